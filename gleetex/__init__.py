@@ -1,12 +1,16 @@
 from . import caching
 from . import cachedconverter
+from . import cost
 from . import htmlhandling
 from . import image
+from . import optimize
 from . import pandoc
 from . import parser
+from . import pipeline
+from . import progress
 from . import typesetting
 
 VERSION = '3.1.0'
 
-__all__ = ['caching', 'cachedconverter', 'htmlhandling', 'image',
-        'pandoc', 'parser', 'unicode', 'VERSION']
\ No newline at end of file
+__all__ = ['caching', 'cachedconverter', 'cost', 'htmlhandling', 'image',
+        'optimize', 'pandoc', 'parser', 'pipeline', 'progress', 'unicode', 'VERSION']
\ No newline at end of file
@@ -2,13 +2,21 @@
 # This code is licenced under the terms of the LGPL-3+, see the file COPYING for
 # more details.
 import argparse
+import collections
+import copy
+import mmap
 import multiprocessing
 import os
 import posixpath
+import queue
 import sys
+import threading
 from . import *
 from .htmlhandling import HtmlImageFormatter
 
+# maximum number of parsed HTML chunks waiting to be written
+CHUNK_QUEUE_SIZE = 1024
+
 
 class HelpfulCmdParser(argparse.ArgumentParser):
     """This variant of arg parser always prints the full help whenever an error
@@ -20,6 +28,17 @@ class HelpfulCmdParser(argparse.ArgumentParser):
 
 
 
+def parse_densities(value):
+    """Parse a comma-separated list of pixel densities, e.g. `1,2,3`."""
+    try:
+        densities = tuple(float(density) for density in value.split(','))
+    except ValueError:
+        densities = ()
+    if not densities or any(density <= 0 for density in densities):
+        raise argparse.ArgumentTypeError("expected a comma-separated list of "
+                "positive numbers, got %s" % repr(value))
+    return densities
+
 def format_ordinal(number):
     endings = ['th', 'st', 'nd', 'rd'] + ['th'] * 6
     return '%d%s' % (number, endings[number%10])
@@ -29,6 +48,7 @@ class Main:
     conversion. Only the run method needs to be called."""
     def __init__(self):
         self.__encoding = "utf-8"
+        self.__optimizer = None
 
     def _parse_args(self, args):
         """Parse command line arguments and return option instance."""
@@ -39,7 +59,8 @@ class Main:
             "through latex and replaced by images.\n\nPlease also see the "
             "documentation on the web or from the manual page for more "
             "information, especially on environment variables.")
-        cmd = HelpfulCmdParser(epilog=epilog, description=description)
+        cmd = HelpfulCmdParser(epilog=epilog, description=description,
+                fromfile_prefix_chars='@')
         cmd.add_argument("-a", action="store_true", dest="exclusionfile", help="save text alternatives " +
                 "for images which are too long for the alt attribute into a " +
                 "single separate file and link images to it")
@@ -56,14 +77,49 @@ class Main:
                         " (e.g. flalign)")
         cmd.add_argument('-f', metavar='SIZE', dest='fontsize', default=12,
                 help="Set font size in pt (default 12)")
+        cmd.add_argument('--embed', metavar='MODE', dest='embedding',
+                choices=HtmlImageFormatter.EMBEDDING_MODES,
+                help=("How to include images into the document: 'link' to the "
+                    "image files, embed them as data URIs ('inline'), embed "
+                    "only images up to the size given by --inline-threshold "
+                    "and link larger ones ('hybrid') or embed each SVG image "
+                    "once and reference it at each occurrence ('symbols'); "
+                    "default: 'link' if -u is given, 'inline' otherwise"))
+        cmd.add_argument('--inline-threshold', metavar='BYTES', type=int,
+                dest='inline_threshold',
+                default=HtmlImageFormatter.INLINE_THRESHOLD,
+                help=("Maximum size of images embedded in hybrid mode "
+                    "(default %d)" % HtmlImageFormatter.INLINE_THRESHOLD))
         cmd.add_argument('-E', dest='encoding', default=None,
                 help="Overwrite encoding to use (default UTF-8)")
         cmd.add_argument('-i', metavar='CLASS', dest='inlinemath',
                 help="CSS class to assign to inline math (default: 'inlinemath')")
         cmd.add_argument('-l', metavar='CLASS', dest='displaymath',
                 help="CSS class to assign to block-level math (default: 'displaymath')")
+        cmd.add_argument('-k', dest='keep_going', action="store_true",
+                default=False, help=("keep going when a formula fails to "
+                    "convert; convert and cache all other formulas and report "
+                    "all failures at the end"))
         cmd.add_argument('-K', dest='keep_latex_source', action="store_true",
                 default=False, help="keep LaTeX file(s) when converting formulas (useful for debugging)")
+        cmd.add_argument('--minify-svg', dest='minify_svg',
+                action='store_true', default=False,
+                help=("Minify SVG images after their creation: remove "
+                    "comments and redundant groups and round coordinates, "
+                    "see --svg-precision"))
+        cmd.add_argument('--svg-precision', metavar='DIGITS', type=int,
+                dest='svg_precision', default=3,
+                help=("Number of decimal places of coordinates in minified SVG "
+                    "images (default 3)"))
+        cmd.add_argument('--gzip-svg', dest='gzip_svg',
+                action='store_true', default=False,
+                help=("Write a gzip-compressed copy of each created SVG image "
+                    "next to it (IMAGE.svg.gz), for web servers serving "
+                    "precompressed files"))
+        cmd.add_argument('--optimize-png', dest='optimize_png',
+                action='store_true', default=False,
+                help=("Re-encode PNG images after their creation with better "
+                    "compression and indexed colours, if lossless"))
         cmd.add_argument('-m', dest='machinereadable', action="store_true",
                 default=False,
                 help="Print output in machine-readable format (less concise, better parseable)")
@@ -85,6 +141,17 @@ class Main:
                     "images and write JSON to stdout")
         cmd.add_argument('--png', action='store_true', dest='png',
                 help="Use PNG instead of SVG for images")
+        cmd.add_argument('--png-fallback', action='store_true',
+                dest='png_fallback', default=False,
+                help=("Create a PNG image along with each SVG image from the "
+                    "same LaTeX run, shown by viewers without SVG support"))
+        cmd.add_argument('--png-densities', metavar='FACTORS', dest='densities',
+                type=parse_densities, default=None,
+                help=("Comma-separated pixel densities of PNG images, as "
+                    "factors of the resolution, e.g. 1,2 for high-DPI "
+                    "screens; all densities are rendered from one LaTeX run "
+                    "and offered with the srcset attribute of linked "
+                    "images"))
         cmd.add_argument('-r', '--resolution', metavar='DPI', dest='dpi',
                 default=None,
                 help=("Set resolution in DPI, only available if PNG output "
@@ -92,10 +159,22 @@ class Main:
         cmd.add_argument('-R', action="store_true", dest='replace_nonascii',
                 default=False, help="Replace non-ascii characters in formulas "
                     "through their LaTeX commands")
+        cmd.add_argument('--scratch-dir', metavar='DIR', dest='scratch_dir',
+                default='',
+                help=("Keep intermediate files in a private directory within "
+                    "DIR instead of the image directory (default: /dev/shm, "
+                    "if available, or the temporary directory)"))
+        cmd.add_argument('--no-scratch', dest='no_scratch',
+                action='store_true', default=False,
+                help=("Keep intermediate files next to the images, as GladTeX "
+                    "versions before 3.1 did"))
         cmd.add_argument("-u", metavar="URL", dest='url',
                 help="URL to image files (relative links are default)")
-        cmd.add_argument('input', help="Input .htex file with LaTeX " +
-                "formulas (if omitted or -, stdin will be read)")
+        cmd.add_argument('input', nargs='+', help="Input .htex file with "
+                "LaTeX formulas (if omitted or -, stdin will be read); if "
+                "several files are given, their formulas are converted "
+                "together; @FILE reads further file names from FILE, one per "
+                "line")
         return cmd.parse_args(args)
 
     def exit(self, text, status):
@@ -116,77 +195,304 @@ class Main:
             print(("Impossible to set resolution when using SVG as output, "
                 "try -f"))
             sys.exit(14)
+        if opts.densities and not opts.png:
+            print("Pixel densities can only be set for PNG output, see --png.")
+            sys.exit(14)
+        if opts.png_fallback and opts.png:
+            print("A PNG fallback can only be created for SVG images.")
+            sys.exit(14)
+        if len(opts.input) > 1 and (opts.output or '-' in opts.input):
+            print(("Options -o and - (stdin) cannot be used with several "
+                "input files."))
+            sys.exit(14)
 
-    def get_input_output(self, options):
+    def get_input_output(self, options, stream=False):
         """Determine whether GladTeX is reading from stdin/file, writing to
         stdout/file and determine base_directory if files are in another
         directory.
         If no output file name is given and there is a input file to read
         from, output is written to a file ending on .html instead of .htex.
         The returned document is either string or byte, the latter if encoding
-        is unknown."""
+        is unknown. If `stream` is set, the opened file (or sys.stdin) is
+        returned instead and needs to be closed by the caller. Input files of
+        unknown encoding are then memory-mapped, unless written to stdout.
+        An input file which is overwritten by the output (e.g. `gladtex
+        doc.html`) is always read completely."""
         data = None
         output = '-'
+        # check which output file name to use
+        base_path = ''
+        if options.output:
+            output = options.output
+            base_path = os.path.dirname(options.output)
+        elif options.input != '-':
+            output = os.path.splitext(options.input)[0] + '.html'
+            base_path = os.path.dirname(options.input)
+        if stream and options.input != '-' and output != '-' and \
+                self.__is_same_file(options.input, output):
+            stream = False # opening the output truncates the input
         if options.input == '-':
-            data = sys.stdin.read()
+            data = (sys.stdin if stream else sys.stdin.read())
         else:
             try:
                 # if encoding was specified or if a pandoc filter is supplied,
                 # read document with default encoding
                 if options.encoding or options.pandocfilter:
                     encoding = ('UTF-8' if options.pandocfilter else options.encoding)
-                    with open(options.input, encoding=encoding) as f:
-                        data = f.read()
+                    data = open(options.input, encoding=encoding)
                 else: # read as binary and guess from HTML meta charset
-                    with open(options.input, 'rb') as file:
-                        data = file.read()
+                    data = open(options.input, 'rb')
+                    # raw HTML is written back as is, in the input encoding;
+                    # never map a file which is truncated by the output
+                    if stream and output != '-':
+                        data = self.__map_file(data)
+                if not stream:
+                    with data:
+                        data = data.read()
             except UnicodeDecodeError as e:
-                self.exit(('Error while reading from %s: %s\nProbably this file'
-                    ' has a different encoding, try specifying -E.') % \
-                            (options.input, str(e)), 88)
+                self.exit_with_decode_error(options.input, e)
             except IsADirectoryError:
                 self.exit("Error: cannot open %s for reading: is a directory." \
                         % options.input, 19)
             except FileNotFoundError:
                 self.exit("Error: file %s not found." % options.input, 20)
 
-        # check which output file name to use
-        base_path = ''
-        if options.output:
-            output = options.output
-            base_path = os.path.dirname(options.output)
-        elif options.input != '-':
-            output = os.path.splitext(options.input)[0] + '.html'
-            base_path = os.path.dirname(options.input)
-
         if base_path: # if finally a basepath found:, strip \\ if on Windows
             base_path = posixpath.join(*(base_path.split('\\')))
         # the basepath needs to be relative to the output file
         return (data, base_path, output)
 
 
+    @staticmethod
+    def __is_same_file(input_fn, output):
+        """Return whether the output file exists and is the input file."""
+        try:
+            return os.path.samefile(input_fn, output)
+        except OSError:
+            return False
+
+    @staticmethod
+    def __map_file(file):
+        """Return a read-only memory map of the given binary file and close
+        the file. Files which cannot be mapped (e.g. empty files or pipes) are
+        returned as they are."""
+        try:
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            return file
+        file.close()
+        return mapped
+
     def run(self, args):
         options = self._parse_args(args[1:])
         self.validate_options(options)
         self.__encoding = options.encoding
+        self.__optimizer = self.create_optimizer(options)
+        if len(options.input) > 1:
+            self.run_batch(options)
+            self.report_optimization()
+            return
+        options.input = options.input[0]
+        # HTML documents are parsed while the formulas are converted
+        doc, base_path, output = self.read_document(options, lazy=True)
+        # show the progress of the conversion on a terminal
+        progress_bar = self.create_progress_bar(options)
+        processed = self.convert_images(doc, base_path, options.img_directory,
+                options, progress_bar)
+        try:
+            self.write_document(processed, base_path, output, options,
+                    progress_bar)
+        except parser.ParseException as e:
+            if output != '-':
+                image.remove_all(output)
+            self.exit_with_parse_error(options.input, e)
+        except UnicodeDecodeError as e: # input is decoded while it is parsed
+            if output != '-':
+                image.remove_all(output)
+            self.exit_with_decode_error(options.input, e)
+        except (cachedconverter.ConversionException,
+                cachedconverter.MultipleConversionException,
+                KeyboardInterrupt) as e:
+            if output != '-': # do not leave an incomplete document behind
+                image.remove_all(output)
+            self.emit_conversion_error(e, options)
+        self.report_optimization()
+
+    def run_batch(self, options):
+        """Convert several input documents at once. All documents are parsed
+        first and the formulas of all documents written to the same directory
+        are converted together, so that formulas shared by several documents
+        are converted only once. Each output directory keeps its own cache;
+        images already converted for another directory are copied instead of
+        being converted again. The documents are written after all formulas
+        have been converted. With `-k`, all documents without failing formulas
+        are written."""
+        # one converter per output directory, the encoding of its first
+        # document is used for the LaTeX documents
+        groups = collections.OrderedDict() # base_path -> (converter, documents)
+        progress_bar = self.create_progress_bar(options)
+        for input_fn in options.input:
+            doc_options = copy.copy(options)
+            doc_options.input = input_fn
+            doc, base_path, output = self.read_document(doc_options)
+            if base_path not in groups:
+                groups[base_path] = (self.create_converter(base_path,
+                        options.img_directory, options, progress_bar), [])
+            groups[base_path][1].append((input_fn, doc, base_path, output,
+                self.__encoding))
+        errors = []
+        try:
+            try:
+                converted = [] # converters of previously converted groups
+                for conv, group in groups.values():
+                    errors.extend(self.convert_group(conv, group, converted,
+                        options))
+                    if errors and not options.keep_going:
+                        break
+                    converted.append(conv)
+            finally:
+                if progress_bar:
+                    progress_bar.finish()
+            if errors and not options.keep_going:
+                self.emit_conversion_error(errors[0], options)
+            for conv, group in groups.values():
+                for _input_fn, doc, base_path, output, encoding in group:
+                    self.__encoding = encoding
+                    formulas = self.get_formulas(doc, options)
+                    if not all(conv.contains(formula, dsp)
+                            for _pos, dsp, formula in formulas):
+                        continue # contains failed formulas
+                    data = [conv.get_data_for(formula, dsp)
+                            for _pos, dsp, formula in formulas]
+                    self.write_document(self.replace_formulas(doc, data,
+                        options), base_path, output, options)
+        except KeyboardInterrupt as e:
+            self.emit_conversion_error(e, options)
+        if errors:
+            self.emit_conversion_error(
+                    cachedconverter.MultipleConversionException(errors),
+                    options)
+
+    def convert_group(self, conv, documents, converted, options):
+        """Convert the formulas of all given documents with the given
+        converter and return a list of ConversionExceptions, one for each
+        failed formula (at most one unless -k was given). Formulas are copied
+        from the given list of other converters, if possible, see
+        CachedConverter.import_formula. The exceptions name the document the
+        formula belongs to."""
+        formulas = []
+        offsets = [] # (index of first formula, input file name)
+        for input_fn, doc, _base_path, _output, _encoding in documents:
+            offsets.append((len(formulas), input_fn))
+            formulas.extend(self.get_formulas(doc, options))
+        for _pos, dsp, formula in formulas:
+            if not conv.contains(formula, dsp):
+                source = next((c for c in converted
+                    if c.contains(formula, dsp)), None)
+                if source:
+                    conv.import_formula(source, formula, dsp)
+        try:
+            conv.convert_all(formulas)
+        except cachedconverter.ConversionException as e:
+            errors = [e]
+        except cachedconverter.MultipleConversionException as e:
+            errors = e.exceptions
+        else:
+            errors = []
+        for error in errors: # make the formula count relative to its document
+            offset, error.document = [o for o in offsets
+                    if o[0] < error.formula_count][-1]
+            error.formula_count -= offset
+        return errors
+
+    def read_document(self, options, lazy=False):
+        """Read and parse the input document. Return a tuple (document,
+        base_path, output), see get_input_output. The document is either a
+        list of raw HTML chunks and formulas or a tuple of (document AST, list
+        of formulas) if options.pandocfilter. If `lazy` is set, HTML chunks
+        are returned as a generator, see parser.parse_document, which reads
+        the input block by block while it is consumed."""
         fmt = ('pandocfilter' if options.pandocfilter else 'html')
-        doc, base_path, output = self.get_input_output(options)
+        stream = lazy and not options.pandocfilter
+        doc, base_path, output = self.get_input_output(options, stream)
         try:
-            # doc is either a list of raw HTML chunks and formulas or a tuple of
-            # (document AST, list of formulas) if options.pandocfilter
-            self.__encoding, doc = parser.parse_document(doc, fmt)
+            self.__encoding, chunks = parser.parse_document(doc, fmt, lazy)
         except parser.ParseException as e:
-            input_fn = ('stdin' if options.input == '-' else options.input)
-            self.exit('Error while parsing {}: {}'.format(input_fn,
-                str(e)), 5)
+            self.exit_with_parse_error(options.input, e)
+        except UnicodeDecodeError as e:
+            self.exit_with_decode_error(options.input, e)
+        # a memory map is released with the last chunk referring to it; an
+        # input file may have been read completely, see get_input_output
+        if hasattr(doc, 'read') and not isinstance(doc, mmap.mmap):
+            chunks = self.__close_after(chunks, doc)
+        return (chunks, base_path, output)
 
-        processed = self.convert_images(doc, base_path, options.img_directory,
-                options)
+    @staticmethod
+    def __close_after(chunks, file):
+        """Yield the given chunks and close the file they are parsed from
+        afterwards, unless it is stdin."""
+        try:
+            yield from chunks
+        finally:
+            if file is not sys.stdin:
+                file.close()
+
+    def exit_with_parse_error(self, input_fn, error):
+        """Report a ParseException and exit."""
+        input_fn = ('stdin' if input_fn == '-' else input_fn)
+        self.exit('Error while parsing {}: {}'.format(input_fn, str(error)), 5)
+
+    def exit_with_decode_error(self, input_fn, error):
+        """Report a UnicodeDecodeError while reading the input and exit."""
+        self.exit(('Error while reading from %s: %s\nProbably this file'
+            ' has a different encoding, try specifying -E.') % \
+                    (input_fn, str(error)), 88)
+
+    def create_optimizer(self, options):
+        """Return an optimize.ImageOptimizer configured with the command-line
+        options or None if no optimization was requested."""
+        optimizer = optimize.ImageOptimizer()
+        if options.minify_svg:
+            optimizer.set_minify_svg(options.svg_precision)
+        if options.optimize_png:
+            optimizer.set_optimize_png(True)
+        if options.gzip_svg:
+            optimizer.set_precompress_svg(True)
+        return (optimizer if optimizer.is_enabled() else None)
+
+    def report_optimization(self):
+        """Print the number of bytes saved by the image optimization, if
+        any images were optimized."""
+        if not self.__optimizer:
+            return
+        files, before, after = self.__optimizer.get_statistics()
+        if files:
+            sys.stderr.write(('Optimized %d image(s): %d bytes saved (%d -> %d '
+                'bytes, %.1f %%).\n') % (files, before - after, before, after,
+                    100.0 * (before - after) / before if before else 0))
+
+    def create_progress_bar(self, options):
+        """Return a progress.ProgressBar if run on a terminal, None
+        otherwise."""
+        if sys.stderr.isatty() and not options.machinereadable:
+            return progress.ProgressBar(sys.stderr)
+        return None
+
+    def write_document(self, processed, base_path, output, options,
+            progress_bar=None):
+        """Write a document with formulas replaced by their conversion data
+        (see convert_images) to the given output file name or to stdout."""
         img_dir = ('' if not options.img_directory or \
                 options.img_directory == '.' else options.img_directory)
         with HtmlImageFormatter(base_path=os.path.join(base_path, img_dir),
                 link_prefix=options.url) as img_fmt:
             img_fmt.set_exclude_long_formulas(True)
+            img_fmt.set_embedding(options.embedding if options.embedding
+                    else (HtmlImageFormatter.LINK if options.url
+                        else HtmlImageFormatter.INLINE),
+                    options.inline_threshold)
+            # image paths are relative to the output document
+            img_fmt.set_source_path(base_path)
             if options.replace_nonascii:
                 img_fmt.set_replace_nonascii(True)
             if options.url:
@@ -196,19 +502,102 @@ class Main:
             if options.displaymath:
                 img_fmt.set_display_math_css_class(options.displaymath)
 
+            # formulas are converted while the document is written
             with (sys.stdout if output == '-'
                     else open(output, 'w', encoding=self.__encoding)) as file:
-                if options.pandocfilter:
-                    pandoc.write_pandoc_ast(file, processed, img_fmt)
-                else:
-                    htmlhandling.write_html(file, processed, img_fmt)
-
-    def convert_images(self, parsed_document, base_path, img_dir, options):
-        """Convert all formulas to images and store file path and equation in a
-        list to be processed later on."""
+                try:
+                    if options.pandocfilter:
+                        pandoc.write_pandoc_ast(file, processed, img_fmt)
+                    else:
+                        htmlhandling.write_html(file, processed, img_fmt)
+                finally:
+                    if progress_bar:
+                        progress_bar.finish()
+
+    def emit_conversion_error(self, error, options):
+        """Report a ConversionException, MultipleConversionException or
+        KeyboardInterrupt and exit."""
+        if isinstance(error, cachedconverter.ConversionException):
+            self.emit_latex_error(error, options.machinereadable,
+                    options.replace_nonascii)
+        elif isinstance(error, cachedconverter.MultipleConversionException):
+            self.emit_latex_errors(error, options.machinereadable,
+                    options.replace_nonascii)
+        # running LaTeX processes have been terminated by the converter
+        self.exit('Interrupted.', 130)
+
+    def convert_images(self, parsed_document, base_path, img_dir, options,
+            observer=None):
+        """Convert all formulas to images. The returned document has each
+        formula replaced by its conversion data (file path, positioning, ...).
+        It is generated lazily: formulas are converted concurrently and the
+        document is available up to the first formula which is not converted
+        yet. Conversion errors are raised while iterating over the document.
+        The optional observer is notified about the progress, see
+        CachedConverter.set_observer."""
+        conv = self.create_converter(base_path, img_dir, options, observer)
+        failed = threading.Event()
+        if options.pandocfilter or isinstance(parsed_document, list):
+            formulas = self.get_formulas(parsed_document, options)
+            converted = self.__iter_converted(conv.convert_iter(formulas,
+                ordered=True), failed)
+            return self.replace_formulas(parsed_document, converted, options)
+        # lazily parsed HTML: the formulas are queued for conversion while the
+        # document is parsed, all chunks are passed on through a bounded queue,
+        # so that the parser never runs far ahead of the output
+        chunks = queue.Queue(maxsize=CHUNK_QUEUE_SIZE)
+        abandoned = threading.Event()
+        converted = self.__iter_converted(conv.convert_iter(
+            self.__split_formulas(parsed_document, chunks, abandoned, failed),
+            ordered=True), failed)
+        return self.__merge_formulas(chunks, converted, abandoned)
+
+    @staticmethod
+    def __split_formulas(parsed_document, chunks, abandoned, failed):
+        """Put all chunks of the parsed document into the queue `chunks`,
+        followed by None, and yield the formulas. Stop as soon as `abandoned`
+        is set. Once `failed` is set, the document is not written anymore:
+        the chunks are dropped, but the formulas are still yielded, so that
+        the remaining formulas can be converted (see __iter_converted)."""
+        def put(chunk):
+            while not abandoned.is_set():
+                if failed.is_set():
+                    return True
+                try:
+                    chunks.put(chunk, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+        try:
+            for chunk in parsed_document:
+                if not put(chunk):
+                    return
+                if isinstance(chunk, (tuple, list)):
+                    yield chunk
+        finally:
+            put(None)
+
+    @staticmethod
+    def __merge_formulas(chunks, converted, abandoned):
+        """Yield the chunks from the queue `chunks` (see __split_formulas),
+        with the formulas replaced by their conversion data from `converted`.
+        `abandoned` is set if the document is not consumed completely."""
+        try:
+            for chunk in iter(chunks.get, None):
+                yield (next(converted) if isinstance(chunk, (tuple, list))
+                        else chunk)
+            for _ in converted: # raises parse errors, if any
+                pass
+        finally:
+            abandoned.set()
+            converted.close()
+
+    def create_converter(self, base_path, img_dir, options, observer=None):
+        """Create a CachedConverter for documents written to base_path,
+        configured with the command-line options."""
         base_path = ('' if not base_path or base_path == '.' else base_path)
         img_dir = ('' if not img_dir or img_dir == '.' else img_dir)
-        result = []
         try:
             conv = cachedconverter.CachedConverter(base_path,
                     not options.notkeepoldcache, encoding=self.__encoding,
@@ -217,47 +606,57 @@ class Main:
             self.exit(e.args[0], 78)
 
         self.set_options(conv, options)
+        if not options.no_scratch:
+            conv.set_scratch_directory(options.scratch_dir)
+        if options.keep_going:
+            conv.set_keep_going(True)
+        if observer:
+            conv.set_observer(observer)
+        if self.__optimizer:
+            conv.set_optimizer(self.__optimizer)
+        return conv
+
+    @staticmethod
+    def get_formulas(parsed_document, options):
+        """Return the list of formulas of a parsed document."""
         if options.pandocfilter:
-            formulas = parsed_document[1]
-        else: # HTML chunks from EqnParser
-            formulas = [c for c in parsed_document if isinstance(c, (tuple,
-                list))]
-        try:
-            conv.convert_all(formulas)
-        except cachedconverter.ConversionException as e:
-            self.emit_latex_error(e, options.machinereadable,
-                    options.replace_nonascii)
+            return parsed_document[1]
+        # HTML chunks from EqnParser
+        return [c for c in parsed_document if isinstance(c, (tuple, list))]
 
+    @staticmethod
+    def replace_formulas(parsed_document, converted, options):
+        """Replace the formulas of a parsed document by their conversion data,
+        taken from the iterable `converted` in document order."""
+        converted = iter(converted)
         if options.pandocfilter:
             # return (ast, formulas), just with formulas being replaced with the
             # conversion data
-            return (parsed_document[0], [conv.get_data_for(eqn, style)
-                    for _p, style, eqn in formulas])
-        for chunk in parsed_document:
-            # output of EqnParser: list-alike is formula, str is raw HTML
-            if isinstance(chunk, (tuple, list)):
-                _p, displaymath, formula = chunk
-                try:
-                    result.append(conv.get_data_for(formula, displaymath))
-                except KeyError as e:
-                    # formula is usually tuple(str, bool)
-                    formula = e.args[0]
-                    if isinstance(formula, (list, tuple)):
-                        formula = e.args[0][0] # ignore bool(displaymath)
-                    raise KeyError(("formula '{}' not found; that means it was "
-                            "not converted which should usually not happen.")
-                        .format(formula))
-            else:
-                result.append(chunk)
-        return result
+            return (parsed_document[0], converted)
+        # output of EqnParser: list-alike is formula, str is raw HTML
+        return (next(converted) if isinstance(chunk, (tuple, list)) else chunk
+                for chunk in parsed_document)
 
+    @staticmethod
+    def __iter_converted(conversions, failed):
+        """Yield the data of each converted formula. At the first formula
+        which could not be converted, `failed` is set, the remaining formulas
+        are converted and the conversion error is raised."""
+        for _index, data in conversions:
+            if data is None:
+                # the document is not written anymore, do not wait for it to
+                # be consumed, see __split_formulas
+                failed.set()
+                for _ in conversions:
+                    pass
+            yield data
 
     def set_options(self, conv, options):
         """Apply options from command line parser to the converter."""
         # set options
         options_to_query = ['preamble', 'latex_maths_env',
                 'png', 'keep_latex_source', 'foreground_color',
-                'background_color']
+                'background_color', 'png_fallback']
         for option_str in options_to_query:
             option = getattr(options, option_str)
             if option:
@@ -268,16 +667,37 @@ class Main:
             conv.set_option("dpi", float(options.dpi))
         elif options.fontsize:
             conv.set_option("fontsize", options.fontsize)
+        if options.densities:
+            conv.set_option('densities', options.densities)
         if options.replace_nonascii:
             conv.set_replace_nonascii(True)
 
     def emit_latex_error(self, err, machine_readable, escape):
+        """Format a LaTeX error in a meaningful way and exit. The argument
+        escape specifies, whether the -R switch had been passed."""
+        if 'DEBUG' in os.environ and os.environ['DEBUG'] == '1':
+            raise err
+        self.exit(self.format_latex_error(err, machine_readable, escape), 91)
+
+    def emit_latex_errors(self, errors, machine_readable, escape):
+        """Format all errors of a MultipleConversionException and exit. In the
+        machine-readable format, errors are separated by an empty line."""
+        if 'DEBUG' in os.environ and os.environ['DEBUG'] == '1':
+            raise errors
+        msgs = [self.format_latex_error(err, machine_readable, escape)
+                for err in errors.exceptions]
+        if machine_readable:
+            msg = '\n\n'.join(msgs)
+        else:
+            msg = '\n\n'.join(msgs) + \
+                    '\n\n%d formula(s) could not be converted.' % len(msgs)
+        self.exit(msg, 91)
+
+    def format_latex_error(self, err, machine_readable, escape):
         """Format a LaTeX error in a meaningful way. The argument escape
         specifies, whether the -R switch had been passed. If the pandocfilter
         mode is active, formula positions will be omitted; this makes the code
         more complex."""
-        if 'DEBUG' in os.environ and os.environ['DEBUG'] == '1':
-            raise err
         escaped = err.formula
         if escape:
             escaped = typesetting.escape_unicode_maths(err.formula)
@@ -295,13 +715,16 @@ class Main:
             if err.src_line_number and err.src_pos_on_line:
                 msg = ('Line: {}, {}\n' + msg).format(err.src_line_number,
                         err.src_pos_on_line)
+            if err.document:
+                msg = 'File: {}\n{}'.format(err.document, msg)
             if additional:
                 msg += '; ' + additional
         else:
             formula = '    ' + err.formula.replace('\n', '\n    ')
             escaped = ('    ' + escaped.replace('\n', '\n    ') if escaped !=
                     err.formula else '')
-            msg = "Error while converting formula %d\n" % err.formula_count
+            msg = "Error while converting formula %d%s\n" % (err.formula_count,
+                    (' in ' + err.document if err.document else ''))
             if err.src_line_number and err.src_pos_on_line:
                 msg += " at line %d, %d:\n" % (err.src_line_number,
                         err.src_pos_on_line,)
@@ -312,7 +735,7 @@ class Main:
             if additional:
                 import textwrap
                 msg += ' undefined.\n' + '\n'.join(textwrap.wrap(additional, 80))
-        self.exit(msg, 91)
+        return msg
 
 
 def main():
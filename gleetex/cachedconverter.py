@@ -5,15 +5,59 @@
 converter sacrifices customizability for convenience and provides a class
 converting a formula directly to a png file."""
 
-import concurrent.futures
+import asyncio
+import collections
+import functools
+import hashlib
 import multiprocessing
 import os
+import queue
+import re
+import shutil
 import subprocess
+import tempfile
+import threading
+import time
 
-from . import caching, image, typesetting
+from . import caching, cost, image, pipeline, progress, typesetting
 from .caching import normalize_formula
 from .image import Format
 
+# scratch directories of a conversion, named after the process creating them
+SCRATCH_NAME = re.compile(r'^gladtex-(\d+)-')
+# memory-backed file systems to create scratch directories in, if available
+FAST_SCRATCH_PATHS = ('/dev/shm',)
+
+def default_scratch_directory():
+    """Return the directory the scratch directories of conversions are created
+    in by default: a memory-backed file system, if available, or the temporary
+    directory of the system."""
+    for path in FAST_SCRATCH_PATHS:
+        if os.path.isdir(path) and os.access(path, os.W_OK | os.X_OK):
+            return path
+    return tempfile.gettempdir()
+
+def remove_stale_scratch_directories(directory):
+    """Remove the scratch directories within the given directory which were
+    left behind by GladTeX processes not running anymore, e.g. after a crash
+    or a kill. This is only supported on POSIX systems."""
+    if os.name != 'posix':
+        return
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return
+    for name in names:
+        match = SCRATCH_NAME.match(name)
+        if not match or int(match.group(1)) == os.getpid():
+            continue
+        try:
+            os.kill(int(match.group(1)), 0)
+        except ProcessLookupError:
+            shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+        except OSError: # running, but owned by another user
+            pass
+
 class ConversionException(Exception):
     """This exception is raised whenever a problem occurs during conversion.
     Example:
@@ -23,6 +67,8 @@ class ConversionException(Exception):
     assert c.src_line_number == 10 # line number in source document (counting from 1)
     assert c.src_pos_on_line == 38 # position of formula in source line, counting from 1
     assert c.formula_count == 5 # fifth formula in document (starting from 1)
+    The attribute `document` is None, unless set by the caller to name the
+    document containing the formula.
     """
     # mind your own business mr. pylint:
     #pylint: disable=too-many-arguments
@@ -41,6 +87,55 @@ class ConversionException(Exception):
         self.src_line_number = src_line_number
         self.src_pos_on_line = src_pos_on_line
         self.formula_count = formula_count
+        self.document = None
+
+class MultipleConversionException(Exception):
+    """This exception is raised if one or more formulas could not be converted
+    and the converter was asked to keep going (see
+    CachedConverter.set_keep_going). All formulas which could be converted
+    are in the cache.
+    The attribute `exceptions` is a list with a ConversionException for each
+    failed formula, ordered by their position in the document."""
+    def __init__(self, exceptions):
+        self.exceptions = sorted(exceptions, key=lambda e: e.formula_count)
+        super().__init__("LaTeX failed at %d formula(s): %s" % (
+            len(self.exceptions), ', '.join(str(e.formula_count)
+                for e in self.exceptions)))
+
+class Profile(collections.namedtuple('Profile', ['dpi', 'transparency',
+        'fontsize', 'background_color', 'foreground_color', 'preamble',
+        'latex_maths_env', 'keep_latex_source', 'png', 'densities',
+        'png_fallback'], defaults=(None,) * 7 + (False, False, None, False))):
+    """Profile(dpi=None, transparency=None, fontsize=None,
+            background_color=None, foreground_color=None, preamble=None,
+            latex_maths_env=None, keep_latex_source=False, png=False,
+            densities=None, png_fallback=False)
+    An immutable set of rendering options, see CachedConverter.set_option for
+    their meaning. A profile can be passed to each conversion call of a
+    CachedConverter, so that one converter renders formulas with different
+    options at the same time:
+
+        dark = Profile(foreground_color='FFFFFF', background_color='000000')
+        c.convert_all(formulas, dark)
+        c.get_data_for(formula, False, dark)
+
+    Use `profile._replace(option=value)` to derive a profile from another.
+    Profiles are used as keys, hence lists, e.g. of densities, are converted
+    to tuples."""
+    __slots__ = ()
+
+    def __new__(cls, *args, **kwargs):
+        return cls._make(super().__new__(cls, *args, **kwargs))
+
+    @classmethod
+    def _make(cls, iterable):
+        # also used by _replace
+        return super()._make((tuple(value) if isinstance(value, list)
+                else value) for value in iterable)
+
+    def get_id(self):
+        """Return a short identifier, derived from the options."""
+        return hashlib.sha1(repr(tuple(self)).encode('utf-8')).hexdigest()[:8]
 
 class CachedConverter:
     """Convert formulas to images.
@@ -64,6 +159,13 @@ class CachedConverter:
     :param img_dir directory for images (default ., equivalent to base_path)
             For example "images" would put it in `base_path`/images and "../img"
             would put it in "base_path/../img"
+
+    The rendering options are set with `set_option`. Alternatively, a Profile
+    can be passed to the conversion methods. Formulas of each profile are
+    cached separately, the cache of the options set with `set_option` is
+    gladtex.cache, the caches of other profiles are named after the profile,
+    e.g. gladtex-1a2b3c4d.cache. Several threads may convert formulas with one
+    converter at the same time.
     """
     GLADTEX_CACHE_FILE_NAME = 'gladtex.cache'
 
@@ -78,24 +180,54 @@ class CachedConverter:
         self.__cache = caching.ImageCache(cache_path,
                 keep_old_cache=keep_old_cache,
                 base_path=empty_path(self.__output_path))
-        self.__converter = None
-        self.__options = {'dpi': None, 'transparency': None, 'fontsize': None,
-                'background_color': None, 'foreground_color': None,
-                'preamble': None, 'latex_maths_env': None,
-                'keep_latex_source': False, 'png': False}
+        self.__keep_old_cache = keep_old_cache
+        self.__profile = Profile()
+        self.__caches = {} # caches of other profiles than self.__profile
+        # protects the caches and the reserved file names when converting from
+        # several threads
+        self.__lock = threading.RLock()
         self.__encoding = encoding
         self.__replace_nonascii = False
+        self.__workers = (None, None)
+        self.__keep_going = False
+        # image files currently being created, without extension, so that
+        # images and their variants of different profiles do not clash
+        self.__reserved_paths = set()
+        self.__observer = None
+        self.__observer_lock = threading.Lock()
+        self.__optimizer = None
+        self.__scratch = None
 
 
     def set_option(self, option, value):
         """Set one of the options accepted for gleetex.image.Tex2img. It is a
         proxy function.
         `option` must be one of dpi, fontsize, transparency, background_color,
-        foreground_color, preamble, latex_maths_env, keep_latex_source, png."""
-        if not option in self.__options.keys():
+        foreground_color, preamble, latex_maths_env, keep_latex_source, png,
+        densities, png_fallback.
+        The options form the profile used if no profile is passed to a
+        conversion, see get_profile."""
+        if not option in Profile._fields:
             raise ValueError("Option must be one of " + \
-                    ', '.join(self.__options.keys()))
-        self.__options[option] = value
+                    ', '.join(Profile._fields))
+        self.__profile = self.__profile._replace(**{option: value})
+
+    def get_profile(self):
+        """Return the Profile with the options set by set_option."""
+        return self.__profile
+
+    def __get_cache(self, profile=None):
+        """Return the ImageCache for the given profile."""
+        if profile is None or profile == self.__profile:
+            return self.__cache
+        with self.__lock:
+            if profile not in self.__caches:
+                self.__caches[profile] = caching.ImageCache(
+                        os.path.join(self.__img_dir, 'gladtex-%s.cache' %
+                            profile.get_id()),
+                        keep_old_cache=self.__keep_old_cache,
+                        base_path=self.__output_path)
+            return self.__caches[profile]
 
     def set_replace_nonascii(self, flag):
         """If set, GladTeX will convert all non-ascii character to LaTeX
@@ -103,123 +235,516 @@ class CachedConverter:
         self.__replace_nonascii = flag
 
 
-    def convert_all(self, formulas):
-        """convert_all(formulas)
+    def set_observer(self, observer):
+        """Set a callable which is notified about the progress of the
+        conversion. It is called with a progress.Event for each formula being
+        queued, found in the cache, typeset by LaTeX, converted to an image or
+        failing to convert. Calls are serialized, even though they originate
+        from different worker threads. See the progress module for details."""
+        self.__observer = observer
+
+    def __notify(self, kind, index, formula, displaymath):
+        """Report an event to the observer, if any."""
+        if self.__observer:
+            with self.__observer_lock:
+                self.__observer(progress.make_event(kind, index, formula,
+                    displaymath))
+
+    def __notify_job(self, kind, job):
+        """Report an event about a job (see _get_formulas_to_convert)."""
+        self.__notify(kind, job[4] - 1, job[0], job[3])
+
+    def set_optimizer(self, optimizer):
+        """Set an optimize.ImageOptimizer, which post-processes each image
+        right after its creation, within the worker thread which created
+        it."""
+        self.__optimizer = optimizer
+
+    def set_scratch_directory(self, path):
+        """Keep the intermediate files of a conversion (LaTeX log and DVI
+        files) in a private directory, created within the given directory (an
+        empty string selects default_scratch_directory(), e.g. /dev/shm) and
+        removed afterwards. Each worker thread uses its own subdirectory for
+        all formulas it typesets. LaTeX reads the document from its standard
+        input and dvisvgm writes SVG images to its standard output. Images are
+        created in the scratch directory as well and moved to the image
+        directory once complete, so the image directory only receives final
+        images, each replaced atomically.
+        Scratch directories left behind by crashed GladTeX processes are
+        removed when a conversion starts.
+        None (default) keeps the intermediate files next to the images, as
+        does the option keep_latex_source."""
+        self.__scratch = path
+
+    def set_keep_going(self, flag):
+        """If set, the conversion continues when a formula fails to convert.
+        All other formulas are converted and cached and a
+        MultipleConversionException with all failures is raised at the end.
+        By default, the conversion stops at the first error and a
+        ConversionException is raised."""
+        self.__keep_going = flag
+
+    def convert_all(self, formulas, profile=None):
+        """convert_all(formulas, profile=None)
         Convert all formulas using self.convert concurrently. Each element of
         `formulas` must be a tuple containing (formula, displaymath,
-        Formulas already contained in the cache are not converted."""
-        formulas_to_convert = self._get_formulas_to_convert(formulas)
+        Formulas already contained in the cache are not converted.
+        `profile` is the Profile to render the formulas with, by default the
+        options set with set_option."""
+        profile = (profile if profile else self.__profile)
+        formulas_to_convert = self._get_formulas_to_convert(formulas, profile)
         if formulas_to_convert:
-            self.__converter = image.Tex2img(Format.Png
-                    if self.__options['png'] else Format.Svg)
-            # apply configured image output options
-            for option, value in self.__options.items():
-                if value and hasattr(self.__converter, 'set_' + option):
-                    if isinstance(value, str): # only try string -> number
-                        try: # some values are numbers
-                            value = float(value)
-                        except ValueError:
-                            pass
-                    getattr(self.__converter, 'set_' + option)(value)
-            self._convert_concurrently(formulas_to_convert)
-
-    def _get_formulas_to_convert(self, formulas):
+            for _job in self.__convert(formulas_to_convert, profile):
+                pass
+
+    def convert_iter(self, formulas, ordered=False, profile=None):
+        """convert_iter(formulas, ordered=False, profile=None)
+        Convert all formulas like convert_all, but yield a tuple
+        (formula_index, data) for each formula as soon as its image is
+        available. The formula_index is the position of the formula in
+        `formulas` (counting from 0) and data is what get_data_for returns.
+        Cached formulas are yielded first. If `ordered` is set, formulas are
+        yielded in the order of `formulas` instead, so that e.g. a document can
+        be written while later formulas are still converted.
+        `formulas` may be any iterable, e.g. a generator parsing a document. It
+        is consumed by a separate thread and each formula is queued for
+        conversion as soon as it is retrieved, so that parsing and conversion
+        overlap. The thread is started right away; the returned iterator
+        needs to be exhausted or closed. If it is closed early, the thread is
+        not waited for, since the iterable may block until its consumer has
+        been shut down; it stops after the formula it is retrieving. Exceptions raised by the iterable are
+        re-raised after the formulas retrieved so far have been yielded.
+        For formulas which failed to convert, data is None; the
+        ConversionException (or MultipleConversionException) is raised after
+        all formulas have been yielded."""
+        profile = (profile if profile else self.__profile)
+        # (index, formula, job) for each formula; job is None for cached
+        # formulas, see __iter_jobs
+        arrivals = queue.Queue()
+        new_jobs = queue.Queue() # jobs for _convert_concurrently
+        created = [] # all jobs, to release their file names afterwards
+        stop = threading.Event()
+        feed_errors = []
+        def feed():
+            try:
+                for index, formula, job, new in self.__iter_jobs(formulas,
+                        profile):
+                    if new:
+                        created.append(job)
+                        new_jobs.put(job)
+                    arrivals.put((index, formula, job))
+                    if stop.is_set():
+                        break
+            except BaseException as e: #pylint: disable=broad-except
+                feed_errors.append(e)
+            finally:
+                arrivals.put(None)
+                new_jobs.put(None)
+                if stop.is_set(): # jobs created after the conversion ended
+                    self.__release_paths(created)
+        threading.Thread(target=feed, daemon=True).start()
+        return self.__iter_conversions(arrivals, new_jobs, ordered, profile,
+                (stop, feed_errors, created))
+
+    def __iter_conversions(self, arrivals, new_jobs, ordered, profile,
+            feeding):
+        """Yield the results of convert_iter. `arrivals` and `new_jobs` are
+        filled by the thread consuming the formulas, `feeding` is a tuple of
+        (stop event, list of exceptions, list of created jobs)."""
+        stop, feed_errors, created = feeding
+        conversions = self._convert_concurrently(iter(new_jobs.get, None),
+                profile)
+        get = lambda index, formula: (index, self.get_data_for(formula[2],
+                formula[1], profile))
+        try:
+            if ordered:
+                finished = {} # image path -> error, for processed jobs
+                for index, formula, job in iter(arrivals.get, None):
+                    while job and job[2] not in finished:
+                        done, error = next(conversions)
+                        finished[done[2]] = error
+                    yield ((index, None) if job and finished[job[2]]
+                            else get(index, formula))
+            else:
+                waiting = {} # image path -> [(index, formula), ...]
+                for index, formula, job in iter(arrivals.get, None):
+                    if job:
+                        waiting.setdefault(job[2], []).append((index, formula))
+                    else:
+                        yield get(index, formula)
+                for done, error in conversions:
+                    for index, formula in waiting.pop(done[2]):
+                        yield ((index, None) if error else get(index, formula))
+            for _ in conversions: # raises the conversion errors, if any
+                pass
+            if feed_errors:
+                raise feed_errors[0]
+        finally:
+            stop.set()
+            conversions.close() # stops the pipeline
+            # not joining the feeder: if the conversion ended early, it may be
+            # blocked by the iterable until the caller has cleaned up; it
+            # releases the jobs it still creates itself, see convert_iter
+            self.__release_paths(created)
+
+    async def convert_all_async(self, formulas, concurrency=None,
+            profile=None, timeout=None):
+        """convert_all_async(formulas, concurrency=None, profile=None,
+                timeout=None)
+        Asynchronous counterpart of convert_all, to be awaited within an
+        asyncio event loop. LaTeX and the image converters run as asyncio
+        subprocesses, no threads are used (except for the image optimizer, if
+        set). `concurrency` limits the number of
+        subprocesses running at the same time; it is either a number (default:
+        number of CPUs) or an asyncio.Semaphore, which can be shared between
+        several conversions on the same event loop.
+        Each LaTeX or image conversion process is killed after `timeout`
+        seconds (default: 20, see image.AsyncTex2img) and its formula fails.
+        If the awaiting task is cancelled, e.g. by asyncio.wait_for to limit
+        the duration of the whole conversion, the process groups of all
+        running subprocesses are killed. Errors are reported as in
+        convert_all."""
+        profile = (profile if profile else self.__profile)
+        cache = self.__get_cache(profile)
+        formulas_to_convert = self._get_formulas_to_convert(formulas, profile)
+        if not formulas_to_convert:
+            return
+        if not isinstance(concurrency, asyncio.Semaphore):
+            concurrency = asyncio.Semaphore(concurrency if concurrency
+                    else multiprocessing.cpu_count())
+        converter = self.__create_converter((functools.partial(
+            image.AsyncTex2img, timeout=timeout) if timeout
+            else image.AsyncTex2img), profile)
+        self.__make_image_directory()
+        scratch = self.__make_scratch_directory(converter, profile)
+        async def convert(job):
+            formula, _pos, img_path, displaymath, _count = job
+            dvi = self.__get_dvi_path(img_path, scratch)
+            try:
+                # only measure the rendering, not waiting for a free slot
+                async with concurrency:
+                    start = time.monotonic()
+                    self.__notify_job(progress.LATEX_START, job)
+                    await converter.create_dvi(self.__create_latex_document(
+                        formula, displaymath, profile), dvi)
+                    self.__notify_job(progress.LATEX_DONE, job)
+                    elapsed = time.monotonic() - start
+                paths = self.__get_image_paths(converter, img_path, dvi,
+                        scratch)
+                async with concurrency:
+                    start = time.monotonic()
+                    pos = await converter.create_image(dvi, paths[0][0])
+                    elapsed += time.monotonic() - start
+                variants = converter.get_variants(img_path)
+                if self.__optimizer: # CPU-bound, keep the event loop going
+                    for path, _target in paths:
+                        await asyncio.get_event_loop().run_in_executor(None,
+                                self.__optimizer.optimize, path)
+                self.__publish_images(paths)
+            except subprocess.SubprocessError as e:
+                return (job, None, e)
+            self.__notify_job(progress.IMAGE_DONE, job)
+            return (job, {'pos': pos, 'path': img_path,
+                    'displaymath': displaymath, 'variants': variants,
+                    'time': round(elapsed, 3)}, None)
+        for job in formulas_to_convert:
+            self.__notify_job(progress.QUEUED, job)
+        tasks = [asyncio.ensure_future(convert(job))
+                for job in formulas_to_convert]
+        def write_cache(job=None, data=None):
+            with self.__lock: # write back cache with valid entries
+                if job:
+                    cache.add_formula(job[0], data['pos'], data['path'],
+                            data['displaymath'], data['time'],
+                            data['variants'])
+                cache.write()
+        errors = []
+        try:
+            for future in asyncio.as_completed(tasks):
+                job, data, error = await future
+                if error:
+                    self.__notify_job(progress.FAILED, job)
+                    errors.append(self.__conversion_exception(error, job))
+                    # writing the cache blocks, keep the event loop going
+                    await asyncio.get_event_loop().run_in_executor(None,
+                            write_cache)
+                    if not self.__keep_going:
+                        break
+                else:
+                    await asyncio.get_event_loop().run_in_executor(None,
+                            write_cache, job, data)
+        finally:
+            pending = [task for task in tasks if not task.done()]
+            for task in pending: # kills the subprocesses, see async_proc_call
+                task.cancel()
+            if pending:
+                await asyncio.wait(pending)
+            self.__release_paths(formulas_to_convert)
+            if scratch:
+                shutil.rmtree(scratch, ignore_errors=True)
+        if errors and self.__keep_going:
+            raise MultipleConversionException(errors)
+        if errors:
+            raise errors[0]
+
+    def __create_converter(self, converter_class, profile):
+        """Create an image converter (Tex2img or AsyncTex2img) and apply the
+        image output options of the given profile. A new converter is created
+        for each conversion, so that conversions with different profiles do
+        not interfere."""
+        converter = converter_class(Format.Png
+                if profile.png else Format.Svg)
+        # apply configured image output options
+        for option, value in profile._asdict().items():
+            if value and hasattr(converter, 'set_' + option):
+                if isinstance(value, str): # only try string -> number
+                    try: # some values are numbers
+                        value = float(value)
+                    except ValueError:
+                        pass
+                getattr(converter, 'set_' + option)(value)
+        # dvipng needs the additional indication of transparency (enabled
+        # by default) when setting a background colour
+        if profile.background_color:
+            converter.set_transparency(False)
+        return converter
+
+    def _get_formulas_to_convert(self, formulas, profile=None):
         """Return a list of formulas to convert, along with their count in the
         global list of formulas of the document being converted and the file
         name. Function was decomposed for better testability."""
-        formulas_to_convert = [] # find as many file names as equations
-        file_ext = (Format.Png.value if self.__options['png']
+        return [job for _index, _formula, job, new
+                in self.__iter_jobs(formulas, profile) if new]
+
+    def __iter_jobs(self, formulas, profile=None):
+        """Yield a tuple (index, formula, job, new) for each formula of the
+        given iterable, where job is the job converting the formula (see
+        _convert_concurrently) or None if the formula is cached. `new` is set
+        for the first occurrence of a formula to convert. The file name of a
+        new job is reserved right away and needs to be released afterwards,
+        see __release_paths."""
+        profile = (profile if profile else self.__profile)
+        cache = self.__get_cache(profile)
+        file_ext = (Format.Png.value if profile.png
                 else Format.Svg.value)
         eqn_path = lambda x: os.path.join(self.__img_dir,
                 'eqn%03d.%s' % (x, file_ext))
-        abs_eqn_path = lambda x: os.path.join(self.__img_dir, eqn_path(x))
-
-        # is (formula, display_math) already in the list of formulas to convert;
-        # displaymath is important since formulas look different in inline maths
-        formula_was_converted = lambda f, dsp: (normalize_formula(f), dsp) in \
-                ((normalize_formula(u[0]), u[3]) for u in formulas_to_convert)
-        # find enough free file names
+        converter = self.__create_converter(image.Tex2img, profile)
+        # formulas cached without these variants are converted again
+        variants = list(converter.get_variants(eqn_path(0)))
+        # file names may also be reserved by a concurrently running conversion
+        is_free = lambda x: os.path.splitext(eqn_path(x))[0] not in \
+                self.__reserved_paths and not any(os.path.exists(
+                    os.path.join(self.__output_path, path)) for path
+                    in [eqn_path(x)] + list(converter.get_variants(
+                        eqn_path(x)).values()))
+        # jobs by (formula, display_math); displaymath is important since
+        # formulas look different in inline maths
+        jobs = {}
         file_name_count = 0
-        used_file_names = [] # track which file names have been assigned
         for formula_count, (pos, dsp, formula) in enumerate(formulas):
-            # ToDo: this belongs in the cache
-            if not self.__cache.contains(formula, dsp) and \
-                    not formula_was_converted(formula, dsp):
-                while os.path.exists(abs_eqn_path(file_name_count)) or \
-                    eqn_path(file_name_count) in used_file_names:
-                    file_name_count += 1
-                used_file_names.append(eqn_path(file_name_count))
-                formulas_to_convert.append((formula, pos, eqn_path(file_name_count),
-                    dsp, formula_count + 1))
-        return formulas_to_convert
-
-
-    def _convert_concurrently(self, formulas_to_convert):
+            key = (normalize_formula(formula), dsp)
+            job, new, cached = jobs.get(key), False, None
+            if not job:
+                with self.__lock:
+                    # ToDo: this belongs in the cache
+                    if cache.contains(formula, dsp, variants):
+                        self.__notify(progress.CACHE_HIT, formula_count,
+                                formula, dsp)
+                        cached = cache.get_data_for(formula, dsp)['path']
+                    else:
+                        if cache.contains(formula, dsp):
+                            cache.remove_formula(formula, dsp)
+                        # find a free file name for the image and its variants
+                        while not is_free(file_name_count):
+                            file_name_count += 1
+                        job = (formula, pos, eqn_path(file_name_count), dsp,
+                                formula_count + 1)
+                        self.__reserved_paths.add(os.path.splitext(job[2])[0])
+                        jobs[key] = job
+                        new = True
+            if cached and self.__optimizer:
+                # cached before precompression was enabled
+                self.__optimizer.precompress(os.path.join(self.__output_path,
+                    cached))
+            yield (formula_count, (pos, dsp, formula), job, new)
+
+    def set_workers(self, latex_workers=None, image_workers=None):
+        """Set the number of worker threads running LaTeX and the number of
+        worker threads converting the DVI files to images. Both default to a
+        value derived from the number of CPUs, with slightly more image workers,
+        since dvisvgm and dvipng are usually slower than LaTeX."""
+        for count in (latex_workers, image_workers):
+            if count is not None and (not isinstance(count, int) or count < 1):
+                raise ValueError("number of workers must be a positive integer")
+        self.__workers = (latex_workers, image_workers)
+
+    def __convert(self, formulas_to_convert, profile):
+        """Convert the given formulas (see _get_formulas_to_convert) and
+        release their file names afterwards, see _convert_concurrently."""
+        try:
+            yield from self._convert_concurrently(formulas_to_convert, profile)
+        finally:
+            self.__release_paths(formulas_to_convert)
+
+    def _convert_concurrently(self, formulas_to_convert, profile=None):
         """The actual concurrent conversion process. Method is intended to be
-        called from convert_all()."""
+        called from convert_all() or convert_iter(). This is a generator,
+        yielding (job, error) as soon as a formula was converted or failed,
+        where job is an element of formulas_to_convert and error is a
+        ConversionException or None. After all formulas have been processed,
+        the ConversionException of the first failed formula (or a
+        MultipleConversionException) is raised.
+        `formulas_to_convert` is either a list or an iterator of jobs. The
+        latter is consumed by a separate thread, which queues each job as soon
+        as it is retrieved."""
+        profile = (profile if profile else self.__profile)
+        cache = self.__get_cache(profile)
+        converter = self.__create_converter(image.Tex2img, profile)
+        self.__make_image_directory()
+        cpus = multiprocessing.cpu_count()
+        latex_workers = (self.__workers[0] if self.__workers[0] else cpus)
+        image_workers = (self.__workers[1] if self.__workers[1]
+                else max(1, int(cpus * 1.5)))
+        # start the most expensive formulas first, so that these do not
+        # determine the overall run time when started last
+        model = self.get_cost_model(profile)
+        # LaTeX and the image conversion run in separate thread pools; each job
+        # is (formula, pos, path, displaymath, formula_count)
+        # on errors or interrupts, running LaTeX and image conversion processes
+        # are terminated immediately
+        scratch = self.__make_scratch_directory(converter, profile)
+        try:
+            with pipeline.RenderPipeline(
+                    functools.partial(self.__create_dvi, converter, profile,
+                        scratch),
+                    functools.partial(self.__create_image, converter,
+                        scratch),
+                    latex_workers, image_workers,
+                    discard=lambda _job, dvi: image.remove_all(dvi[0]),
+                    on_cancel=converter.terminate) as pipe:
+                estimate = lambda job: model.estimate(job[0], job[3])
+                submit = lambda job: (self.__notify_job(progress.QUEUED, job),
+                        pipe.submit(job, estimate(job)))
+                if isinstance(formulas_to_convert, list):
+                    # workers pick up jobs while these are submitted, hence sort
+                    # first
+                    for job in sorted(formulas_to_convert, key=estimate,
+                            reverse=True):
+                        submit(job)
+                    pipe.close()
+                else: # jobs are queued in order of their costs as they arrive
+                    threading.Thread(target=self.__submit_all, args=(pipe,
+                        formulas_to_convert, submit), daemon=True).start()
+                errors = []
+                for job, data, error in pipe.results():
+                    if isinstance(error, image.ProcessCancelled):
+                        continue # aborted because of another error
+                    if isinstance(error, subprocess.SubprocessError):
+                        if not self.__keep_going:
+                            pipe.cancel() # do not start any other job
+                            if errors:
+                                continue
+                        self.__notify_job(progress.FAILED, job)
+                        with self.__lock: # write back cache with valid entries
+                            cache.write()
+                        errors.append(self.__conversion_exception(error, job))
+                        yield (job, errors[-1])
+                    elif error:
+                        raise error
+                    else:
+                        with self.__lock:
+                            cache.add_formula(job[0], data['pos'], data['path'],
+                                    data['displaymath'], data['time'],
+                                    data['variants'])
+                            cache.write()
+                        self.__notify_job(progress.IMAGE_DONE, job)
+                        yield (job, None)
+                if errors and self.__keep_going:
+                    raise MultipleConversionException(errors)
+                if errors:
+                    raise errors[0]
+        finally:
+            if scratch:
+                shutil.rmtree(scratch, ignore_errors=True)
+
+    @staticmethod
+    def __submit_all(pipe, jobs, submit):
+        """Submit all jobs of the given iterator and close the pipeline, see
+        _convert_concurrently."""
+        try:
+            for job in jobs:
+                if pipe.is_cancelled():
+                    break
+                submit(job)
+        finally:
+            pipe.close()
+
+    def __make_image_directory(self):
+        """Create the image directory *before* it is required in the concurrent
+        formula creation step."""
         imgdir_full = os.path.join(self.__output_path, self.__img_dir)
         if imgdir_full and not os.path.exists(imgdir_full):
-            # create directory *before* it is required in the concurrent
-            # formulacreation step
             os.makedirs(imgdir_full)
 
-        thread_count = int(multiprocessing.cpu_count() * 2.5)
-        # convert missing formulas
-        with concurrent.futures.ThreadPoolExecutor(max_workers=thread_count) as executor:
-            # start conversion and mark each thread with its formula, position
-            # in the source file and formula_count (index into a global list of
-            # formulas)
-            jobs = {executor.submit(self.__convert, eqn, path, dsp): (eqn, pos, count)
-                for (eqn, pos, path, dsp, count) in formulas_to_convert}
-            error_occurred = None
-            for future in concurrent.futures.as_completed(jobs):
-                if error_occurred and not future.done():
-                    future.cancel()
-                    continue
-                formula, pos_in_src, formula_count = jobs[future]
-                try:
-                    data = future.result()
-                except subprocess.SubprocessError as e:
-                    # retrieve the position (line, pos on line) in the source
-                    # document from original formula list
-                    if pos_in_src: # missing for the pandocfilter case
-                        pos_in_src = list(p+1 for p in pos_in_src) # user expects lines/pos_in_src' to count from 1
-                    self.__cache.write() # write back cache with valid entries
-                    if not pos_in_src: # pandocfilter case:
-                        error_occurred = ConversionException(str(e.args[0]),
-                                formula, formula_count)
-                    else:
-                        error_occurred = ConversionException(str(e.args[0]), formula,
-                            formula_count, pos_in_src[0], pos_in_src[1])
-                else:
-                    self.__cache.add_formula(formula, data['pos'],
-                            data['path'],
-                            data['displaymath'])
-                    self.__cache.write()
-            #pylint: disable=raising-bad-type
-            if error_occurred:
-                raise error_occurred
-
-
-
-    def __convert(self, formula, img_path, displaymath=False):
-        """convert(formula, img_path, displaymath=False)
-        Convert given formula with displaymath/inlinemath.
-        This method wraps the formula in a tex document, executes all the steps
-        to produce a image and return the positioning information for the
-        HTML output. It does not check the cache.
-        :param formula formula to convert
-        :param img_path image output path (relative to the configured base_path,
-                    see __init__)
-        :param displaymath whether or not to use displaymath during the conversion
-        :return dictionary with position (pos), image path (path) and formula
-            style (displaymath, boolean) as a dictionary with the keys in
-            parenthesis"""
+    def __make_scratch_directory(self, converter, profile):
+        """Create a private scratch directory for the intermediate files of a
+        conversion and configure the image converter to use pipes instead of
+        files (see set_scratch_directory). Return its path or None if
+        intermediate files are kept next to the images. The caller removes
+        the directory."""
+        if self.__scratch is None or profile.keep_latex_source:
+            return None
+        directory = (self.__scratch if self.__scratch
+                else default_scratch_directory())
+        remove_stale_scratch_directories(directory)
+        converter.set_pipes(True)
+        # files included by the preamble are relative to the image directory,
+        # in which LaTeX runs otherwise
+        converter.set_search_path(os.path.abspath(os.path.join(
+            self.__output_path, self.__img_dir)))
+        # named after the process, see remove_stale_scratch_directories
+        return tempfile.mkdtemp(prefix='gladtex-%d-' % os.getpid(),
+                dir=directory)
+
+    @staticmethod
+    def __get_worker_directory(scratch):
+        """Return the scratch directory of the calling worker thread within
+        the scratch directory of a conversion. It is created on first use and
+        reused for all formulas typeset by this worker."""
+        path = os.path.join(scratch, 'worker-%d' % threading.get_ident())
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def __release_paths(self, formulas_to_convert):
+        """Release the image file names reserved by _get_formulas_to_convert,
+        once the conversion of these formulas has finished."""
+        with self.__lock:
+            for job in formulas_to_convert:
+                self.__reserved_paths.discard(os.path.splitext(job[2])[0])
+
+    def __conversion_exception(self, error, job):
+        """Create a ConversionException from the SubprocessError of the given
+        job, see _convert_concurrently."""
+        formula, pos_in_src, _path, _dsp, formula_count = job
+        # retrieve the position (line, pos on line) in the source
+        # document from original formula list
+        if not pos_in_src: # pandocfilter case:
+            return ConversionException(str(error.args[0]), formula,
+                    formula_count)
+        # user expects lines/pos_in_src' to count from 1
+        pos_in_src = list(p+1 for p in pos_in_src)
+        return ConversionException(str(error.args[0]), formula, formula_count,
+                pos_in_src[0], pos_in_src[1])
+
+    def __create_latex_document(self, formula, displaymath, profile):
+        """Wrap the given formula in a LaTeX document, configured with the
+        options of this converter and the given profile."""
         latex = typesetting.LaTeXDocument(formula)
         latex.set_displaymath(displaymath)
         def set(opt, setter):
-            if self.__options[opt]:
-                getattr(latex, 'set_' + setter)(self.__options[opt])
+            if getattr(profile, opt):
+                getattr(latex, 'set_' + setter)(getattr(profile, opt))
         set('preamble', 'preamble_string')
         set('latex_maths_env', 'latex_environment')
         set('background_color', 'background_color')
@@ -228,20 +753,139 @@ class CachedConverter:
             latex.set_encoding(self.__encoding)
         if self.__replace_nonascii:
             latex.set_replace_nonascii(True)
-        # dvipng needs the additionalindication of transparency (enabled by
-        # default) when setting a background colour
-        if self.__options['background_color']:
-            self.__converter.set_transparency(False)
-        pos = self.__converter.convert(latex,
-                os.path.join(self.__output_path, os.path.splitext(img_path)[0]))
+        return latex
+
+    def __get_dvi_path(self, img_path, scratch=None):
+        """Return the path of the DVI file of the given image: next to the
+        image or in the scratch directory, if given."""
+        if scratch:
+            return os.path.join(scratch, os.path.splitext(
+                os.path.basename(img_path))[0] + '.dvi')
+        return os.path.join(self.__output_path,
+                os.path.splitext(img_path)[0]) + '.dvi'
+
+    def __create_dvi(self, converter, profile, scratch, job):
+        """First stage of the conversion: typeset the formula of the given job
+        (see _convert_concurrently) into a DVI file, using the given image
+        converter and profile. The DVI file is written to the scratch
+        directory of the worker, if a scratch directory is given. Return its
+        file name and the time it took."""
+        formula, _pos, img_path, displaymath, _count = job
+        start = time.monotonic()
+        dvi = self.__get_dvi_path(img_path, (self.__get_worker_directory(
+            scratch) if scratch else None))
+        self.__notify_job(progress.LATEX_START, job)
+        converter.create_dvi(self.__create_latex_document(formula,
+                displaymath, profile), dvi)
+        self.__notify_job(progress.LATEX_DONE, job)
+        return (dvi, time.monotonic() - start)
+
+    def __get_image_paths(self, converter, img_path, dvi, scratch):
+        """Return a list of (path, destination) for the image of a job and its
+        variants: images are created next to their DVI file in the scratch
+        directory, if given, and moved to their destination afterwards (see
+        __publish_images). Otherwise, both paths are the same."""
+        target = os.path.join(self.__output_path, img_path)
+        path = (os.path.join(os.path.dirname(dvi), os.path.basename(img_path))
+                if scratch else target)
+        return list(zip([path] + list(converter.get_variants(path).values()),
+                [target] + list(converter.get_variants(target).values())))
+
+    @staticmethod
+    def __publish_images(paths):
+        """Move images created in a scratch directory to their destination,
+        along with their compressed copies, if any (see
+        optimize.ImageOptimizer.set_precompress_svg)."""
+        for path, target in paths:
+            if path == target:
+                continue
+            if os.path.exists(path + '.gz'):
+                image.move_file(path + '.gz', target + '.gz')
+            image.move_file(path, target)
+
+    def __create_image(self, converter, scratch, job, dvi):
+        """Second stage of the conversion: convert the DVI file of the given
+        job into an image. Return a dictionary with position (pos), image path
+        (path), formula style (displaymath, boolean), the paths of the variants
+        of the image (variants, see image.Tex2img.get_variants) and the total
+        render time (time)."""
+        _formula, _pos, img_path, displaymath, _count = job
+        dvi, latex_time = dvi
+        start = time.monotonic()
+        variants = converter.get_variants(img_path)
+        paths = self.__get_image_paths(converter, img_path, dvi, scratch)
+        try:
+            pos = converter.create_image(dvi, paths[0][0])
+            if self.__optimizer:
+                for path, _target in paths:
+                    self.__optimizer.optimize(path)
+            self.__publish_images(paths)
+        except OSError:
+            image.remove_all(*(path for pair in paths for path in pair))
+            raise
         return {'pos': pos,
                 'path': img_path, # relative to self.__base_name(!)
-                'displaymath': displaymath}
+                'displaymath': displaymath,
+                'variants': variants,
+                'time': round(latex_time + time.monotonic() - start, 3)}
+
+    def get_cost_model(self, profile=None):
+        """Return a cost.CostModel, trained with the render times of the
+        formulas in the cache of this converter (for the given profile). It
+        estimates how long it takes to render a formula."""
+        profile = (profile if profile else self.__profile)
+        return cost.CostModel.from_cache(self.__get_cache(profile),
+                profile.latex_maths_env)
+
+    def contains(self, formula, display_math, profile=None):
+        """Return whether an image of the given formula is in the cache."""
+        return self.__get_cache(profile).contains(formula, display_math)
+
+    def import_formula(self, converter, formula, display_math, profile=None):
+        """Copy the image of a formula from the cache of another
+        CachedConverter, which is configured with the same options, into the
+        image directory of this converter and add it to the cache. This avoids
+        converting a formula again which is used in documents written to
+        different directories. Raises KeyError if the other converter does not
+        know the formula."""
+        profile = (profile if profile else self.__profile)
+        data = converter.get_data_for(formula, display_math, profile)
+        source = os.path.join(converter.__output_path, data['path'])
+        self.__make_image_directory()
+        jobs = self._get_formulas_to_convert([(None, display_math, formula)],
+                profile)
+        try:
+            for job in jobs: # empty if the formula is cached already
+                destination = os.path.join(self.__output_path, job[2])
+                shutil.copyfile(source, destination)
+                if os.path.exists(source + '.gz'):
+                    shutil.copyfile(source + '.gz', destination + '.gz')
+                if self.__optimizer:
+                    self.__optimizer.precompress(destination)
+                # variants are named after their image, e.g. eqn000@2x.png
+                root = (os.path.splitext(data['path'])[0],
+                        os.path.splitext(job[2])[0])
+                variants = {name: root[1] + path[len(root[0]):]
+                        for name, path in data.get('variants', {}).items()}
+                for name, path in variants.items():
+                    shutil.copyfile(os.path.join(converter.__output_path,
+                        data['variants'][name]), os.path.join(
+                            self.__output_path, path))
+                with self.__lock:
+                    cache = self.__get_cache(profile)
+                    cache.add_formula(formula, data['pos'], job[2],
+                            display_math, data.get('time'), variants)
+                    cache.write()
+        finally:
+            self.__release_paths(jobs)
 
-    def get_data_for(self, formula, display_math):
+    def get_data_for(self, formula, display_math, profile=None):
         """Simple wrapper around ImageCache, enriching the returned data with
         the information provided as arguments to this function. This helps when
-        using a formula without its context."""
-        data = self.__cache.get_data_for(formula, display_math).copy()
+        using a formula without its context. `profile` selects the cache of a
+        Profile other than the one configured with set_option."""
+        with self.__lock:
+            data = self.__get_cache(profile).get_data_for(formula,
+                    display_math).copy()
         data.update({'formula': formula, 'displaymath': display_math})
         return data
@@ -16,7 +16,11 @@ Cache format:
                         'path': 'some/path'
                         'pos': { # positioning within the HTML document
                             'height': ..., 'width':..., 'depth:....
-                        }
+                        },
+                        'time': 1.2, # optional, seconds taken to render
+                        # optional, further files rendered from the formula,
+                        # by name, e.g. high-resolution images
+                        'variants': {'2x': 'some/path@2x'}
                     }
                     }
             }
@@ -174,12 +178,20 @@ class ImageCache:
             if os.path.isfile(file):
                 os.remove(file)
 
-    def add_formula(self, formula, pos, file_path, displaymath=False):
+    #pylint: disable=too-many-arguments
+    def add_formula(self, formula, pos, file_path, displaymath=False,
+            render_time=None, variants=None):
         """Add formula to cache. The pos argument contains the positioning
         info for the output document and is a dict with 'height', 'width' and
         'depth'.
         Keep in mind that formulas set with displaymath are not the same as
         those set iwth inlinemath.
+        The optional render_time (in seconds) is remembered to estimate the
+        conversion costs of future formulas, see gleetex.cost.
+        The optional variants are a dictionary mapping names to the paths of
+        further images rendered from the formula, e.g. images with a higher
+        resolution (see image.Tex2img.get_variants). These paths are relative
+        like file_path.
         This method raises OSError if specified image doesn't exist or if it got
         an absolute file_path.
         """
@@ -203,6 +215,19 @@ class ImageCache:
             val[displaymath] = {'pos': pos,
                     'path': file_path,
                 }
+            if render_time is not None:
+                val[displaymath]['time'] = render_time
+            if variants:
+                val[displaymath]['variants'] = {name: path.replace('\\', '/')
+                        for name, path in variants.items()}
+
+    def get_render_times(self):
+        """Return a list of (formula, displaymath, seconds) for all cached
+        formulas for which the render time is known."""
+        return [(formula, displaymath, data['time'])
+                for formula, variants in self.__cache.items()
+                if formula != ImageCache.VERSION_STR
+                for displaymath, data in variants.items() if 'time' in data]
 
     def remove_formula(self, formula, displaymath):
         """This method removes the given formula from the cache. A KeyError is
@@ -214,21 +239,29 @@ class ImageCache:
         else:
             value = self.__cache[formula]
             if displaymath in value:
-                with contextlib.suppress(FileNotFoundError):
-                    os.remove(os.path.join(self.__base_path, value[displaymath]['path']))
+                paths = [value[displaymath]['path']] + list(
+                        value[displaymath].get('variants', {}).values())
+                for path in paths:
+                    path = os.path.join(self.__base_path, path)
+                    # precompressed copies are removed with their image
+                    for file_path in (path, path + '.gz'):
+                        with contextlib.suppress(FileNotFoundError):
+                            os.remove(file_path)
                 del self.__cache[formula][displaymath]
                 if not self.__cache[formula]:
                     del self.__cache[formula]
             else:
                 raise KeyError("key %s (%s) not in cache" % (formula, displaymath))
 
-    def contains(self, formula, displaymath):
+    def contains(self, formula, displaymath, variants=()):
         """Check whether a formula was already cached and return True if
-        found."""
+        found. If the names of variants are given, these need to have been
+        cached as well, see add_formula."""
         try:
-            return bool(self.get_data_for(formula, displaymath))
+            data = self.get_data_for(formula, displaymath)
         except KeyError:
             return False
+        return all(name in data.get('variants', {}) for name in variants)
 
 
     def get_data_for(self, formula, displaymath):
@@ -236,8 +269,10 @@ class ImageCache:
         Retrieve meta data about a formula from the cache.
 
         The meta information is used to embed the formula in the HTML document.
-        It is a dictionary with the keys 'pos' and 'path'. The positioning info
-        is described in the documentation of this class.
+        It is a dictionary with the keys 'pos' and 'path' and optionally
+        'time' and 'variants', as described in the documentation of this
+        module. If the image or one of its variants does not exist anymore,
+        the formula is removed from the cache.
         This method raises a KeyError if the formula wasn't found."""
         formula = normalize_formula(formula)
         if not formula in self.__cache:
@@ -246,10 +281,11 @@ class ImageCache:
             # check whether file still exists
             value = self.__cache[formula]
             if displaymath in value.keys():
-                # if file doesn't exist anymore, outdated and hence removed from
-                # cache
-                if not os.path.exists(os.path.join(self.__base_path,
-                        value[displaymath]['path'])):
+                # if a file doesn't exist anymore, outdated and hence removed
+                # from cache
+                if not all(os.path.exists(os.path.join(self.__base_path, path))
+                        for path in [value[displaymath]['path']] + list(
+                            value[displaymath].get('variants', {}).values())):
                     del self.__cache[formula]
                     raise KeyError((formula, displaymath))
                 else:
@@ -0,0 +1,103 @@
+# (c) 2013-2019 Sebastian Humenda
+# This code is licenced under the terms of the LGPL-3+, see the file COPYING for
+# more details.
+"""Estimate how long it takes to render a formula.
+
+Formulas are converted concurrently. If a long-running formula, e.g. a large
+`align*` block, is started last, all other workers are idle while it is
+rendered. Starting the most expensive formulas first shortens the overall
+conversion time.
+
+The estimate is based on the length of a formula, the environments it uses and
+the render times of previously converted formulas, as remembered by the
+ImageCache. The estimator is independent of the converter and can be used by
+other tools:
+
+    model = CostModel.from_cache(ImageCache('img/gladtex.cache'))
+    seconds = model.estimate(r'\\begin{align*} ... \\end{align*}', True)
+"""
+
+import re
+
+from .caching import normalize_formula
+
+# factors by which an environment makes a formula more expensive than its length
+# alone suggests; starred variants are treated as the unstarred ones
+ENVIRONMENT_FACTORS = {'align': 2.0, 'alignat': 2.0, 'flalign': 2.0,
+        'eqnarray': 2.0, 'gather': 1.5, 'multline': 1.5, 'split': 1.5,
+        'array': 1.5, 'matrix': 1.5, 'pmatrix': 1.5, 'bmatrix': 1.5,
+        'vmatrix': 1.5, 'Vmatrix': 1.5, 'cases': 1.3, 'tikzpicture': 5.0,
+        'xy': 4.0}
+# additional cost of a line break, in characters
+LINE_BREAK_COST = 20
+# factor for formulas set as displaymath
+DISPLAYMATH_FACTOR = 1.2
+# minimum number of known render times before they are used
+MIN_SAMPLES = 5
+# default parameters of the linear model (seconds, seconds per unit)
+DEFAULT_BASE = 0.5
+DEFAULT_PER_UNIT = 0.002
+
+ENVIRONMENT_PATTERN = re.compile(r'\\begin\s*\{\s*([a-zA-Z]+)\*?\s*\}')
+
+def complexity(formula, displaymath=False, environment=None):
+    """Return a unit-less complexity measure of the formula. It grows linearly
+    with the length of the formula and is weighted by the used environments
+    and the display style. `environment` is the maths environment the formula
+    is wrapped in, if any (see LaTeXDocument.set_latex_environment)."""
+    formula = normalize_formula(formula)
+    environments = ENVIRONMENT_PATTERN.findall(formula)
+    if environment:
+        environments.append(environment.rstrip('*'))
+    factor = max([ENVIRONMENT_FACTORS.get(env, 1.0) for env in environments]
+            + [1.0])
+    units = len(formula) * factor + formula.count('\\\\') * LINE_BREAK_COST
+    return units * (DISPLAYMATH_FACTOR if displaymath else 1.0)
+
+class CostModel:
+    """Predict the render time of a formula in seconds. The prediction is a
+    linear function of the complexity of a formula (see `complexity()`). Its
+    parameters are fitted to known render times, if enough are available, and
+    fall back to conservative defaults otherwise.
+    `environment` is the maths environment all formulas are wrapped in, if any
+    (see `complexity()`); it applies to the samples and the estimates alike."""
+    def __init__(self, samples=None, environment=None):
+        self.__base = DEFAULT_BASE
+        self.__per_unit = DEFAULT_PER_UNIT
+        self.__environment = environment
+        if samples:
+            self.fit(samples)
+
+    @staticmethod
+    def from_cache(cache, environment=None):
+        """Create a model from the render times known to an ImageCache, for
+        formulas wrapped in the given maths environment."""
+        return CostModel(cache.get_render_times(), environment)
+
+    def fit(self, samples):
+        """Fit the model to a list of (formula, displaymath, seconds). The
+        model is left unchanged if less than MIN_SAMPLES samples are given or
+        if the samples do not differ in complexity."""
+        points = [(complexity(formula, displaymath, self.__environment),
+                    seconds)
+                for formula, displaymath, seconds in samples]
+        if len(points) < MIN_SAMPLES:
+            return
+        mean_x = sum(x for x, _ in points) / len(points)
+        mean_y = sum(y for _, y in points) / len(points)
+        variance = sum((x - mean_x) ** 2 for x, _ in points)
+        if not variance:
+            return
+        per_unit = sum((x - mean_x) * (y - mean_y) for x, y in points) / variance
+        # a longer formula is never cheaper, rendering never takes no time
+        self.__per_unit = max(per_unit, 0.0)
+        self.__base = max(mean_y - self.__per_unit * mean_x, 0.0)
+
+    def get_parameters(self):
+        """Return (base cost in seconds, seconds per complexity unit)."""
+        return (self.__base, self.__per_unit)
+
+    def estimate(self, formula, displaymath=False):
+        """Return the estimated render time of a formula in seconds."""
+        return self.__base + self.__per_unit * complexity(formula, displaymath,
+                self.__environment)
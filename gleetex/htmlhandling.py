@@ -16,12 +16,32 @@ import os
 import posixpath
 import re
 import base64
+import bisect
+import codecs
 
 from . import typesetting
 
 # match HTML 4 and 5
 CHARSET_PATTERN = re.compile(
         rb'(?:content="text/html; charset=(.*?)"|charset="(.*?)")')
+# number of bytes searched again for a charset declaration crossing the
+# boundary of two blocks of a stream
+CHARSET_OVERLAP = 256
+
+# root element of an SVG document: (attributes, content)
+SVG_ROOT = re.compile(r'<svg\b([^>]*)>(.*)</svg>', re.DOTALL)
+# identifiers and references to identifiers within an SVG document, up to the
+# identifier itself
+SVG_ID = re.compile(r"""(\sid=['"])""")
+SVG_REFERENCE = re.compile(r"""(href=['"]#|url\(#)""")
+# references to identifiers: (start of the reference, identifier)
+SVG_REFERENCE_ID = re.compile(r"""(href=['"]#|url\(#)([^'")]+)""")
+# glyph outline as written by dvisvgm --no-fonts: (quote, identifier, quote,
+# path data)
+SVG_GLYPH = re.compile(r"""<path id=(['"])([^'"]+)\1 d=(['"])([^'"]*)\3\s*/>""")
+SVG_EMPTY_DEFS = re.compile(r'<defs>\s*</defs>\s*')
+# name of an image variant with a higher pixel density, see image.density_name
+DENSITY_VARIANT = re.compile(r'^\d+(?:\.\d+)?x$')
 
 class ParseException(Exception):
     """Exception to propagate a parsing error."""
@@ -36,14 +56,43 @@ class ParseException(Exception):
 
 def get_position(document, index):
     """This returns the line number and position on line for the given String.
-    Note: lines and positions are counted from 0."""
-    line = document[:index+1].count('\n')
-    if document[index] == '\n':
-        return (line, 0)
-    newline = document[:index+1].rfind('\n')
-    newline = (newline if newline >= 0 else 0)
-    return (line, len(document[newline:index]))
-
+    Note: lines and positions are counted from 0.
+    Use a LineIndex to look up several positions in the same document."""
+    return LineIndex(document).get_position(index)
+
+class LineIndex:
+    """Index of the line breaks of a document, built once, to look up the line
+    and position on line of an offset in logarithmic time, see get_position.
+
+    lines = LineIndex(document)
+    line, pos = lines.get_position(index)"""
+    def __init__(self, document):
+        self.__newlines = []
+        newline = document.find('\n')
+        while newline >= 0:
+            self.__newlines.append(newline)
+            newline = document.find('\n', newline + 1)
+
+    def get_position(self, index):
+        """Return (line number, position on line) of the given offset, both
+        counted from 0, see get_position."""
+        # number of line breaks up to and including index
+        line = bisect.bisect_right(self.__newlines, index)
+        if line and self.__newlines[line - 1] == index:
+            return (line, 0)
+        return (line, index - (self.__newlines[line - 1] if line else 0))
+
+
+def is_ascii_compatible(encoding):
+    """Return whether a document in the given encoding can be searched for
+    ASCII markup without decoding it. This is the case for all single-byte
+    encodings and for UTF-8, but not for UTF-16 or stateful encodings."""
+    try:
+        name = codecs.lookup(encoding).name
+    except LookupError:
+        return False
+    return (not name.startswith(('utf-16', 'utf-32', 'utf-7', 'iso2022', 'hz'))
+            and '<eq>\n'.encode(name) == b'<eq>\n')
 
 def find_anycase(where, what):
     """Find with both lower or upper case."""
@@ -61,13 +110,33 @@ class EqnParser:
     a rare use case."""
     class State(enum.Enum): # ([\s\S]*?) also matches newlines
         Comment = re.compile(r'<!--([\s\S]*?)-->', re.MULTILINE)
-        Equation = re.compile(r'<\s*(?:eq|EQ)\s*(.*?)?>([\s\S.]+?)<\s*/\s*(?:eq|EQ)>',
-                re.MULTILINE)
+        Equation = re.compile(r'<\s*eq\s*(.*?)?>([\s\S.]+?)<\s*/\s*eq>',
+                re.MULTILINE | re.IGNORECASE)
 
+    # start of a comment or of an equation, whatever comes first
+    TOKEN = re.compile(r'<!--|<\s*eq\s*.*?>', re.IGNORECASE)
     HTML_ENTITY = re.compile(r'(&(:?#\d+|[a-zA-Z]+);)')
 
+    # size of the blocks read by feed_stream
+    BLOCK_SIZE = 65536
+
+    # patterns for documents parsed without decoding them, see feed_buffer
+    BYTE_TOKEN = re.compile(rb'<!--|<\s*eq\s*.*?>', re.IGNORECASE)
+    BYTE_COMMENT = re.compile(rb'<!--([\s\S]*?)-->', re.MULTILINE)
+    BYTE_EQUATION = re.compile(rb'<\s*eq\s*(.*?)?>([\s\S.]+?)<\s*/\s*eq>',
+            re.MULTILINE | re.IGNORECASE)
+    HEAD_END = re.compile(rb'<\s*/\s*head\s*>', re.IGNORECASE)
+
     def __init__(self):
         self.__document = None
+        self.__lines = None # LineIndex of the document
+        # when parsing a stream, self.__document is a window of the document;
+        # (offset of the window, number of line breaks before it, offset of
+        # the last line break before it or None)
+        self.__window = (0, 0, None)
+        # position of the last formula parsed by feed_buffer: (offset, number
+        # of line breaks before it, characters since the last line break)
+        self.__byte_position = (0, 0, 0)
         self.__data = []
         self.__encoding = None
 
@@ -75,105 +144,281 @@ class EqnParser:
         """Feed a string or a bytes instance and start parsing. If a bytes
         instance is fed, an HTML encoding header has to be present, so that the
         encoding can be extracted."""
+        self.__data.extend(self.feed_iter(document))
+
+    def feed_iter(self, document):
+        """Like feed, but return a generator yielding the parsed chunks as soon
+        as these are found, e.g. to start converting the first formulas while
+        the rest of the document is parsed. The chunks are not collected, i.e.
+        get_data is not affected. The encoding is determined right away."""
+        self.__decode(document)
+        return (chunk for chunk in self._parse() if chunk) # filter empty bits
+
+    def feed_stream(self, stream, block_size=None):
+        """Parse a file object (opened in text or binary mode) block by block
+        and return a generator yielding the parsed chunks, like feed_iter.
+        Only the current block and the formula or comment being parsed are
+        kept in memory, so arbitrarily large documents can be parsed with
+        constant memory. If the stream is opened in binary mode, it is read
+        until the charset declaration of the HTML document is found, usually
+        within the first block."""
+        block_size = (block_size if block_size else EqnParser.BLOCK_SIZE)
+        first = stream.read(block_size)
+        if isinstance(first, bytes):
+            first = self.__read_charset(first, stream, block_size)
+            self.__encoding = self.__guess_encoding(first)
+            decoder = codecs.getincrementaldecoder(self.__encoding)()
+            first = decoder.decode(first)
+            def read():
+                # a block may end within a character and decode to nothing
+                raw = stream.read(block_size)
+                return (decoder.decode(raw, final=not raw), not raw)
+        else:
+            def read():
+                block = stream.read(block_size)
+                return (block, not block)
+        return (chunk for chunk in self._parse_stream(first, read)
+                if chunk) # filter empty bits
+
+    def feed_buffer(self, buffer):
+        """Parse a bytes-like object, e.g. a memory-mapped file (mmap.mmap),
+        without decoding it as a whole and return a generator yielding the
+        parsed chunks, like feed_iter. The charset is only searched for in the
+        HTML header. Only formulas are decoded, raw HTML chunks and comments
+        are memoryview slices of the buffer, to be written back unaltered (see
+        write_html). Documents in an encoding which is not a superset of ASCII
+        are decoded and parsed as a whole."""
+        head = EqnParser.HEAD_END.search(buffer)
+        self.__encoding = self.__guess_encoding(buffer[:head.end()] if head
+                else buffer)
+        if not is_ascii_compatible(self.__encoding):
+            return self.feed_iter(bytes(buffer))
+        return (chunk for chunk in self._parse_buffer(buffer)
+                if chunk) # filter empty bits
+
+    def _parse_buffer(self, buffer):
+        """Parse an undecoded document, see feed_buffer and _parse."""
+        view = memoryview(buffer)
+        self.__byte_position = (0, 0, 0)
+        start_pos = 0
+        while start_pos < len(buffer):
+            token = EqnParser.BYTE_TOKEN.search(buffer, start_pos)
+            if not token: # only data left
+                yield view[start_pos:]
+                break
+            yield view[start_pos:token.start()]
+            if token.group() == b'<!--':
+                match = EqnParser.BYTE_COMMENT.search(buffer, token.start())
+                if not match:
+                    raise ParseException("Improperly formatted comment found",
+                            self.__get_byte_position(buffer, token.start()))
+                chunk, start_pos = view[token.start():match.end()], match.end()
+            else:
+                chunk, start_pos = self.__handle_byte_equation(buffer,
+                        token.start())
+            yield chunk
+
+    def __handle_byte_equation(self, buffer, start_pos):
+        """Parse an equation of an undecoded document, see handle_equation."""
+        lnum, pos = self.__get_byte_position(buffer, start_pos)
+        match = EqnParser.BYTE_EQUATION.search(buffer, start_pos)
+        if not match:
+            rest = buffer[start_pos:]
+            next_eq = find_anycase(rest[1:], b'<eq')
+            closing = find_anycase(rest, b'</eq>')
+            if -1 < next_eq < closing and closing > -1:
+                raise ParseException("Unclosed tag found", (lnum, pos))
+            raise ParseException("Malformed equation tag found", (lnum, pos))
+        attrs, formula = (group.decode(self.__encoding)
+                for group in match.groups(b''))
+        return (self.__make_formula((lnum, pos), attrs, formula), match.end())
+
+    def __get_byte_position(self, buffer, index):
+        """Return (line number, position on line) of an offset of an undecoded
+        document, see get_position. The position on the line is counted in
+        characters. Offsets have to be passed in ascending order."""
+        offset, lines, chars = self.__byte_position
+        passed = buffer[offset:index]
+        newline = passed.rfind(b'\n')
+        if newline >= 0:
+            lines += passed.count(b'\n')
+            chars = len(passed[newline:].decode(self.__encoding, 'replace'))
+        else:
+            chars += len(passed.decode(self.__encoding, 'replace'))
+        self.__byte_position = (index, lines, chars)
+        return (lines, chars)
+
+    def _parse_stream(self, data, read):
+        """Parse a document which is read in blocks, see feed_stream. `data`
+        is the first block, read() returns a tuple of the next one and whether
+        the end of the document was reached. The parsed part of the document
+        is dropped whenever a block is read."""
+        self.__set_window(data, 0, 0, None)
+        pos = 0 # parse position within the window
+        eof = False
+        while True:
+            document = self.__document
+            token = EqnParser.TOKEN.search(document, pos)
+            if token:
+                pattern = (EqnParser.State.Comment if token.group() == '<!--'
+                        else EqnParser.State.Equation).value
+                # a formula or comment may continue in the next block;
+                # handlers report malformed ones at the end of the document
+                if eof or pattern.match(document, token.start()):
+                    yield document[pos:token.start()]
+                    chunk, pos = (self.handle_comment(token.start())
+                            if token.group() == '<!--'
+                            else self.handle_equation(token.start()))
+                    yield chunk
+                    continue
+                yield document[pos:token.start()]
+                pos = token.start()
+            elif eof:
+                yield document[pos:]
+                break
+            else: # keep a tag which may turn out to be an equation
+                cut = document.rfind('<', pos)
+                cut = (cut if cut >= 0 and document.find('>', cut) < 0
+                        else len(document))
+                yield document[pos:cut]
+                pos = cut
+            block, eof = read()
+            # drop the parsed part of the document
+            offset, lines, last_newline = self.__window
+            parsed = document[:pos]
+            if parsed.count('\n'):
+                lines += parsed.count('\n')
+                last_newline = offset + parsed.rfind('\n')
+            self.__set_window(document[pos:] + block, offset + pos, lines,
+                    last_newline)
+            pos = 0
+
+    def __set_window(self, document, offset, lines, last_newline):
+        """Set the part of the document being parsed, see _parse_stream."""
+        self.__document = document
+        self.__lines = LineIndex(document)
+        self.__window = (offset, lines, last_newline)
+
+    def get_position(self, index):
+        """Return (line number, position on line) of an offset within the
+        document being parsed, see get_position. If the document is parsed as
+        a stream, offsets are relative to the current window of the document,
+        but positions refer to the whole document."""
+        line, pos = self.__lines.get_position(index)
+        offset, lines, last_newline = self.__window
+        if line:
+            return (lines + line, pos)
+        return (lines, offset + index - (last_newline if last_newline
+                is not None else 0))
+
+    def __decode(self, document):
+        """Decode the document, if required, and store it for parsing."""
         if isinstance(document, bytes): # try to guess encoding
-            try:
-                encoding = next(filter(bool, CHARSET_PATTERN.search(document)
-                        .groups())).decode('ascii')
-                document = document.decode(encoding)
-            except AttributeError:
-                raise ParseException(("Could not determine encoding of "
-                        "document, no charset information in the HTML header "
-                        "found."))
-            self.__encoding = encoding
-        self.__document = document[:]
-        self._parse()
+            self.__encoding = self.__guess_encoding(document)
+            document = document.decode(self.__encoding)
+        self.__set_window(document[:], 0, 0, None)
+
+    @staticmethod
+    def __read_charset(data, stream, block_size):
+        """Read blocks from a binary stream and append them to the given data,
+        until the charset declaration of the document is found (see
+        __guess_encoding) or the stream is exhausted. Return the data read."""
+        data = bytearray(data)
+        searched = 0 # data before this position has been searched already
+        while not CHARSET_PATTERN.search(data, searched):
+            block = stream.read(block_size)
+            if not block:
+                break
+            searched = max(0, len(data) - CHARSET_OVERLAP)
+            data += block
+        return bytes(data)
+
+    @staticmethod
+    def __guess_encoding(document):
+        """Return the encoding given in the HTML header of a bytes document."""
+        try:
+            return next(filter(bool, CHARSET_PATTERN.search(document)
+                    .groups())).decode('ascii')
+        except AttributeError:
+            raise ParseException(("Could not determine encoding of "
+                    "document, no charset information in the HTML header "
+                    "found."))
 
     def find_with_offset(self, doc, start, what):
         """This find method searches in the document for a given string, staking
         the offset into account. REturned is the absolute position (so offset +
         relative match position) or -1 for no hit."""
         if isinstance(what, str):
-            pos = doc[start:].find(what)
-        else:
-            match = what.search(doc[start:])
-            pos = (-1 if not match else match.span()[0])
-        return (pos if pos == -1 else pos + start)
+            return doc.find(what, start)
+        match = what.search(doc, start)
+        return (-1 if not match else match.start())
 
 
     def _parse(self):
         """This function parses the document, while maintaining state using the
-        State enum."""
-        in_document = lambda x: not x == -1
-        # maintain a lower-case copy, which eases searching, but doesn't affect
-        # the handler methods
-        doc = self.__document[:].lower()
-
-        end = len(self.__document) - 1
-        eq_start = re.compile(r'<\s*eq\s*(.*?)>')
-
+        State enum. It is a generator yielding the parsed chunks.
+        The document is scanned once: each search starts at the end of the
+        previous match, no part of the document is copied or searched again."""
+        document = self.__document
         start_pos = 0
-        while start_pos < end:
-            comment = self.find_with_offset(doc, start_pos, '<!--')
-            formula = self.find_with_offset(doc, start_pos, eq_start)
-            if in_document(comment) and in_document(formula): # both present, take closest
-                if comment < formula:
-                    self.__data.append(self.__document[start_pos:comment])
-                    start_pos = self.handle_comment(comment)
-                else:
-                    self.__data.append(self.__document[start_pos:formula])
-                    start_pos = self.handle_equation(formula)
-            elif in_document(formula):
-                self.__data.append(self.__document[start_pos:formula])
-                start_pos = self.handle_equation(formula)
-            elif in_document(comment):
-                self.__data.append(self.__document[start_pos:comment])
-                start_pos = self.handle_comment(comment)
-            else: # only data left
-                self.__data.append(self.__document[start_pos:])
-                start_pos = end
+        while start_pos < len(document):
+            token = EqnParser.TOKEN.search(document, start_pos)
+            if not token: # only data left
+                yield document[start_pos:]
+                break
+            yield document[start_pos:token.start()]
+            if token.group() == '<!--':
+                chunk, start_pos = self.handle_comment(token.start())
+            else:
+                chunk, start_pos = self.handle_equation(token.start())
+            yield chunk
 
 
     def handle_equation(self, start_pos):
         """Parse an equation. The given offset should mark the beginning of this
-        equation."""
+        equation. Return the formula chunk and the end of the equation."""
         # get line and column of `start_pos`
-        lnum, pos = get_position(self.__document, start_pos)
+        lnum, pos = self.get_position(start_pos)
 
-        match = EqnParser.State.Equation.value.search(self.__document[start_pos:])
+        match = EqnParser.State.Equation.value.search(self.__document,
+                start_pos)
         if not match:
             next_eq = find_anycase(self.__document[start_pos+1:], '<eq')
             closing = find_anycase(self.__document[start_pos:], '</eq>')
             if -1 < next_eq < closing and closing > -1:
                 raise ParseException("Unclosed tag found", (lnum, pos))
             raise ParseException("Malformed equation tag found", (lnum, pos))
-        end = start_pos + match.span()[1]
         attrs, formula = match.groups()
-        if '<eq>' in formula or '<EQ' in formula:
-            raise ParseException("Invalid nesting of formulas detected.", (lnum,
-                pos))
+        # let line number count from 0 as well
+        return (self.__make_formula((lnum, pos), attrs, formula), match.end())
 
+    @staticmethod
+    def __make_formula(position, attrs, formula):
+        """Create the formula chunk from the attributes and the content of an
+        equation tag."""
+        if '<eq>' in formula or '<EQ' in formula:
+            raise ParseException("Invalid nesting of formulas detected.",
+                    position)
         # replace HTML entities
-        entity = EqnParser.HTML_ENTITY.search(formula)
-        while entity:
-            formula = re.sub(EqnParser.HTML_ENTITY,
-                    html.unescape(entity.groups()[0]), formula)
-            entity = EqnParser.HTML_ENTITY.search(formula)
+        formula = EqnParser.HTML_ENTITY.sub(lambda entity:
+                html.unescape(entity.group(1)), formula)
         attrs = attrs.lower()
         displaymath = bool(attrs) and 'env' in attrs and 'displaymath' in attrs
-        self.__data.append(((lnum, pos), # let line number count from 0 as well
-                displaymath, formula))
-        return end
+        return (position, displaymath, formula)
 
 
     def handle_comment(self, start_pos):
-        match = EqnParser.State.Comment.value.search(self.__document[start_pos:])
+        """Parse a comment starting at the given offset. Return the comment and
+        the end of it."""
+        match = EqnParser.State.Comment.value.search(self.__document,
+                start_pos)
         if not match:
-            lnum, pos = get_position(self.__document, start_pos)
+            lnum, pos = self.get_position(start_pos)
             # this could be a parser issue, too
             raise ParseException("Improperly formatted comment found", (lnum,
                 pos))
-        self.__data.append('<!--%s-->' % match.groups()[0])
-        return start_pos + match.span()[1] # return end of match
+        # return end of match
+        return ('<!--%s-->' % match.groups()[0], match.end())
 
     def get_encoding(self):
         """Return the parsed encoding from the HTML meta data. If none was set,
@@ -319,7 +564,9 @@ class HtmlImageFormatter: # ToDo: localisation
     external to be easily readable. Furthermore the alt attribute is limited to
     255 characters, so formula blocks exceeding that limit need to be treated
     differently anyway. If that behavior is not wanted, it can be disabled and
-    nothing will be excluded."""
+    nothing will be excluded.
+    Images are linked by default. They can also be embedded into the document
+    as data URIs, see set_embedding."""
 
     EXCLUSION_FILE_NAME = 'outsourced-descriptions.html'
     HTML_TEMPLATE_HEAD = ('<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01//EN"' +
@@ -327,6 +574,21 @@ class HtmlImageFormatter: # ToDo: localisation
         '<meta http-equiv="content-type" content="text/html; charset=utf-8"/>' +
         '\n<title>Outsourced Formulas</title>\n</head>\n<!-- ' +
         'DO NOT MODIFY THIS FILE, IT IS AUTOMATICALLY GENERATED -->\n<body>\n')
+    # maximum number of bytes of base64-encoded images kept in memory
+    ENCODED_IMAGE_CACHE_SIZE = 32 * 1024 * 1024
+    # embedding modes: link to the image file, embed the image as data URI or
+    # embed images up to a size threshold and link larger ones
+    LINK = 'link'
+    INLINE = 'inline'
+    HYBRID = 'hybrid'
+    # embed each SVG image once as a symbol and reference it at each
+    # occurrence; other images are embedded as data URIs
+    SYMBOLS = 'symbols'
+    EMBEDDING_MODES = (LINK, INLINE, HYBRID, SYMBOLS)
+    # default size threshold in bytes for HYBRID
+    INLINE_THRESHOLD = 4096
+    MIME_TYPES = {'.svg': 'image/svg+xml', '.png': 'image/png'}
+
     def __init__(self, base_path='', link_prefix=None):
         self.__exclude_descriptions = False
         self.__link_prefix = (link_prefix if link_prefix else '')
@@ -339,6 +601,15 @@ class HtmlImageFormatter: # ToDo: localisation
         self.__inline_maxlength=100
         self.__file_head = HtmlImageFormatter.HTML_TEMPLATE_HEAD
         self.__cached_formula_pars = collections.OrderedDict()
+        # path -> (mtime, size, base64-encoded image), least recently used first
+        self.__encoded_images = collections.OrderedDict()
+        self.__encoded_size = 0
+        self.__embedding = HtmlImageFormatter.LINK
+        # identifier of an SVG image -> whether it is embedded as a symbol
+        self.__defined_symbols = {}
+        self.__glyphs = {} # path data of embedded glyphs -> identifier
+        self.__inline_threshold = HtmlImageFormatter.INLINE_THRESHOLD
+        self.__source_path = ''
         self.__url = ''
         self.initialized = False
         self.initialize() # read already written file, if any
@@ -374,6 +645,27 @@ class HtmlImageFormatter: # ToDo: localisation
         HTML link."""
         self.__url = prefix
 
+    def set_embedding(self, mode, threshold=None):
+        """Set how images are included into the document, one of
+        EMBEDDING_MODES: LINK (default) links to the image file (prefixed by
+        the URL, see set_url), INLINE embeds the image as a data URI and HYBRID
+        embeds images up to `threshold` bytes (default INLINE_THRESHOLD) and
+        links larger ones. SYMBOLS embeds each SVG image once as a hidden
+        `<symbol>` and references it with `<use>` at each occurrence, so that
+        the document grows with the number of distinct formulas only. The
+        glyph outlines of the SVG images are shared between all symbols."""
+        if mode not in HtmlImageFormatter.EMBEDDING_MODES:
+            raise ValueError("unknown embedding mode: %s" % mode)
+        self.__embedding = mode
+        if threshold is not None:
+            self.__inline_threshold = threshold
+
+    def set_source_path(self, path):
+        """Set the directory the image paths are relative to, to read images
+        which are embedded (default: the current working directory). This is
+        usually the directory of the output document."""
+        self.__source_path = path
+
     def initialize(self):
         """Initialize the image writer. If a file with already written image
         descriptions exists, this one will be parsed first and new formulas
@@ -412,27 +704,154 @@ class HtmlImageFormatter: # ToDo: localisation
                     for formula in self.__cached_formula_pars.values()]))
             f.write('\n</body>\n</html>\n')
 
-    def get_html_img(self, pos, formula, img_path, displaymath=False):
+    def get_html_img(self, pos, formula, img_path, displaymath=False,
+            variants=None):
         """:param pos dictionary containing keys depth, height and width
         :param formula LaTeX alternative text
         :param img_path: path to image
         :param displaymath display or inline math (default False, inline maths)
+        :param variants dictionary of further images of the formula, by name
+            (see caching.ImageCache.add_formula); images with a higher pixel
+            density (named e.g. `2x`) are offered in the srcset attribute of
+            linked images (inlining all of them would enlarge the document
+            instead of saving bandwidth), a
+            PNG image (named `png`) is the fallback of an SVG image within a
+            `<picture>` element
         :returns a string with the formatted HTML"""
-        full_url = img_path
-        if self.__url:
-            if self.__url.endswith('/'): self.__url = self.__url[:-1]
-            full_url = self.__url + '/' + img_path
-        with open(full_url, "rb") as image_file:
-            encoded_image = base64.b64encode(image_file.read()).decode("ascii")
-
         # depth is a negative offset
         depth = float(pos['depth']) * -1
         css = (self.__css['display'] if displaymath else self.__css['inline'])
-        return ('<img src="data:image/svg+xml;base64,{0}" style="vertical-align: {3:.2f}px; margin: 0;" '
-                'height="{2[height]:.2f}" width="{2[width]:.2f}" alt="{1}" '
-                'class="{4}" >').format(encoded_image, formula, pos, depth, css)
-
-    def format_excluded(self, pos, formula, img_path, displaymath=False):
+        if self.__embedding == HtmlImageFormatter.SYMBOLS and \
+                img_path.lower().endswith('.svg'):
+            identifier = 'gladtex-' + re.sub('[^A-Za-z0-9_-]', '-', img_path)
+            definition = ''
+            if identifier not in self.__defined_symbols:
+                definition = self.get_svg_symbol(os.path.join(
+                    self.__source_path, img_path), identifier, self.__glyphs)
+                self.__defined_symbols[identifier] = definition is not None
+            if self.__defined_symbols[identifier]:
+                return ('{0}<svg style="vertical-align: {3:.2f}px; margin: 0;" '
+                        'height="{2[height]:.2f}" width="{2[width]:.2f}" '
+                        'role="img" aria-label="{1}" class="{4}">'
+                        '<use href="#{5}"/></svg>').format(definition,
+                                formula, pos, depth, css, identifier)
+        variants = (variants if variants else {})
+        if 'png' in variants and img_path.lower().endswith('.svg'):
+            # viewers without SVG support (or without support for <picture>)
+            # show the PNG image
+            return ('<picture><source srcset="{0}" type="image/svg+xml">{1}'
+                    '</picture>').format(self.get_image_source(img_path),
+                            self.get_html_img(pos, formula, variants['png'],
+                                displaymath))
+        source = self.get_image_source(img_path)
+        densities = ([] if self.is_inlined(img_path) else sorted(
+            (float(name[:-1]), path) for name, path in variants.items()
+            if DENSITY_VARIANT.match(name)))
+        # src is the candidate for density 1, it is not repeated in srcset
+        srcset = ('' if not densities else ' srcset="%s"' % ', '.join(
+            '%s %gx' % (self.get_image_link(path), density)
+            for density, path in densities))
+        return ('<img src="{0}"{5} style="vertical-align: {3:.2f}px; '
+                'margin: 0;" height="{2[height]:.2f}" width="{2[width]:.2f}" '
+                'alt="{1}" class="{4}" >').format(source, formula, pos, depth,
+                        css, srcset)
+
+    @staticmethod
+    def get_svg_symbol(path, identifier, glyphs=None):
+        """Return a hidden SVG element defining the given SVG image as a
+        `<symbol>` with the given identifier, or None if the file is not an
+        SVG document. The identifiers within the image are prefixed with the
+        symbol identifier, so that these do not clash with those of other
+        images in the same document.
+        If a dictionary `glyphs` is given, the glyph outlines are moved out of
+        the symbol and shared between all symbols of a document: `glyphs` maps
+        the path data of the glyphs defined so far to their identifier, only
+        glyphs not yet in it are defined along with the symbol."""
+        with open(path, encoding='utf-8') as image_file:
+            document = image_file.read()
+        match = SVG_ROOT.search(document)
+        if not match:
+            return None
+        attributes, content = match.groups()
+        view_box = re.search(r"""viewBox=(['"])(.*?)\1""", attributes)
+        prefix = identifier + '-'
+        content = SVG_ID.sub(lambda m: m.group(1) + prefix, content)
+        content = SVG_REFERENCE.sub(lambda m: m.group(1) + prefix, content)
+        shared = ''
+        if glyphs is not None:
+            renamed = {} # identifier within the symbol -> shared identifier
+            defined = []
+            def share(match):
+                data = match.group(4)
+                if data not in glyphs:
+                    glyphs[data] = 'gladtex-glyph-%d' % len(glyphs)
+                    defined.append("<path id='%s' d='%s'/>" % (glyphs[data],
+                        data))
+                renamed[match.group(2)] = glyphs[data]
+                return ''
+            content = SVG_EMPTY_DEFS.sub('', SVG_GLYPH.sub(share, content))
+            content = SVG_REFERENCE_ID.sub(lambda m: m.group(1) +
+                    renamed.get(m.group(2), m.group(2)), content)
+            if defined:
+                shared = '<defs>%s</defs>' % ''.join(defined)
+        return ('<svg aria-hidden="true" style="position: absolute; width: 0; '
+                'height: 0; overflow: hidden">{3}<symbol id="{0}"{1}>{2}'
+                '</symbol></svg>').format(identifier, (' viewBox="%s"' %
+                    view_box.group(2) if view_box else ''), content, shared)
+
+    def is_inlined(self, img_path):
+        """Return whether the given image is embedded as a data URI, depending
+        on the embedding mode (see set_embedding)."""
+        if self.__embedding == HtmlImageFormatter.LINK:
+            return False
+        return self.__embedding != HtmlImageFormatter.HYBRID or \
+                os.path.getsize(os.path.join(self.__source_path, img_path)) \
+                <= self.__inline_threshold
+
+    def get_image_source(self, img_path):
+        """Return the src attribute of an image, either a link or a data URI,
+        depending on the embedding mode (see set_embedding)."""
+        if self.is_inlined(img_path):
+            mime_type = HtmlImageFormatter.MIME_TYPES.get(
+                    os.path.splitext(img_path)[1].lower(),
+                    'application/octet-stream')
+            return 'data:%s;base64,%s' % (mime_type, self.get_encoded_image(
+                os.path.join(self.__source_path, img_path)))
+        return self.get_image_link(img_path)
+
+    def get_image_link(self, img_path):
+        """Return the link to an image, with the URL prefix (see set_url)."""
+        if self.__url:
+            if self.__url.endswith('/'): self.__url = self.__url[:-1]
+            return self.__url + '/' + img_path
+        return img_path
+
+    def get_encoded_image(self, path):
+        """Return the base64-encoded content of the given image file. Each
+        file is read and encoded once, as long as its modification time and
+        size do not change; the encoded images are kept up to a total size of
+        ENCODED_IMAGE_CACHE_SIZE bytes."""
+        stat = os.stat(path)
+        cached = self.__encoded_images.get(path)
+        if cached and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+            self.__encoded_images.move_to_end(path)
+            return cached[2]
+        with open(path, "rb") as image_file:
+            encoded_image = base64.b64encode(image_file.read()).decode("ascii")
+        if cached:
+            self.__encoded_size -= len(cached[2])
+        self.__encoded_images[path] = (stat.st_mtime_ns, stat.st_size,
+                encoded_image)
+        self.__encoded_images.move_to_end(path)
+        self.__encoded_size += len(encoded_image)
+        while self.__encoded_size > HtmlImageFormatter.ENCODED_IMAGE_CACHE_SIZE:
+            _path, (_mtime, _size, dropped) = self.__encoded_images.popitem(
+                    last=False)
+            self.__encoded_size -= len(dropped)
+        return encoded_image
+
+    def format_excluded(self, pos, formula, img_path, displaymath=False,
+            variants=None):
         """This method formats a formula and an formula image in HTML and
         additionally writes the formula to an external (configured) file to
         which the image links to. That's useful for blind screen reader users
@@ -441,10 +860,12 @@ class HtmlImageFormatter: # ToDo: localisation
         :param formula LaTeX alternative text
         :param img_path: path to image
         :param displaymath if set to true, image is treated as display math formula (default False)
+        :param variants further images of the formula, see get_html_img
         :returns string with formatted HTML image which also links to excluded
         formula"""
         shortened = (formula[:100] + '...'  if len(formula) > 100 else formula)
-        img = self.get_html_img(pos, shortened, img_path, displaymath)
+        img = self.get_html_img(pos, shortened, img_path, displaymath,
+                variants)
         identifier = gen_id(formula)
         # write formula out to external file
         if identifier not in self.__cached_formula_pars:
@@ -453,7 +874,7 @@ class HtmlImageFormatter: # ToDo: localisation
         return '<a.eqn href="{}#{}">{}</a.eqn>'.format(exclusion_filelink,
                 gen_id(formula), img)
 
-    def format(self, pos, formula, img_path, displaymath=False):
+    def format(self, pos, formula, img_path, displaymath=False, variants=None):
         """This method formats a formula. If self.__exclude_descriptions is set
         and the formula igreater than the configured length, the formula will be
         outsourced, otherwise it'll be included in the IMG's alt tag. In either
@@ -462,25 +883,38 @@ class HtmlImageFormatter: # ToDo: localisation
         :param formula LaTeX alternative text
         :param img_path: path to image
         :param displaymath whether or not formula is in display math (default: no)
+        :param variants further images of the formula, see get_html_img
         :returns string with formatted HTML image which also links to excluded
         formula"""
         formula = typesetting.increase_readability(formula,
                 self.__replace_nonascii)
         if self.__exclude_descriptions and \
                 len(formula) > self.__inline_maxlength:
-            return self.format_excluded(pos, formula, img_path, displaymath)
-        return self.get_html_img(pos, formula, img_path, displaymath)
+            return self.format_excluded(pos, formula, img_path, displaymath,
+                    variants)
+        return self.get_html_img(pos, formula, img_path, displaymath, variants)
 
 def write_html(file, document, formatter):
     """Processed HTML documents are made up of raw HTML chunks which are written
     back unaltered and of processed image. An processed image is a former
     formula converted to an image with additional meta data. This is passed to
     the format function of the supplied formatter and the result is written to
-    the given (open) file handle."""
+    the given (open) file handle.
+    Raw HTML chunks may also be bytes-like objects (see
+    EqnParser.feed_buffer), which are written to the binary buffer of the
+    text file; these have to be in the encoding of the file."""
+    binary = None # file.buffer, as soon as bytes have been written
     for chunk in document:
         if isinstance(chunk, dict):
             is_displaymath = chunk['displaymath']
-            file.write(formatter.format(chunk['pos'], chunk['formula'],
-                    chunk['path'], is_displaymath))
+            chunk = formatter.format(chunk['pos'], chunk['formula'],
+                    chunk['path'], is_displaymath, chunk.get('variants'))
+        if not isinstance(chunk, str):
+            if not binary:
+                file.flush()
+                binary = file.buffer
+            binary.write(chunk)
+        elif binary:
+            binary.write(chunk.encode(file.encoding, file.errors or 'strict'))
         else:
             file.write(chunk)
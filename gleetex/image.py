@@ -7,12 +7,16 @@ Each formula is saved as an image, either as PNG or SVG. SVG is advised, since
 it is a properly scalable format.
 """
 
+import asyncio
 import enum
+import errno
 import os
 import re
 import shutil
+import signal
 import subprocess
 import sys
+import threading
 
 from .typesetting import LaTeXDocument
 
@@ -20,6 +24,17 @@ DVIPNG_REGEX = re.compile(r"^ depth=(-?\d+) height=(\d+) width=(\d+)")
 DVISVGM_DEPTH_REGEX = re.compile(r"^\s*width=.*?pt, height=.*?pt, depth=(.*?)pt")
 DVISVGM_SIZE_REGEX = re.compile(r"^\s*graphic size: (.*?)pt x (.*?)pt")
 
+def density_name(density):
+    """Return the name of a pixel density (a factor of the resolution) as used
+    in the srcset attribute of HTML images, e.g. `2x`."""
+    return '%gx' % density
+
+def density_file_name(path, density):
+    """Return the file name of the variant of an image rendered with the given
+    pixel density, e.g. img/eqn000@2x.png for img/eqn000.png."""
+    root, extension = os.path.splitext(path)
+    return '%s@%s%s' % (root, density_name(density), extension)
+
 def remove_all(*files):
     """Guarded remove of files (rm -f); no exception is thrown if a file
     couldn't be removed."""
@@ -29,18 +44,131 @@ def remove_all(*files):
         except OSError:
             pass
 
+def move_file(source, destination):
+    """Move a file, replacing the destination atomically: readers see either
+    the old or the new file, never a partially written one. If both are on
+    different file systems, e.g. a scratch directory on a tmpfs, the file is
+    copied next to the destination first."""
+    try:
+        os.replace(source, destination)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    temporary = destination + '.tmp'
+    try:
+        shutil.copyfile(source, temporary)
+        os.replace(temporary, destination)
+    except OSError:
+        remove_all(temporary)
+        raise
+    os.remove(source)
+
+
+class ProcessCancelled(subprocess.SubprocessError):
+    """Raised if a subprocess was terminated or could not be started, because
+    its ProcessTracker was told to terminate all processes."""
+    pass
+
+class ProcessTracker:
+    """Keep track of running subprocesses, so that these can be terminated at
+    once, e.g. when a conversion has failed or was interrupted by the user.
+    Once `terminate()` was called, no further processes may be started; the
+    tracker is meant to be used for a single conversion run.
+    Processes are started in their own process group on POSIX systems, so that
+    processes spawned by LaTeX are terminated as well."""
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__processes = set()
+        self.__terminated = False
+
+    def add(self, proc):
+        """Register a process. If the tracker has been terminated already,
+        the process is terminated immediately and ProcessCancelled is
+        raised."""
+        with self.__lock:
+            if not self.__terminated:
+                self.__processes.add(proc)
+                return
+        kill_process_group(proc)
+        raise ProcessCancelled("conversion cancelled")
+
+    def remove(self, proc):
+        with self.__lock:
+            self.__processes.discard(proc)
+
+    def is_terminated(self):
+        return self.__terminated
+
+    def terminate(self):
+        """Terminate all running processes and refuse to start new ones."""
+        with self.__lock:
+            self.__terminated = True
+            processes = list(self.__processes)
+            self.__processes.clear()
+        for proc in processes:
+            kill_process_group(proc)
+
+def kill_process_group(proc):
+    """Kill the process group of the given process (POSIX, see
+    ProcessTracker) or the process itself."""
+    try:
+        if os.name == 'posix' and os.getpgid(proc.pid) == proc.pid:
+            os.killpg(proc.pid, signal.SIGKILL)
+        else:
+            proc.kill()
+    except OSError: # terminated in the meantime
+        pass
+
+def missing_program_message(cmd, install_recommends):
+    """Return an error message for a missing program, try to help."""
+    text = "Command `%s` not found." % cmd[0]
+    if install_recommends and shutil.which('dpkg'):
+        text += ' Install it using `sudo apt install ' + install_recommends
+    else:
+        text += ' Install a TeX distribution of your choice, e.g. MikTeX or TeXlive.'
+    return text
 
-def proc_call(cmd, cwd=None, install_recommends=True):
+def decode_output(output):
+    """Decode the output of a process, see proc_call."""
+    return output.decode(sys.getdefaultencoding(), errors="surrogateescape")
+
+#pylint: disable=too-many-arguments,redefined-builtin
+def proc_call(cmd, cwd=None, install_recommends=True, tracker=None, input=None,
+        capture=False, env=None):
     """Execute cmd (list of arguments) as a subprocess. Returned is a tuple with
     stdout and stderr, decoded if not None. If the return value is not equal 0, a
-    subprocess error is raised. Timeouts will happen after 20 seconds."""
-    with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            universal_newlines=False, cwd=cwd) as proc:
+    subprocess error is raised. Timeouts will happen after 20 seconds.
+    If a ProcessTracker is given, the process is registered with it while
+    running; a ProcessCancelled exception is raised if the process was
+    terminated through the tracker.
+    `input` (bytes) is written to the standard input of the process, if given.
+    If `capture` is set, a tuple (stdout as bytes, decoded stderr) is returned,
+    for processes writing binary data to their standard output.
+    `env` replaces the environment of the process, if given."""
+    if tracker and tracker.is_terminated():
+        raise ProcessCancelled("conversion cancelled")
+    # own process group to terminate child processes as well, see ProcessTracker
+    kwargs = ({'start_new_session': True} if tracker and os.name == 'posix'
+            else {})
+    try:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE, universal_newlines=False, cwd=cwd,
+                stdin=(subprocess.PIPE if input is not None else None),
+                env=env, **kwargs)
+    except FileNotFoundError:
+        raise subprocess.SubprocessError(missing_program_message(cmd,
+            install_recommends)) from None
+    with proc:
+        if tracker:
+            tracker.add(proc)
         data = []
         try:
-            data = [d.decode(sys.getdefaultencoding(), errors="surrogateescape")
-                    for d in proc.communicate(timeout=20) if d]
+            output = proc.communicate(input=input, timeout=20)
+            data = [decode_output(d) for d in output if d]
             if proc.wait():
+                if tracker and tracker.is_terminated():
+                    raise ProcessCancelled("conversion cancelled")
                 raise subprocess.SubprocessError("Error while executing %s\n%s\n" %
                     (' '.join(cmd), '\n'.join(data)))
         except subprocess.TimeoutExpired as e:
@@ -54,22 +182,62 @@ def proc_call(cmd, cwd=None, install_recommends=True):
             else:
                 raise subprocess.SubprocessError('execution timed out after ' +
                         str(e.args[1]) + ' s: ' + ' '.join(e.args[0]))
-        except KeyboardInterrupt as e:
-            sys.stderr.write("\nInterrupted; ")
-            import traceback
-            traceback.print_exc(file=sys.stderr)
-        except FileNotFoundError:
-            # program missing, try to help
-            text = "Command `%s` not found." % cmd[0]
-            if install_recommends and shutil.which('dpkg'):
-                text += ' Install it using `sudo apt install ' + install_recommends
-            else:
-                text += ' Install a TeX distribution of your choice, e.g. MikTeX or TeXlive.'
-            raise subprocess.SubprocessError(text) from None
+        except KeyboardInterrupt:
+            # do not leave the process behind, let the caller handle the rest
+            kill_process_group(proc)
+            raise
+        finally:
+            if tracker:
+                tracker.remove(proc)
+        if capture:
+            return (output[0], decode_output(output[1]))
         if isinstance(data, list):
             return '\n'.join(data)
         return data
 
+#pylint: disable=too-many-arguments,redefined-builtin
+async def async_proc_call(cmd, cwd=None, install_recommends=True,
+        tracker=None, timeout=20, input=None, capture=False, env=None):
+    """Asynchronous counterpart of proc_call, to be awaited within an asyncio
+    event loop. The process is killed if it does not terminate within
+    `timeout` seconds or if the awaiting task is cancelled."""
+    if tracker and tracker.is_terminated():
+        raise ProcessCancelled("conversion cancelled")
+    kwargs = ({'start_new_session': True} if os.name == 'posix' else {})
+    try:
+        proc = await asyncio.create_subprocess_exec(*cmd,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd,
+                stdin=(subprocess.PIPE if input is not None else None),
+                env=env, **kwargs)
+    except FileNotFoundError:
+        raise subprocess.SubprocessError(missing_program_message(cmd,
+            install_recommends)) from None
+    if tracker:
+        tracker.add(proc)
+    try:
+        output = await asyncio.wait_for(proc.communicate(input), timeout)
+    except asyncio.TimeoutError:
+        kill_process_group(proc)
+        await proc.wait()
+        raise subprocess.SubprocessError('execution timed out after %s s: %s'
+                % (timeout, ' '.join(cmd))) from None
+    except asyncio.CancelledError:
+        kill_process_group(proc)
+        await proc.wait()
+        raise
+    finally:
+        if tracker:
+            tracker.remove(proc)
+    data = [decode_output(d) for d in output if d]
+    if proc.returncode:
+        if tracker and tracker.is_terminated():
+            raise ProcessCancelled("conversion cancelled")
+        raise subprocess.SubprocessError("Error while executing %s\n%s\n" %
+            (' '.join(cmd), '\n'.join(data)))
+    if capture:
+        return (output[0], decode_output(output[1]))
+    return '\n'.join(data)
+
 #pylint: disable=too-few-public-methods
 class Format(enum.Enum):
     """Chose the image output format."""
@@ -94,6 +262,11 @@ class Tex2img:
         self.__size = [115, None]
         self.__background = 'transparent'
         self.__keep_latex_source = False
+        self.__densities = ()
+        self.__png_fallback = False
+        self.__pipes = False
+        self.__search_path = None
+        self.__processes = ProcessTracker()
 
     def set_dpi(self, dpi):
         """Set output resolution for formula images. This has no effect ifthe
@@ -124,12 +297,80 @@ class Tex2img:
             raise TypeError("boolean object required, got %s." % repr(flag))
         self.__keep_latex_source = flag
 
+    def set_densities(self, densities):
+        """Set additional pixel densities for PNG images, as factors of the
+        configured resolution, e.g. (2, 3) for high-DPI screens. Each density
+        is rendered by another dvipng run over the same DVI file, so that LaTeX
+        runs once per formula; the images are named after density_file_name.
+        The positioning information is always that of the image with the
+        configured resolution. This has no effect if the output format is
+        SVG."""
+        if any(not isinstance(density, (int, float)) or density <= 0
+                for density in densities):
+            raise ValueError("densities must be positive numbers, got %s" %
+                    repr(densities))
+        self.__densities = tuple(density for density in densities
+                if density != 1)
 
-    def create_dvi(self, tex_document, dvi_fn):
-        """Call LaTeX to produce a dvi file with the given LaTeX document.
-        Temporary files will be removed, even in the case of a LaTeX error.
-        This method raises a SubprocessError with the helpful part of LaTeX's
-        error output."""
+    def set_png_fallback(self, flag):
+        """Create a PNG image along with each SVG image, from the same DVI
+        file, for viewers without SVG support. The PNG image is named like the
+        SVG image. This has no effect if the output format is PNG."""
+        self.__png_fallback = flag
+
+    def set_pipes(self, flag):
+        """Pass the LaTeX document to LaTeX through its standard input instead
+        of writing it to a file (unless the LaTeX source is kept, see
+        set_keep_latex_source) and read SVG images from the standard output
+        of dvisvgm. The DVI file can then be kept in a scratch directory,
+        apart from the image: see create_image."""
+        self.__pipes = flag
+
+    def set_search_path(self, path):
+        """Set a directory in which LaTeX looks for files included by the
+        document (e.g. with `\\input` in the preamble), after its working
+        directory. This keeps relative paths working if LaTeX runs elsewhere,
+        e.g. in a scratch directory (see set_pipes). The directory is put in
+        front of the TEXINPUTS environment variable of LaTeX."""
+        self.__search_path = (os.path.abspath(path) if path else None)
+
+    def _latex_environment(self):
+        """Return the environment of LaTeX, see set_search_path, or None to
+        inherit the environment of this process."""
+        if not self.__search_path:
+            return None
+        env = os.environ.copy()
+        # an empty entry at the end stands for the default search path
+        env['TEXINPUTS'] = os.pathsep.join(['.', self.__search_path,
+            env.get('TEXINPUTS', '')])
+        return env
+
+    def get_variants(self, image_fn):
+        """Return a dictionary mapping the name of each variant created along
+        with the given image file to its file name: the pixel densities of PNG
+        images (see set_densities) or `png` for the PNG fallback of SVG images
+        (see set_png_fallback)."""
+        if self.__format == Format.Png:
+            return {density_name(density): density_file_name(image_fn,
+                density) for density in self.__densities}
+        if self.__png_fallback:
+            return {'png': os.path.splitext(image_fn)[0] + '.png'}
+        return {}
+
+    def _tracker(self):
+        """Return the ProcessTracker of this converter."""
+        return self.__processes
+
+    def terminate(self):
+        """Terminate all running LaTeX and image conversion processes at once.
+        All conversions currently running or started afterwards fail with a
+        ProcessCancelled exception; this converter cannot be used anymore."""
+        self.__processes.terminate()
+
+    def _prepare_latex(self, tex_document, dvi_fn):
+        """Write the LaTeX document next to the given DVI file name. Return the
+        LaTeX command, its working directory, the intermediate files to
+        remove afterwards and the input of the command (see set_pipes)."""
         path = os.path.dirname(dvi_fn)
         if path and not os.path.exists(path):
             os.makedirs(path)
@@ -139,48 +380,116 @@ class Tex2img:
 
         if self.__size[1]: # font size in pt
             tex_document.set_fontsize(self.__size[1])
+        intermediate = [new_extension('aux'), new_extension('log')]
+        if self.__pipes and not self.__keep_latex_source:
+            # the job name determines the names of the DVI and the log file
+            jobname = os.path.splitext(os.path.basename(dvi_fn))[0]
+            return (['latex', '-halt-on-error', '-jobname=' + jobname], path,
+                    intermediate, str(tex_document).encode(self.__encoding))
         tex_fn = new_extension('tex')
-        aux_fn = new_extension('aux')
-        log_fn = new_extension('log')
-        cmd = None
         encoding = self.__encoding
         with open(tex_fn, mode='w', encoding=encoding) as tex:
             tex.write(str(tex_document))
-        cmd = ['latex', '-halt-on-error', os.path.basename(tex_fn)]
-        try:
-            proc_call(cmd, cwd=path, install_recommends='texlive-recommended')
-        except subprocess.SubprocessError as e:
-            remove_all(dvi_fn)
-            msg = ''
-            if e.args:
-                data = self.parse_latex_log(e.args[0])
-                if data:
-                    msg += data
-                else:
-                    msg += str(e.args[0])
-            raise subprocess.SubprocessError(msg) # propagate subprocess error
-        finally:
-            if self.__keep_latex_source:
-                remove_all(aux_fn, log_fn)
+        if not self.__keep_latex_source:
+            intermediate.append(tex_fn)
+        return (['latex', '-halt-on-error', os.path.basename(tex_fn)], path,
+                intermediate, None)
+
+    def _latex_error(self, error):
+        """Return a SubprocessError with the helpful part of LaTeX's error
+        output from the given SubprocessError."""
+        msg = ''
+        if error.args:
+            data = self.parse_latex_log(error.args[0])
+            if data:
+                msg += data
             else:
-                remove_all(tex_fn, aux_fn, log_fn)
+                msg += str(error.args[0])
+        return subprocess.SubprocessError(msg)
 
-    def create_image(self, dvi_fn):
-        """Create the image containing the formula, using either dvisvgm or
-        dvipng."""
-        dirname = os.path.dirname(dvi_fn)
+    def _image_fn(self, dvi_fn, image_fn=None):
+        """Return the name of the image file, by default the DVI file name
+        with the extension of the output format."""
+        return (image_fn if image_fn else '%s.%s' % (
+            os.path.splitext(dvi_fn)[0], self.__format.value))
+
+    def _image_command(self, dvi_fn, image_fn=None):
+        """Return the command converting the DVI file into an image, the name
+        of the image file, a function parsing the positioning information
+        from the output of the command and whether the command writes the
+        image to its standard output (see set_pipes)."""
+        output_fn = self._image_fn(dvi_fn, image_fn)
+        dirname = os.path.dirname(output_fn)
         if dirname and not os.path.exists(dirname):
             os.makedirs(dirname)
 
-        output_fn = '%s.%s' % (os.path.splitext(dvi_fn)[0], self.__format.value)
         if self.__format == Format.Png:
-            dpi = (fontsize2dpi(self.__size[1])  if self.__size[1]
-                    else self.__size[0])
-            return create_png(dvi_fn, output_fn,dpi,
-                    self.__background)
+            return (png_command(dvi_fn, output_fn, self.__get_dpi(),
+                self.__background), output_fn, parse_dvipng_output, False)
         if not self.__size[1]:
             self.__size[1] = 12 # 12 pt
-        return create_svg(dvi_fn, output_fn)
+        return (svg_command(dvi_fn, output_fn, self.__pipes), output_fn,
+                parse_dvisvgm_output, self.__pipes)
+
+    def __get_dpi(self):
+        """Return the resolution of PNG images."""
+        return (fontsize2dpi(self.__size[1]) if self.__size[1]
+                else self.__size[0])
+
+    def _variant_commands(self, dvi_fn, image_fn=None):
+        """Return a list of (command, file name) creating the variants of the
+        image of the given DVI file, see get_variants."""
+        output_fn = self._image_fn(dvi_fn, image_fn)
+        if self.__format == Format.Png:
+            return [(png_command(dvi_fn, density_file_name(output_fn, density),
+                        int(round(self.__get_dpi() * density)),
+                        self.__background), density_file_name(output_fn,
+                            density))
+                    for density in self.__densities]
+        return [(png_command(dvi_fn, variant_fn, self.__get_dpi(),
+                    self.__background), variant_fn)
+                for variant_fn in self.get_variants(output_fn).values()]
+
+    def create_dvi(self, tex_document, dvi_fn):
+        """Call LaTeX to produce a dvi file with the given LaTeX document.
+        Temporary files will be removed, even in the case of a LaTeX error.
+        This method raises a SubprocessError with the helpful part of LaTeX's
+        error output."""
+        cmd, path, intermediate, tex = self._prepare_latex(tex_document,
+                dvi_fn)
+        try:
+            proc_call(cmd, cwd=path, install_recommends='texlive-recommended',
+                    tracker=self.__processes, input=tex,
+                    env=self._latex_environment())
+        except ProcessCancelled:
+            remove_all(dvi_fn)
+            raise
+        except subprocess.SubprocessError as e:
+            remove_all(dvi_fn)
+            raise self._latex_error(e) # propagate subprocess error
+        finally:
+            remove_all(*intermediate)
+
+    def create_image(self, dvi_fn, image_fn=None):
+        """Create the image containing the formula, using either dvisvgm or
+        dvipng. The variants of the image (see get_variants) are created from
+        the same DVI file beforehand. The image is named after the DVI file,
+        unless `image_fn` is given, e.g. if the DVI file is kept in a scratch
+        directory."""
+        cmd, output_fn, parse, stdout = self._image_command(dvi_fn, image_fn)
+        variants = self._variant_commands(dvi_fn, image_fn)
+        created = False
+        try:
+            for variant_cmd, _variant_fn in variants:
+                proc_call(variant_cmd, install_recommends='dvipng',
+                        tracker=self.__processes)
+            pos = run_image_command(cmd, dvi_fn, output_fn, parse,
+                    tracker=self.__processes, stdout=stdout)
+            created = True
+            return pos
+        finally:
+            if not created:
+                remove_all(dvi_fn, *(fn for _cmd, fn in variants))
 
     def convert(self, tex_document, base_name):
         """Convert the given TeX document into an image. The base name is used
@@ -215,6 +524,74 @@ class Tex2img:
             return line
         return None
 
+class AsyncTex2img(Tex2img):
+    """Asynchronous counterpart of Tex2img, for the use within an asyncio event
+    loop. LaTeX and the image converters are run as asyncio subprocesses, so
+    neither threads nor a blocked event loop are involved. The methods
+    create_dvi, create_image and convert are coroutines, everything else
+    behaves like in Tex2img.
+    Each subprocess is killed after `timeout` seconds or when the awaiting
+    task is cancelled.
+
+    converter = AsyncTex2img(Format.Svg)
+    pos = await converter.convert(LaTeXDocument('\\tau'), 'img/eqn000')
+    """
+    def __init__(self, fmt, encoding="UTF-8", timeout=20):
+        super().__init__(fmt, encoding)
+        self.__timeout = timeout
+
+    async def create_dvi(self, tex_document, dvi_fn):
+        """See Tex2img.create_dvi."""
+        cmd, path, intermediate, tex = self._prepare_latex(tex_document,
+                dvi_fn)
+        try:
+            await async_proc_call(cmd, cwd=path,
+                    install_recommends='texlive-recommended',
+                    tracker=self._tracker(), timeout=self.__timeout, input=tex,
+                    env=self._latex_environment())
+        except ProcessCancelled:
+            remove_all(dvi_fn)
+            raise
+        except subprocess.SubprocessError as e:
+            remove_all(dvi_fn)
+            raise self._latex_error(e) # propagate subprocess error
+        except asyncio.CancelledError:
+            remove_all(dvi_fn)
+            raise
+        finally:
+            remove_all(*intermediate)
+
+    async def create_image(self, dvi_fn, image_fn=None):
+        """See Tex2img.create_image."""
+        cmd, output_fn, parse, stdout = self._image_command(dvi_fn, image_fn)
+        variants = self._variant_commands(dvi_fn, image_fn)
+        data = None
+        try:
+            for variant_cmd, _variant_fn in variants:
+                await async_proc_call(variant_cmd, install_recommends='dvipng',
+                        tracker=self._tracker(), timeout=self.__timeout)
+            data = await async_proc_call(cmd, install_recommends=('dvipng'
+                    if cmd[0] == 'dvipng' else 'texlive-binaries'),
+                    tracker=self._tracker(), timeout=self.__timeout,
+                    capture=stdout)
+            if stdout:
+                data = write_image(output_fn, *data)
+        except (subprocess.SubprocessError, asyncio.CancelledError):
+            remove_all(output_fn, *(fn for _cmd, fn in variants))
+            raise
+        finally:
+            remove_all(dvi_fn)
+        return parse(data)
+
+    async def convert(self, tex_document, base_name):
+        """See Tex2img.convert."""
+        if not isinstance(tex_document, LaTeXDocument):
+            raise TypeError(("expected object of type typesetting.LaTeXDocument,"
+                    " got %s") % type(tex_document))
+        dvi = '%s.dvi' % base_name
+        await self.create_dvi(tex_document, dvi)
+        return await self.create_image(dvi)
+
 def fontsize2dpi(size_pt):
     """This function calculates the DPI for the resulting image. Depending on
     the font size, a different resolution needs to be used. According to the
@@ -223,32 +600,49 @@ def fontsize2dpi(size_pt):
     size_px = size_pt * 1.3333333 # and more 3s!
     return size_px * 72.27 / 10
 
-def create_png(dvi_fn, output_name, dpi, background):
-    """Create a PNG file from a given dvi file. The side effect is the PNG file
-    being written to disk.
-    By default, the background of the resulting image is transparent, setting
-    any other value will make it use whatever was is set in the DVI file.
-    :param dvi_fn       Dvi file name
-    :param output_name  Output file name
-    :param dpi          Output resolution
-    :param background   Background colour (default: transparent)
-    :return dimensions for embedding into an HTML document
-    :raises ValueError raised whenever dvipng output coudln't be parsed"""
-    if not output_name:
-        raise ValueError("Empty output_name")
-    cmd = ['dvipng', '-q*', '-D', str(dpi)]
-    if background == 'transparent':
-        cmd += ['-bg', background]
-    cmd += ['--height*', '--depth*', '--width*', # print information for embedding
-            '-o', output_name, dvi_fn]
+def write_image(output_name, image, messages):
+    """Write an image, read from the standard output of a converter, to the
+    given file and return the messages of the converter."""
+    with open(output_name, 'wb') as image_file:
+        image_file.write(image)
+    return messages
+
+#pylint: disable=too-many-arguments
+def run_image_command(cmd, dvi_fn, output_name, parse, tracker=None,
+        stdout=False):
+    """Run a DVI to image converter command (see png_command and svg_command),
+    remove the DVI file and return the positioning information, as parsed by
+    `parse` from the output of the command. The output file is removed if the
+    conversion failed. If `stdout` is set, the command writes the image to its
+    standard output and it is written to the output file from there."""
     data = None
     try:
-        data = proc_call(cmd, install_recommends='dvipng')
+        data = proc_call(cmd, install_recommends=('dvipng'
+                if cmd[0] == 'dvipng' else 'texlive-binaries'), tracker=tracker,
+                capture=stdout)
+        if stdout:
+            data = write_image(output_name, *data)
     except subprocess.SubprocessError:
         remove_all(output_name)
         raise
     finally:
         remove_all(dvi_fn)
+    return parse(data)
+
+def png_command(dvi_fn, output_name, dpi, background):
+    """Return the dvipng command to convert the given DVI file, see
+    create_png."""
+    if not output_name:
+        raise ValueError("Empty output_name")
+    cmd = ['dvipng', '-q*', '-D', str(dpi)]
+    if background == 'transparent':
+        cmd += ['-bg', background]
+    return cmd + ['--height*', '--depth*', '--width*', # print information for embedding
+            '-o', output_name, dvi_fn]
+
+def parse_dvipng_output(data):
+    """Parse the positioning information from the output of dvipng.
+    :raises ValueError raised whenever dvipng output coudln't be parsed"""
     for line in data.split('\n'):
         found = DVIPNG_REGEX.search(line)
         if found:
@@ -256,26 +650,34 @@ def create_png(dvi_fn, output_name, dpi, background):
                 map(float, found.groups())))
     raise ValueError("Could not parse dvi output: " + repr(data))
 
-def create_svg(dvi_fn, output_name):
-    """Create a SVG file from a given dvi file. The side effect is the SVG file
+def create_png(dvi_fn, output_name, dpi, background, tracker=None):
+    """Create a PNG file from a given dvi file. The side effect is the PNG file
     being written to disk.
+    By default, the background of the resulting image is transparent, setting
+    any other value will make it use whatever was is set in the DVI file.
     :param dvi_fn       Dvi file name
     :param output_name  Output file name
-    :param size         font size in pt
+    :param dpi          Output resolution
+    :param background   Background colour (default: transparent)
+    :param tracker      optional ProcessTracker for the dvipng process
     :return dimensions for embedding into an HTML document
     :raises ValueError raised whenever dvipng output coudln't be parsed"""
+    return run_image_command(png_command(dvi_fn, output_name, dpi, background),
+            dvi_fn, output_name, parse_dvipng_output, tracker=tracker)
+
+def svg_command(dvi_fn, output_name, stdout=False):
+    """Return the dvisvgm command to convert the given DVI file, see
+    create_svg. If `stdout` is set, dvisvgm writes the image to its standard
+    output instead of the output file."""
     if not output_name:
         raise ValueError("Empty output_name")
-    cmd = ['dvisvgm', '--exact', '--no-fonts', '-o', output_name,
+    output = (['--stdout'] if stdout else ['-o', output_name])
+    return ['dvisvgm', '--exact', '--no-fonts'] + output + [
             '--bbox=preview', dvi_fn, '--libgs=/usr/lib/libgs.so.9']
-    data = None
-    try:
-        data = proc_call(cmd, install_recommends='texlive-binaries')
-    except subprocess.SubprocessError:
-        remove_all(output_name)
-        raise
-    finally:
-        remove_all(dvi_fn)
+
+def parse_dvisvgm_output(data):
+    """Parse the positioning information from the output of dvisvgm.
+    :raises ValueError raised whenever dvisvgm output coudln't be parsed"""
     pos = {}
     for line in data.split('\n'):
         if not pos:
@@ -291,3 +693,14 @@ def create_svg(dvi_fn, output_name):
                                     (float(v) * 1.3333333 for v in found.groups()))))
                 return pos
     raise ValueError("Could not parse dvisvgm output: " + repr(data))
+
+def create_svg(dvi_fn, output_name, tracker=None):
+    """Create a SVG file from a given dvi file. The side effect is the SVG file
+    being written to disk.
+    :param dvi_fn       Dvi file name
+    :param output_name  Output file name
+    :param tracker      optional ProcessTracker for the dvisvgm process
+    :return dimensions for embedding into an HTML document
+    :raises ValueError raised whenever dvipng output coudln't be parsed"""
+    return run_image_command(svg_command(dvi_fn, output_name), dvi_fn,
+            output_name, parse_dvisvgm_output, tracker=tracker)
@@ -0,0 +1,596 @@
+# (c) 2013-2019 Sebastian Humenda
+# This code is licenced under the terms of the LGPL-3+, see the file COPYING for
+# more details.
+"""Optimize the images created by the converters.
+
+dvisvgm writes SVG images with generator comments, coordinates with more
+precision than a screen can show and groups without any effect. The
+ImageOptimizer post-processes each image right after it has been created, in
+the worker thread which created it:
+
+    optimizer = ImageOptimizer()
+    optimizer.set_minify_svg(2) # round coordinates to two decimal places
+    converter.set_optimizer(optimizer) # see CachedConverter.set_optimizer
+    ...
+    files, before, after = optimizer.get_statistics()
+
+The SVG minifier works on the stream of tags of a document, it does not build a
+document tree. PNG images, as created by dvipng, are re-encoded with a better
+choice of filters and compression and converted to indexed colours if this is
+lossless; this only requires zlib.
+
+For web servers serving precompressed files (e.g. nginx with `gzip_static`),
+the optimizer can write a gzip-compressed copy next to each SVG image, see
+ImageOptimizer.set_precompress_svg."""
+
+import gzip
+import os
+import re
+import struct
+import threading
+import zlib
+
+# tags, comments, processing instructions and text of an XML document
+SVG_TOKEN = re.compile(r'<!--.*?-->|<\?.*?\?>|<!DOCTYPE[^>]*>|'
+        r'<!\[CDATA\[.*?\]\]>|<[^>]+>|[^<]+', re.DOTALL)
+# start or end tag: (slash of end tag, name, attributes, slash of empty tag)
+SVG_TAG = re.compile(r'<(/?)\s*([^\s/>]+)(.*?)(/?)\s*>$', re.DOTALL)
+SVG_ATTRIBUTE = re.compile(r"""([^\s=]+)\s*=\s*(['"])(.*?)\2""", re.DOTALL)
+NUMBER = re.compile(r'-?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+# commands of path data
+PATH_COMMANDS = 'MmZzLlHhVvCcSsQqTtAa'
+# references to identifiers, via href or url()
+SVG_REFERENCE = re.compile(r"""#([^'")\s]+)""")
+# transform functions of a transform attribute: (name, arguments)
+TRANSFORM_FUNCTION = re.compile(r'\s*([a-zA-Z]+)\s*\(([^)]*)\)[\s,]*')
+# arguments of transform functions without any effect, by function name
+IDENTITY_ARGUMENTS = {'translate': ([0], [0, 0]), 'scale': ([1], [1, 1]),
+        'rotate': ([0], [0, 0, 0]), 'skewX': ([0],), 'skewY': ([0],),
+        'matrix': ([1, 0, 0, 1, 0, 0],)}
+
+# attributes holding coordinates or lengths
+NUMERIC_ATTRIBUTES = {'d', 'x', 'y', 'x1', 'y1', 'x2', 'y2', 'cx', 'cy', 'r',
+        'rx', 'ry', 'dx', 'dy', 'width', 'height', 'viewBox', 'points',
+        'transform', 'stroke-width'}
+# elements which are removed with their content
+METADATA_ELEMENTS = {'metadata'}
+# elements in which whitespace is significant
+TEXT_ELEMENTS = {'text', 'tspan', 'textPath', 'style', 'title', 'desc'}
+# elements accepting the transform of a group wrapping them
+TRANSFORMABLE_ELEMENTS = {'g', 'path', 'use', 'rect', 'circle', 'ellipse',
+        'line', 'polyline', 'polygon', 'text', 'image'}
+
+def format_number(number, precision):
+    """Format a number with at most `precision` decimal places, without
+    trailing zeros."""
+    formatted = ('%.*f' % (precision, float(number))).rstrip('0').rstrip('.')
+    return ('0' if formatted in ('-0', '') else formatted)
+
+def round_numbers(value, precision):
+    """Round all numbers in an attribute value, e.g. path data, to the given
+    precision. Numbers which were only separated by their decimal point, e.g.
+    in `1.5.5`, are separated by a space afterwards."""
+    def replace(match):
+        number = format_number(match.group(), precision)
+        start = match.start()
+        if start and value[start - 1] in '0123456789.' and \
+                not number.startswith('-'):
+            return ' ' + number
+        return number
+    return NUMBER.sub(replace, value)
+
+def round_path(value, precision):
+    """Round all numbers of path data (the `d` attribute) like round_numbers.
+    The large-arc and sweep flags of elliptical arcs are single digits which
+    may be written without separators, e.g. `a5 5 0 011 10 10`; these are
+    copied as they are instead of being read as one number."""
+    output = []
+    pos = 0
+    command, index = '', 0 # index of the next parameter of the command
+    while pos < len(value):
+        char = value[pos]
+        if char in PATH_COMMANDS:
+            command, index = char, 0
+        elif command in ('A', 'a') and index % 7 in (3, 4) and char in '01':
+            index += 1
+        else:
+            match = NUMBER.match(value, pos)
+            if match:
+                number = format_number(match.group(), precision)
+                if output and output[-1][-1] in '0123456789.' and \
+                        not number.startswith('-'):
+                    output.append(' ')
+                output.append(number)
+                index += 1
+                pos = match.end()
+                continue
+        output.append(char)
+        pos += 1
+    return ''.join(output)
+
+def merge_transforms(value, precision):
+    """Simplify a transform attribute value: adjacent translations are added
+    up and transform functions without any effect are removed. The numbers
+    are rounded to `precision` decimal places. Values which cannot be parsed
+    are only rounded."""
+    functions = []
+    pos = 0
+    for match in TRANSFORM_FUNCTION.finditer(value):
+        if match.start() != pos:
+            break
+        pos = match.end()
+        name = match.group(1)
+        arguments = [float(number) for number in NUMBER.findall(
+            match.group(2))]
+        if name == 'translate' and len(arguments) == 1:
+            arguments.append(0.0)
+        if arguments in IDENTITY_ARGUMENTS.get(name, ()):
+            continue
+        if name == 'translate' and functions and functions[-1][0] == name:
+            arguments = [a + b for a, b in zip(functions.pop()[1], arguments)]
+        functions.append((name, arguments))
+    if pos != len(value):
+        return round_numbers(value, precision)
+    functions = [(name, arguments) for name, arguments in functions
+            if arguments not in IDENTITY_ARGUMENTS.get(name, ())]
+    return ' '.join('%s(%s)' % (name, ' '.join(format_number(argument,
+            precision) for argument in arguments))
+            for name, arguments in functions)
+
+def get_children(tokens):
+    """Return a dictionary mapping the index of each start tag in the given
+    tokens (see minify_svg) to the names of the child elements and whether
+    the element contains text other than whitespace."""
+    children = {}
+    open_elements = [] # indices of the start tags of the open elements
+    for index, token in enumerate(tokens):
+        if token.startswith(('<!--', '<?', '<!DOCTYPE')):
+            continue
+        tag = (SVG_TAG.match(token) if token.startswith('<') and
+                not token.startswith('<![CDATA[') else None)
+        if not tag:
+            if open_elements and token.strip():
+                children[open_elements[-1]][1] = True
+            continue
+        end, name, _attributes, empty = tag.groups()
+        if end:
+            if open_elements:
+                open_elements.pop()
+            continue
+        if open_elements:
+            children[open_elements[-1]][0].append(name)
+        children[index] = [[], False]
+        if not empty:
+            open_elements.append(index)
+    return children
+
+def minify_svg(document, precision=3):
+    """Minify an SVG document (string): remove comments, the XML declaration,
+    metadata and whitespace between tags, round coordinates to `precision`
+    decimal places and simplify transformations (see merge_transforms). Groups
+    without attributes are unwrapped; groups with only a transformation are
+    unwrapped if they contain a single element, which then takes the
+    transformation. Identifiers of groups are removed if they are not
+    referenced. Return the minified document."""
+    tokens = SVG_TOKEN.findall(document)
+    referenced = set(SVG_REFERENCE.findall(' '.join(token for token in tokens
+            if token.startswith('<') and '#' in token)))
+    children = get_children(tokens)
+    output = []
+    # for each open element: (name, whether its end tag is written)
+    open_elements = []
+    # transformations of unwrapped groups, for the next element written
+    transforms = []
+    skipped = 0 # depth within removed elements
+    for index, token in enumerate(tokens):
+        if token.startswith(('<!--', '<?', '<!DOCTYPE')):
+            continue
+        if not token.startswith('<') or token.startswith('<![CDATA['):
+            in_text = any(name in TEXT_ELEMENTS for name, _ in open_elements)
+            if not skipped and (in_text or token.strip()):
+                output.append(token)
+            continue
+        tag = SVG_TAG.match(token)
+        if not tag:
+            output.append(token)
+            continue
+        end, name, attributes, empty = tag.groups()
+        if end:
+            if open_elements:
+                name, written = open_elements.pop()
+                if skipped:
+                    skipped -= 1
+                elif written:
+                    output.append('</%s>' % name)
+                elif name == 'g' and transforms: # element has been removed
+                    transforms.pop()
+            continue
+        if skipped or name in METADATA_ELEMENTS:
+            if not empty:
+                skipped += 1
+                open_elements.append((name, False))
+            continue
+        attributes = minify_attributes(name, attributes, referenced, precision)
+        if transforms: # take the transformation of the unwrapped groups
+            own = [value for key, value in attributes if key == 'transform']
+            attributes = [(key, value) for key, value in attributes
+                    if key != 'transform']
+            transform = merge_transforms(' '.join(transforms + own),
+                    precision)
+            if transform:
+                attributes.append(('transform', transform))
+            del transforms[:]
+        if name == 'g' and not attributes: # group without any effect
+            if not empty:
+                open_elements.append((name, False))
+            continue
+        elements, text = children[index]
+        if name == 'g' and len(elements) == 1 and not text and \
+                elements[0] in TRANSFORMABLE_ELEMENTS and \
+                [key for key, _value in attributes] == ['transform']:
+            transforms.append(attributes[0][1])
+            open_elements.append((name, False))
+            continue
+        output.append('<%s%s%s>' % (name, ''.join(" %s=%s" % (key,
+                quote_attribute(value)) for key, value in attributes),
+                ('/' if empty else '')))
+        if not empty:
+            open_elements.append((name, True))
+    return ''.join(output)
+
+def minify_attributes(name, attributes, referenced, precision):
+    """Return the minified attributes of an element as a list of (name,
+    value), see minify_svg."""
+    minified = []
+    for key, _quote, value in SVG_ATTRIBUTE.findall(attributes):
+        if key == 'id' and name == 'g' and value not in referenced:
+            continue
+        if key == 'transform':
+            value = merge_transforms(value, precision)
+            if not value: # without any effect
+                continue
+        elif key == 'd':
+            value = round_path(value, precision)
+        elif key in NUMERIC_ATTRIBUTES:
+            value = round_numbers(value, precision)
+        minified.append((key, value))
+    return minified
+
+def quote_attribute(value):
+    """Quote an attribute value, preferring single quotes like dvisvgm."""
+    return ("'%s'" % value if "'" not in value else '"%s"' % value)
+
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# number of samples per pixel of each PNG colour type
+PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+# ancillary chunks kept when re-encoding a PNG image, all others are dropped
+PNG_KEPT_CHUNKS = (b'gAMA', b'cHRM', b'sRGB', b'iCCP', b'pHYs')
+
+def read_png_chunks(data):
+    """Return the chunks of a PNG image as a list of (type, data)."""
+    if not data.startswith(PNG_SIGNATURE):
+        raise ValueError("not a PNG image")
+    chunks = []
+    pos = len(PNG_SIGNATURE)
+    while pos + 8 <= len(data):
+        length, kind = struct.unpack('>I4s', data[pos:pos + 8])
+        chunks.append((kind, data[pos + 8:pos + 8 + length]))
+        pos += length + 12 # length, type, data, CRC
+        if kind == b'IEND':
+            break
+    return chunks
+
+def write_png_chunk(kind, data):
+    """Return a PNG chunk with the given type and data."""
+    return (struct.pack('>I', len(data)) + kind + data +
+            struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+def paeth(left, up, up_left):
+    """The Paeth predictor of the PNG specification."""
+    estimate = left + up - up_left
+    distances = (abs(estimate - left), abs(estimate - up),
+            abs(estimate - up_left))
+    if distances[0] <= distances[1] and distances[0] <= distances[2]:
+        return left
+    return (up if distances[1] <= distances[2] else up_left)
+
+def unfilter_rows(data, height, stride, bpp):
+    """Reverse the filtering of the rows of a decompressed PNG image. `stride`
+    is the number of bytes of a row, `bpp` the number of bytes per pixel (at
+    least 1)."""
+    rows = []
+    previous = bytearray(stride)
+    pos = 0
+    for _ in range(height):
+        kind, row = data[pos], bytearray(data[pos + 1:pos + 1 + stride])
+        pos += stride + 1
+        if len(row) != stride:
+            raise ValueError("truncated PNG image data")
+        for i in range(stride):
+            left = (row[i - bpp] if i >= bpp else 0)
+            if kind == 1:
+                row[i] = (row[i] + left) & 0xff
+            elif kind == 2:
+                row[i] = (row[i] + previous[i]) & 0xff
+            elif kind == 3:
+                row[i] = (row[i] + ((left + previous[i]) >> 1)) & 0xff
+            elif kind == 4:
+                row[i] = (row[i] + paeth(left, previous[i],
+                    (previous[i - bpp] if i >= bpp else 0))) & 0xff
+            elif kind != 0:
+                raise ValueError("unknown PNG filter type %d" % kind)
+        rows.append(row)
+        previous = row
+    return rows
+
+def filter_row(kind, row, previous, bpp):
+    """Apply the PNG filter of the given type to a row."""
+    filtered = bytearray(len(row))
+    for i, value in enumerate(row):
+        left = (row[i - bpp] if i >= bpp else 0)
+        if kind == 0:
+            predicted = 0
+        elif kind == 1:
+            predicted = left
+        elif kind == 2:
+            predicted = previous[i]
+        elif kind == 3:
+            predicted = (left + previous[i]) >> 1
+        else:
+            predicted = paeth(left, previous[i],
+                    (previous[i - bpp] if i >= bpp else 0))
+        filtered[i] = (value - predicted) & 0xff
+    return filtered
+
+def encode_rows(rows, bpp, adaptive):
+    """Filter the given rows and return the filtered image data (without
+    compression). If `adaptive` is set, the filter of each row is chosen by
+    the minimum sum of absolute differences, as recommended by the PNG
+    specification; otherwise no filter is used."""
+    encoded = bytearray()
+    previous = bytearray(len(rows[0]) if rows else 0)
+    for row in rows:
+        if adaptive:
+            candidates = [(kind, filter_row(kind, row, previous, bpp))
+                    for kind in range(5)]
+            kind, filtered = min(candidates, key=lambda candidate: sum(
+                (value if value < 128 else 256 - value)
+                for value in candidate[1]))
+        else:
+            kind, filtered = 0, row
+        encoded.append(kind)
+        encoded += filtered
+        previous = row
+    return bytes(encoded)
+
+def unpack_samples(row, depth, count):
+    """Return the first `count` samples of a row with the given bit depth."""
+    if depth == 8:
+        return list(row[:count])
+    per_byte = 8 // depth
+    mask = (1 << depth) - 1
+    return [(row[i // per_byte] >> (8 - depth * (i % per_byte + 1))) & mask
+            for i in range(count)]
+
+def pack_samples(samples, depth):
+    """Pack samples with the given bit depth into a row of bytes."""
+    if depth == 8:
+        return bytearray(samples)
+    per_byte = 8 // depth
+    packed = bytearray((len(samples) + per_byte - 1) // per_byte)
+    for i, sample in enumerate(samples):
+        packed[i // per_byte] |= sample << (8 - depth * (i % per_byte + 1))
+    return packed
+
+def png_pixels(header, rows, chunks):
+    """Return the pixels of the given unfiltered rows as lists of RGBA tuples.
+    `header` is (width, height, bit depth, colour type), `chunks` the chunks
+    of the image, for the palette and transparency information. Raise
+    ValueError, KeyError or IndexError for a missing or malformed palette."""
+    width, _height, depth, color_type = header
+    chunks = dict(chunks)
+    transparency = chunks.get(b'tRNS', b'')
+    scale = 255 // ((1 << depth) - 1)
+    if color_type == 3:
+        palette = chunks[b'PLTE']
+        if not palette or len(palette) % 3:
+            raise ValueError("malformed PNG palette")
+        colors = [tuple(palette[i:i + 3]) + (transparency[i // 3]
+                if i // 3 < len(transparency) else 255,)
+                for i in range(0, len(palette), 3)]
+    pixels = []
+    for row in rows:
+        samples = unpack_samples(row, depth, width * PNG_CHANNELS[color_type])
+        if color_type == 3:
+            pixels.append([colors[index] for index in samples])
+        elif color_type == 0:
+            key = (struct.unpack('>H', transparency)[0] if transparency
+                    else None)
+            pixels.append([(value * scale,) * 3 + (0 if value == key else 255,)
+                for value in samples])
+        elif color_type == 2:
+            key = (struct.unpack('>3H', transparency) if transparency
+                    else None)
+            pixels.append([tuple(samples[i:i + 3]) + (0
+                if tuple(samples[i:i + 3]) == key else 255,)
+                for i in range(0, len(samples), 3)])
+        elif color_type == 4:
+            pixels.append([(samples[i],) * 3 + (samples[i + 1],)
+                for i in range(0, len(samples), 2)])
+        else:
+            pixels.append([tuple(samples[i:i + 4])
+                for i in range(0, len(samples), 4)])
+    return pixels
+
+def decode_png(data):
+    """Decode a PNG image. Return a tuple (header, rows, chunks): the header is
+    (width, height, bit depth, colour type), rows are the unfiltered image
+    rows and chunks the list of (type, data) of the image. Raise ValueError for
+    interlaced images and images with 16 bits per sample."""
+    chunks = read_png_chunks(data)
+    if not chunks or chunks[0][0] != b'IHDR':
+        raise ValueError("PNG image without header")
+    width, height, depth, color_type, _compression, _filter, interlace = \
+            struct.unpack('>IIBBBBB', chunks[0][1])
+    if interlace or depth > 8 or color_type not in PNG_CHANNELS or \
+            (depth < 8 and color_type not in (0, 3)):
+        raise ValueError("unsupported PNG image")
+    bits = PNG_CHANNELS[color_type] * depth
+    stride = (width * bits + 7) // 8
+    image_data = zlib.decompress(b''.join(data for kind, data in chunks
+            if kind == b'IDAT'))
+    rows = unfilter_rows(image_data, height, stride, max(1, bits // 8))
+    return ((width, height, depth, color_type), rows, chunks)
+
+def optimize_png(data):
+    """Re-encode a PNG image: convert it to indexed colours if it has at most
+    256 distinct colours (including transparency), choose the filters and
+    compression strategy which produce the smallest image and drop all chunks
+    not required for displaying it. The image is returned unaltered if it
+    cannot be made smaller or if its format is not supported, see
+    decode_png."""
+    try:
+        header, rows, chunks = decode_png(data)
+        pixels = png_pixels(header, rows, chunks)
+    except (ValueError, KeyError, IndexError, zlib.error, struct.error):
+        return data
+    width, height, depth, color_type = header
+    colors = {}
+    for row in pixels:
+        for pixel in row:
+            if pixel not in colors:
+                colors[pixel] = None
+                if len(colors) > 256:
+                    break
+        if len(colors) > 256:
+            break
+    extra = [] # PLTE and tRNS chunks
+    if len(colors) <= 256:
+        # transparent colours first, to keep the tRNS chunk short
+        palette = sorted(colors, key=lambda color: color[3] == 255)
+        indices = {color: index for index, color in enumerate(palette)}
+        depth = next(d for d in (1, 2, 4, 8) if len(palette) <= 1 << d)
+        color_type, bpp = 3, 1
+        rows = [pack_samples([indices[pixel] for pixel in row], depth)
+                for row in pixels]
+        extra.append((b'PLTE', b''.join(bytes(color[:3])
+            for color in palette)))
+        alphas = bytes(color[3] for color in palette if color[3] != 255)
+        if alphas:
+            extra.append((b'tRNS', alphas))
+    else: # keep the colour type, only re-encode
+        bpp = max(1, PNG_CHANNELS[color_type] * depth // 8)
+        extra.extend((kind, chunk) for kind, chunk in chunks
+                if kind in (b'PLTE', b'tRNS'))
+    compressed = min((compress(filtered, strategy)
+            for filtered in (encode_rows(rows, bpp, False),
+                encode_rows(rows, bpp, True))
+            for strategy in (zlib.Z_DEFAULT_STRATEGY, zlib.Z_FILTERED)),
+            key=len)
+    optimized = PNG_SIGNATURE + write_png_chunk(b'IHDR', struct.pack(
+        '>IIBBBBB', width, height, depth, color_type, 0, 0, 0))
+    optimized += b''.join(write_png_chunk(kind, chunk) for kind, chunk
+            in chunks if kind in PNG_KEPT_CHUNKS)
+    optimized += b''.join(write_png_chunk(kind, chunk)
+            for kind, chunk in extra)
+    optimized += write_png_chunk(b'IDAT', compressed)
+    optimized += write_png_chunk(b'IEND', b'')
+    return (optimized if len(optimized) < len(data) else data)
+
+def compress(data, strategy):
+    """Compress data with zlib at the highest level and the given strategy."""
+    compressor = zlib.compressobj(9, zlib.DEFLATED, zlib.MAX_WBITS, 9,
+            strategy)
+    return compressor.compress(data) + compressor.flush()
+
+
+class ImageOptimizer:
+    """Optimize image files after their creation, see the module
+    documentation. All optimizations are disabled by default. The optimizer
+    may be used from several threads at the same time."""
+    def __init__(self):
+        self.__svg_precision = None
+        self.__png = False
+        self.__precompress = False
+        self.__statistics = [0, 0, 0] # files, bytes before, bytes after
+        self.__lock = threading.Lock()
+
+    def set_minify_svg(self, precision):
+        """Minify SVG images and round their coordinates to the given number
+        of decimal places, see minify_svg. None disables the minification."""
+        if precision is not None and precision < 0:
+            raise ValueError("precision must not be negative")
+        self.__svg_precision = precision
+
+    def set_optimize_png(self, flag):
+        """Re-encode PNG images with better compression and indexed colours,
+        if possible, see optimize_png."""
+        self.__png = flag
+
+    def set_precompress_svg(self, flag):
+        """Write a gzip-compressed copy of each (optimized) SVG image next to
+        it, with `.gz` appended to its file name."""
+        self.__precompress = flag
+
+    def is_enabled(self):
+        """Return whether any optimization is enabled."""
+        return self.__svg_precision is not None or self.__png or \
+                self.__precompress
+
+    def optimize(self, path):
+        """Optimize the given image file in place. The file is only rewritten
+        if it became smaller. Return a tuple (size before, size after)."""
+        with open(path, 'rb') as image_file:
+            data = image_file.read()
+        optimized = data
+        if path.lower().endswith('.svg') and self.__svg_precision is not None:
+            optimized = minify_svg(data.decode('utf-8'),
+                    self.__svg_precision).encode('utf-8')
+        elif path.lower().endswith('.png') and self.__png:
+            optimized = optimize_png(data)
+        if len(optimized) < len(data):
+            with open(path, 'wb') as image_file:
+                image_file.write(optimized)
+        else:
+            optimized = data
+        if path.lower().endswith('.svg') and self.__precompress:
+            write_gzip(path + '.gz', optimized)
+        with self.__lock:
+            self.__statistics[0] += 1
+            self.__statistics[1] += len(data)
+            self.__statistics[2] += len(optimized)
+        return (len(data), len(optimized))
+
+    def precompress(self, path):
+        """Write the gzip-compressed copy of an existing SVG image, e.g. of a
+        cached image created without it, if precompression is enabled and the
+        copy is missing or older than the image. Return whether it was
+        written."""
+        if not self.__precompress or not path.lower().endswith('.svg'):
+            return False
+        try:
+            if os.path.getmtime(path + '.gz') >= os.path.getmtime(path):
+                return False
+        except FileNotFoundError:
+            pass
+        with open(path, 'rb') as image_file:
+            write_gzip(path + '.gz', image_file.read())
+        return True
+
+    def get_statistics(self):
+        """Return a tuple (number of optimized files, total bytes before,
+        total bytes after)."""
+        with self.__lock:
+            return tuple(self.__statistics)
+
+def write_gzip(path, data):
+    """Write data gzip-compressed to the given file. The file is replaced
+    atomically, so that a web server never serves a partial file, and it does
+    not contain a time stamp, so that it only changes with its content."""
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as raw_file:
+        with gzip.GzipFile(os.path.basename(path)[:-3], 'wb', 9, raw_file,
+                mtime=0) as gzip_file:
+            gzip_file.write(data)
+    os.replace(temporary, path)
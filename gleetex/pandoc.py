@@ -47,8 +47,10 @@ def replace_formulas_in_ast(formatter, ast, formulas):
     Each 'Math' element found in the Pandoc AST will be replaced through a
     formatted (HTML) image link. The formulas are taken from the supplied
     formulas list. The number of formulas in the document has to match the
-    number of formulas form the list."""
-    if not formulas:
+    number of formulas form the list.
+    `formulas` may also be an iterator, which is then only consumed as far as
+    formulas are found in `ast`, see write_pandoc_ast."""
+    if isinstance(formulas, list) and not formulas:
         return
     if isinstance(ast, list):
         for item in ast:
@@ -56,9 +58,10 @@ def replace_formulas_in_ast(formatter, ast, formulas):
     elif isinstance(ast, dict):
         if 't' in ast and ast['t'] == 'Math':
             ast['t'] = 'RawInline' # raw HTML
-            eqn = formulas.pop(0)
+            eqn = (formulas.pop(0) if isinstance(formulas, list)
+                    else next(formulas))
             ast['c'] = ['html',formatter.format(eqn['pos'], eqn['formula'], eqn['path'],
-                    eqn['displaymath'])]
+                    eqn['displaymath'], eqn.get('variants'))]
         elif 'c' in ast:
             replace_formulas_in_ast(formatter, ast['c'], formulas)
     # ^ ignore all other cases
@@ -66,10 +69,20 @@ def replace_formulas_in_ast(formatter, ast, formulas):
 def write_pandoc_ast(file, document, formatter):
     """Replace 'Math' elements from a Pandoc AST with 'RawInline' elements,
     containing formatted HTML image tags.
+    The document is written block by block. `formulas` may be an iterator
+    (e.g. from CachedConverter.convert_iter), so that a block is written as
+    soon as the formulas it contains are available.
     :param formatter    A formatter offering the "format" method (see ImageFormatter)
-    :param formulas     A list of formulas with the information (pos, formula, path, displaymath)
-    :param ast          Document ast to modified"""
+    :param document     A tuple of (ast, formulas), where ast is the document
+                        AST to modify and formulas an iterable of formula
+                        information (pos, formula, path, displaymath) in
+                        document order"""
     ast, formulas = document
-    replace_formulas_in_ast(formatter, ast['blocks'], formulas)
-    file.write(json.dumps(ast))
-
+    formulas = iter(formulas)
+    head = json.dumps({key: value for key, value in ast.items()
+            if key != 'blocks'})
+    file.write(head[:-1] + (', ' if len(head) > 2 else '') + '"blocks": [')
+    for index, block in enumerate(ast['blocks']):
+        replace_formulas_in_ast(formatter, block, formulas)
+        file.write((', ' if index else '') + json.dumps(block))
+    file.write(']}')
@@ -10,6 +10,7 @@ and hence document in their respective functions."""
 
 import enum
 import json
+import mmap
 import sys
 
 from . import htmlhandling
@@ -32,7 +33,7 @@ class Format(enum.Enum):
         else:
             raise ValueError("unrecognised format: %s" % string)
 
-def parse_document(doc, fmt):
+def parse_document(doc, fmt, lazy=False):
     """This function parses an input document (string or bytes) with the given
     format specifier. For HTML, the returned "parsed" document is a list of
     chunks, where raw chunks are just plain HTML instructions and data and
@@ -40,19 +41,38 @@ def parse_document(doc, fmt):
     If the input document is a pandoc AST, the formulas will be extracted and
     the document is a tuple of (pandoc AST, formulas).
 
-    :param doc  input of bytes or string to parse
+    If `lazy` is set, the chunks of an HTML document are returned as a
+    generator, which parses the document while it is consumed. Parse errors
+    are then raised by the generator. An HTML document may also be given as
+    an open file, which is then read block by block while parsing, see
+    EqnParser.feed_stream, or as a memory-mapped file (mmap.mmap), which is
+    parsed without decoding it, see EqnParser.feed_buffer.
+
+    :param doc  input of bytes or string (or a file object for HTML) to parse
     :param fmt  either the enum type `Format` or a string understood by Format.parse
+    :param lazy return a generator for HTML documents instead of a list
     :return     (encoding, document) (a tuple)"""
     if isinstance(fmt, str):
         fmt = Format.parse(fmt)
     encoding = None
     if fmt == Format.HTML:
         docparser = htmlhandling.EqnParser()
-        docparser.feed(doc)
+        if isinstance(doc, mmap.mmap):
+            doc = docparser.feed_buffer(doc)
+            doc = (doc if lazy else list(doc))
+        elif hasattr(doc, 'read'):
+            doc = docparser.feed_stream(doc)
+            doc = (doc if lazy else list(doc))
+        elif lazy:
+            doc = docparser.feed_iter(doc)
+        else:
+            docparser.feed(doc)
+            doc = docparser.get_data()
         encoding = docparser.get_encoding()
         encoding = (encoding if encoding else 'utf-8')
-        doc = docparser.get_data()
     elif fmt == Format.PANDOCFILTER:
+        if hasattr(doc, 'read'):
+            doc = doc.read()
         if isinstance(doc, bytes):
             doc = doc.decode(sys.getdefaultencoding())
         ast = json.loads(doc)
@@ -0,0 +1,191 @@
+# (c) 2013-2019 Sebastian Humenda
+# This code is licenced under the terms of the LGPL-3+, see the file COPYING for
+# more details.
+"""The creation of a formula image is a two-step process: LaTeX typesets the
+formula into a DVI file and dvisvgm (or dvipng) converts this DVI file into the
+final image. Both steps have very different run times, dvisvgm with Ghostscript
+is usually a lot slower than LaTeX.
+
+This module provides a pipeline with a separate pool of worker threads for each
+of the two stages. Finished intermediate results (the DVI files) are passed
+through a bounded queue to the second stage, so that the first stage is slowed
+down whenever the second stage cannot keep up."""
+
+import itertools
+import queue
+import threading
+
+# marks the end of the input for a worker thread
+_STOP = object()
+# marks a job which has been dropped after the pipeline was cancelled
+_DROPPED = object()
+# wakes up the consumer of the results when the pipeline is closed
+_CLOSED = object()
+
+class RenderPipeline:
+    """RenderPipeline(first_stage, second_stage, first_workers=1,
+            second_workers=1, queue_size=None)
+    Run jobs through two stages, each with its own pool of worker threads.
+
+    `first_stage` is called with a job and its return value is passed, along
+    with the job, to `second_stage`. The return value of the second stage is
+    the result of the job. At most `queue_size` intermediate results wait for
+    the second stage (default: twice the number of second-stage workers).
+    The optional `discard` callable is called with (job, intermediate) for each
+    intermediate result which is not processed because of a cancellation, e.g.
+    to remove intermediate files. The optional `on_cancel` callable is called
+    without arguments when the pipeline is cancelled; it should abort the jobs
+    currently running, e.g. by terminating their subprocesses.
+
+    Example:
+
+    with RenderPipeline(create_dvi, create_image, 4, 6) as pipeline:
+        for job in jobs:
+            pipeline.submit(job)
+        pipeline.close()
+        for job, result, exception in pipeline.results():
+            ...
+
+    Exceptions raised by a stage are not propagated, they are returned as the
+    third item of the tuple yielded by `results()`.
+    Jobs are started in order of their priority, see `submit()`."""
+    #pylint: disable=too-many-arguments,too-many-instance-attributes
+    def __init__(self, first_stage, second_stage, first_workers=1,
+            second_workers=1, queue_size=None, discard=None, on_cancel=None):
+        if first_workers < 1 or second_workers < 1:
+            raise ValueError("at least one worker per stage required")
+        self.__stages = (first_stage, second_stage)
+        self.__discard = discard
+        self.__on_cancel = on_cancel
+        self.__jobs = queue.PriorityQueue()
+        self.__sequence = itertools.count() # keeps order for equal priorities
+        self.__intermediate = queue.Queue(maxsize=(queue_size if queue_size
+                else 2 * second_workers))
+        self.__results = queue.Queue()
+        self.__lock = threading.Lock()
+        self.__submitted = 0
+        self.__closed = False
+        self.__cancelled = False
+        self.__first_running = first_workers
+        self.__threads = [threading.Thread(target=self.__first_worker,
+                    daemon=True) for _ in range(first_workers)]
+        self.__second_threads = [threading.Thread(target=self.__second_worker,
+                    daemon=True) for _ in range(second_workers)]
+        for thread in self.__threads + self.__second_threads:
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            self.cancel()
+        self.close()
+        self.join()
+
+    def submit(self, job, priority=0):
+        """Queue a job for processing. Jobs with a higher priority are started
+        first, jobs with the same priority in order of submission. Jobs may be
+        submitted from another thread while the results are consumed. Jobs
+        submitted after `cancel()` are dropped right away."""
+        with self.__lock:
+            if self.__closed:
+                raise ValueError("cannot submit jobs to a closed pipeline")
+            self.__submitted += 1
+            if self.__cancelled:
+                self.__results.put(_DROPPED)
+                return
+            self.__jobs.put((-priority, next(self.__sequence), job))
+
+    def close(self):
+        """Signal that no more jobs are going to be submitted."""
+        with self.__lock:
+            if self.__closed:
+                return
+            self.__closed = True
+            for _ in self.__threads: # sorts after all jobs
+                self.__jobs.put((float('inf'), next(self.__sequence), _STOP))
+        self.__results.put(_CLOSED)
+
+    def cancel(self):
+        """Cancel all jobs which have not been started yet. Jobs which are
+        currently processed are only aborted by the `on_cancel` callable, if
+        given."""
+        with self.__lock:
+            first = not self.__cancelled
+            self.__cancelled = True
+        if first and self.__on_cancel: # outside the lock, it may take a while
+            self.__on_cancel()
+        with self.__lock: # no job is submitted meanwhile
+            while True: # drain the job queue, keep the stop markers
+                try:
+                    item = self.__jobs.get_nowait()
+                except queue.Empty:
+                    break
+                if item[2] is _STOP:
+                    self.__jobs.put(item)
+                    break
+                self.__results.put(_DROPPED)
+
+    def is_cancelled(self):
+        return self.__cancelled
+
+    def join(self):
+        """Wait for all worker threads to terminate. The pipeline needs to be
+        closed beforehand."""
+        for thread in self.__threads + self.__second_threads:
+            thread.join()
+
+    def results(self):
+        """Yield a tuple (job, result, exception) for each job, as soon as it
+        has been processed. Either result or exception is None. Results are
+        yielded in order of completion. The generator terminates as soon as the
+        pipeline has been closed and all jobs have been processed or dropped."""
+        received = 0
+        while not self.__closed or received < self.__submitted:
+            item = self.__results.get()
+            if item is _CLOSED:
+                continue
+            received += 1
+            if item is not _DROPPED:
+                yield item
+
+    def __first_worker(self):
+        first_stage = self.__stages[0]
+        while True:
+            job = self.__jobs.get()[2]
+            if job is _STOP:
+                break
+            if self.__cancelled:
+                self.__results.put(_DROPPED)
+                continue
+            try:
+                intermediate = first_stage(job)
+            except Exception as e: #pylint: disable=broad-except
+                self.__results.put((job, None, e))
+            else: # blocks if the second stage is busy
+                self.__intermediate.put((job, intermediate))
+        # the last worker of the first stage shuts down the second stage
+        with self.__lock:
+            self.__first_running -= 1
+            last = self.__first_running == 0
+        if last:
+            for _ in self.__second_threads:
+                self.__intermediate.put(_STOP)
+
+    def __second_worker(self):
+        second_stage = self.__stages[1]
+        while True:
+            item = self.__intermediate.get()
+            if item is _STOP:
+                break
+            job, intermediate = item
+            if self.__cancelled:
+                if self.__discard:
+                    self.__discard(job, intermediate)
+                self.__results.put(_DROPPED)
+                continue
+            try:
+                self.__results.put((job, second_stage(job, intermediate), None))
+            except Exception as e: #pylint: disable=broad-except
+                self.__results.put((job, None, e))
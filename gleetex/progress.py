@@ -0,0 +1,127 @@
+# (c) 2013-2019 Sebastian Humenda
+# This code is licenced under the terms of the LGPL-3+, see the file COPYING for
+# more details.
+"""Progress reporting for long-running conversions.
+
+A CachedConverter reports the progress of a conversion to an observer, see
+CachedConverter.set_observer. An observer is a callable receiving an `Event`
+for each step of the conversion of a formula:
+
+    def observer(event):
+        if event.kind == progress.FAILED:
+            print('formula no. %d failed' % (event.index + 1))
+    converter.set_observer(observer)
+
+The observer is called from the worker threads of the converter, but never
+concurrently, so it does not need to be thread-safe. It should return
+quickly, since it holds up the conversion while it runs.
+
+`ProgressBar` is an observer printing a progress bar with throughput and
+estimated time of arrival to a terminal."""
+
+import collections
+import time
+
+# a formula has been queued for conversion
+QUEUED = 'queued'
+# a formula has been found in the cache and is not converted
+CACHE_HIT = 'cache-hit'
+# LaTeX started or finished to typeset a formula
+LATEX_START = 'latex-start'
+LATEX_DONE = 'latex-done'
+# the image of a formula has been created; the conversion of this formula is
+# complete
+IMAGE_DONE = 'image-done'
+# a formula failed to convert
+FAILED = 'failed'
+
+Event = collections.namedtuple('Event', ['kind', 'timestamp', 'index',
+    'formula', 'displaymath'])
+Event.__doc__ = """Event(kind, timestamp, index, formula, displaymath)
+A step in the conversion of a formula. `kind` is one of the constants of this
+module, `timestamp` the time of the event in seconds since the epoch and
+`index` the position of the formula in the list of formulas passed to the
+converter, counting from 0. For formulas occurring several times, the index of
+its first occurrence is used."""
+
+def make_event(kind, index, formula, displaymath):
+    """Create an Event with the current time."""
+    return Event(kind, time.time(), index, formula, displaymath)
+
+def format_duration(seconds):
+    """Format a duration as h:mm:ss or m:ss."""
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return '%d:%02d:%02d' % (hours, minutes, seconds)
+    return '%d:%02d' % (minutes, seconds)
+
+class ProgressBar:
+    """ProgressBar(file, width=30, interval=0.1)
+    Observer printing a progress bar to the given file, usually sys.stderr.
+    Besides the number of processed formulas, it shows the throughput of the
+    conversion in formulas per second and the estimated remaining time. The
+    bar is redrawn at most every `interval` seconds. Call `finish()` once the
+    conversion is done."""
+    def __init__(self, file, width=30, interval=0.1):
+        self.__file = file
+        self.__width = width
+        self.__interval = interval
+        self.__total = 0 # queued formulas and cache hits
+        self.__cached = 0
+        self.__converted = 0 # converted or failed formulas
+        self.__failed = 0
+        self.__started = None # time of the first queued formula
+        self.__last_drawn = 0
+        self.__visible = False
+
+    def __call__(self, event):
+        if event.kind == QUEUED:
+            self.__total += 1
+            if self.__started is None:
+                self.__started = event.timestamp
+        elif event.kind == CACHE_HIT:
+            self.__total += 1
+            self.__cached += 1
+        elif event.kind == IMAGE_DONE:
+            self.__converted += 1
+        elif event.kind == FAILED:
+            self.__converted += 1
+            self.__failed += 1
+        else:
+            return
+        if time.monotonic() - self.__last_drawn >= self.__interval:
+            self.draw()
+
+    def get_line(self):
+        """Return the progress bar as a string."""
+        done = self.__cached + self.__converted
+        filled = (self.__width * done // self.__total if self.__total
+                else self.__width)
+        line = '[%s%s] %d/%d formulas' % ('#' * filled,
+                '-' * (self.__width - filled), done, self.__total)
+        if self.__failed:
+            line += ', %d failed' % self.__failed
+        elapsed = (time.time() - self.__started if self.__started else 0)
+        if self.__converted and elapsed > 0:
+            rate = self.__converted / elapsed
+            line += ', %.1f/s, ETA %s' % (rate,
+                    format_duration((self.__total - done) / rate))
+        return line
+
+    def draw(self):
+        """Redraw the progress bar, overwriting the current line."""
+        # keep a trailing space for terminals not clearing the line
+        self.__file.write('\r%s ' % self.get_line())
+        self.__file.flush()
+        self.__last_drawn = time.monotonic()
+        self.__visible = True
+
+    def finish(self):
+        """Draw the final state of the progress bar and end the line, if the
+        bar has been drawn at all."""
+        if self.__visible:
+            self.draw()
+            self.__file.write('\n')
+            self.__file.flush()
+            self.__visible = False
@@ -1,10 +1,17 @@
 #pylint: disable=too-many-public-methods,import-error,too-few-public-methods,missing-docstring,unused-variable
+import asyncio
 import os
+import re
 import shutil
+import subprocess
+import sys
 import tempfile
+import threading
+import time
 import unittest
+from subprocess import SubprocessError
 from unittest.mock import patch
-from gleetex import cachedconverter, image
+from gleetex import cachedconverter, image, optimize, progress
 from gleetex.caching import JsonParserException
 from gleetex.image import  remove_all
 
@@ -27,27 +34,132 @@ class Tex2imgMock():
         self.__format = fmt
         self.set_dpi = self.set_transparency = self.set_foreground_color \
                 = self.set_background_color = lambda x: None # do nothing
+        self.__densities = ()
+        self.__png_fallback = False
 
-    def create_dvi(self, dvi_fn):
+    def set_densities(self, densities):
+        self.__densities = [density for density in densities if density != 1]
+
+    def set_png_fallback(self, flag):
+        self.__png_fallback = flag
+
+    def get_variants(self, image_fn):
+        if self.__format != image.Format.Png:
+            return ({'png': os.path.splitext(image_fn)[0] + '.png'}
+                    if self.__png_fallback else {})
+        return {image.density_name(density): image.density_file_name(
+            image_fn, density) for density in self.__densities}
+
+    def create_dvi(self, _tex_document, dvi_fn):
         with open(dvi_fn, 'w') as f:
             f.write('dummy')
 
-    def create_image(self, dvi_fn):
+    def set_pipes(self, flag):
+        pass
+
+    def set_search_path(self, path):
+        self.search_path = path
+
+    def create_image(self, dvi_fn, image_fn=None):
         if os.path.exists(dvi_fn):
             os.remove(dvi_fn)
-        write(os.path.splitext(dvi_fn)[0] + '.' + self.__format.value)
+        if not image_fn:
+            image_fn = os.path.splitext(dvi_fn)[0] + '.' + self.__format.value
+        for path in [image_fn] + list(self.get_variants(image_fn).values()):
+            write(path)
+        return {'depth': 9, 'height': 8, 'width': 7}
 
     def convert(self, tx, basename):
         write(basename + '.tex', tx)
         dvi = basename + '.dvi'
-        self.create_dvi(dvi)
-        self.create_image(dvi)
+        self.create_dvi(tx, dvi)
+        pos = self.create_image(dvi)
         remove_all(dvi, basename + '.tex', basename + '.log', basename + '.aux')
-        return {'depth': 9, 'height': 8, 'width': 7}
+        return pos
 
     def parse_log(self, _logdata):
         return {}
 
+    def terminate(self):
+        pass
+
+
+class FailingTex2imgMock(Tex2imgMock):
+    """Fail for every formula containing "fail"."""
+    def create_dvi(self, tex_document, dvi_fn):
+        if 'fail' in str(tex_document):
+            raise SubprocessError('Undefined control sequence')
+        super().create_dvi(tex_document, dvi_fn)
+
+
+class InputTex2imgMock(Tex2imgMock):
+    """Fail unless files read with \\input are found in the working directory
+    of LaTeX (that of the DVI file) or in the search path."""
+    search_path = None
+    def create_dvi(self, tex_document, dvi_fn):
+        for name in re.findall(r'\\input\{(.*?)\}', str(tex_document)):
+            if not any(os.path.exists(os.path.join(directory, name + '.tex'))
+                    for directory in (os.path.dirname(dvi_fn),
+                        self.search_path) if directory is not None):
+                raise SubprocessError("File `%s.tex' not found." % name)
+        super().create_dvi(tex_document, dvi_fn)
+
+
+class RecordingTex2imgMock(Tex2imgMock):
+    """Record the order in which formulas are typeset."""
+    order = []
+    def create_dvi(self, tex_document, dvi_fn):
+        RecordingTex2imgMock.order.append(str(tex_document))
+        super().create_dvi(tex_document, dvi_fn)
+
+
+# writes the ids of itself and of a child process, then sleeps like a hung LaTeX
+SLEEPING_LATEX = """import os, subprocess, sys, time
+child = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(60)'])
+with open(sys.argv[1] + '.tmp', 'w') as f:
+    f.write('%d %d' % (os.getpid(), child.pid))
+os.replace(sys.argv[1] + '.tmp', sys.argv[1])
+time.sleep(60)
+"""
+
+class SleepingAsyncTex2img(image.AsyncTex2img):
+    """Run a hanging process instead of LaTeX, see SLEEPING_LATEX."""
+    def _prepare_latex(self, tex_document, dvi_fn):
+        write('latex.py', SLEEPING_LATEX)
+        return ([sys.executable, os.path.abspath('latex.py'),
+            os.path.abspath('pids')], None, ['latex.py'], None)
+
+def is_running(pid):
+    """Return whether the process with the given id runs (and is no
+    zombie)."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            return f.read().split(')')[-1].split()[0] != 'Z'
+    except OSError:
+        return True
+
+
+
+class AsyncTex2imgMock(FailingTex2imgMock):
+    """Asynchronous variant of the mock, see image.AsyncTex2img."""
+    running = 0
+    max_running = 0
+
+    async def create_dvi(self, tex_document, dvi_fn):
+        AsyncTex2imgMock.running += 1
+        AsyncTex2imgMock.max_running = max(AsyncTex2imgMock.max_running,
+                AsyncTex2imgMock.running)
+        await asyncio.sleep(0.01)
+        AsyncTex2imgMock.running -= 1
+        super().create_dvi(tex_document, dvi_fn)
+
+    async def create_image(self, dvi_fn, image_fn=None):
+        return super().create_image(dvi_fn, image_fn)
+
 
 class TestCachedConverter(unittest.TestCase):
     #pylint: disable=protected-access
@@ -141,3 +253,368 @@ class TestCachedConverter(unittest.TestCase):
         # expect all formulas and a gladtex cache to exist
         self.assertEqual(get_number_of_files('.'), len(formulas)+1,
                 "present files:\n%s" % ', '.join(os.listdir('.')))
+
+    @patch('gleetex.image.Tex2img', FailingTex2imgMock)
+    def test_that_failing_formula_raises_conversion_exception(self):
+        formulas = [mk_eqn('a_{%d}' % i, pos=(i,i)) for i in range(4)] + \
+                [mk_eqn('\\fail', pos=(9, 2))]
+        c = cachedconverter.CachedConverter('.')
+        with self.assertRaises(cachedconverter.ConversionException) as ctx:
+            c.convert_all(formulas)
+        self.assertEqual(ctx.exception.formula, '\\fail')
+        self.assertEqual(ctx.exception.formula_count, 5)
+        self.assertEqual(ctx.exception.src_line_number, 10)
+        self.assertFalse(any(f.endswith('.dvi') for f in os.listdir('.')))
+
+    @patch('gleetex.image.Tex2img', Tex2imgMock)
+    def test_that_worker_counts_are_validated(self):
+        c = cachedconverter.CachedConverter('.')
+        self.assertRaises(ValueError, c.set_workers, 0)
+        c.set_workers(1, 1)
+        formulas = [mk_eqn('a_{%d}' % i) for i in range(5)]
+        c.convert_all(formulas)
+        self.assertEqual(get_number_of_files('.'), len(formulas)+1)
+
+    @patch('gleetex.image.Tex2img', RecordingTex2imgMock)
+    def test_that_expensive_formulas_are_converted_first(self):
+        RecordingTex2imgMock.order = []
+        formulas = [mk_eqn('a_{%d}' % i) for i in range(3)] + \
+                [mk_eqn('\\begin{align*}a &= b \\\\ c &= d\\end{align*}')]
+        c = cachedconverter.CachedConverter('.')
+        c.set_workers(1, 1)
+        c.convert_all(formulas)
+        self.assertTrue('align*' in RecordingTex2imgMock.order[0])
+        self.assertTrue(c.get_data_for('a_{1}', False)['time'] >= 0)
+
+    @patch('gleetex.image.Tex2img', FailingTex2imgMock)
+    def test_that_all_failures_are_reported_when_keeping_going(self):
+        formulas = [mk_eqn('\\fail_{%d}' % i, pos=(i, 0)) for i in range(3)] \
+                + [mk_eqn('a_{%d}' % i) for i in range(4)]
+        c = cachedconverter.CachedConverter('.')
+        c.set_keep_going(True)
+        with self.assertRaises(cachedconverter.MultipleConversionException) \
+                as ctx:
+            c.convert_all(formulas)
+        self.assertEqual([e.formula_count for e in ctx.exception.exceptions],
+                [1, 2, 3])
+        # successfully converted formulas are cached
+        c = cachedconverter.CachedConverter('.')
+        for i in range(4):
+            self.assertTrue(c.get_data_for('a_{%d}' % i, False))
+
+    @patch('gleetex.image.AsyncTex2img', AsyncTex2imgMock)
+    def test_that_formulas_are_converted_asynchronously(self):
+        AsyncTex2imgMock.max_running = 0
+        formulas = [mk_eqn('a_{%d}' % i) for i in range(10)]
+        c = cachedconverter.CachedConverter('.')
+        asyncio.run(c.convert_all_async(formulas, 3))
+        self.assertEqual(get_number_of_files('.'), len(formulas)+1)
+        self.assertTrue(c.get_data_for('a_{9}', False))
+        self.assertTrue(AsyncTex2imgMock.max_running <= 3)
+
+    @patch('gleetex.image.AsyncTex2img', AsyncTex2imgMock)
+    def test_that_async_render_times_exclude_waiting_for_a_slot(self):
+        formulas = [mk_eqn('a_{%d}' % i) for i in range(10)]
+        c = cachedconverter.CachedConverter('.')
+        start = time.monotonic()
+        asyncio.run(c.convert_all_async(formulas, 1))
+        elapsed = time.monotonic() - start
+        # formulas are rendered one after another
+        self.assertTrue(sum(c.get_data_for('a_{%d}' % i, False)['time']
+            for i in range(10)) <= elapsed)
+
+    @patch('gleetex.image.AsyncTex2img', AsyncTex2imgMock)
+    def test_that_concurrent_async_conversions_use_distinct_files(self):
+        c = cachedconverter.CachedConverter('.')
+        async def convert_both():
+            await asyncio.gather(
+                c.convert_all_async([mk_eqn('a_{%d}' % i) for i in range(5)]),
+                c.convert_all_async([mk_eqn('b_{%d}' % i) for i in range(5)]))
+        asyncio.run(convert_both())
+        self.assertEqual(get_number_of_files('.'), 11)
+        self.assertNotEqual(c.get_data_for('a_{0}', False)['path'],
+                c.get_data_for('b_{0}', False)['path'])
+
+    @patch('gleetex.image.AsyncTex2img', AsyncTex2imgMock)
+    def test_that_async_failures_raise_conversion_exception(self):
+        formulas = [mk_eqn('a_{%d}' % i) for i in range(3)] + \
+                [mk_eqn('\\fail', pos=(4, 1))]
+        c = cachedconverter.CachedConverter('.')
+        with self.assertRaises(cachedconverter.ConversionException) as ctx:
+            asyncio.run(c.convert_all_async(formulas))
+        self.assertEqual(ctx.exception.formula_count, 4)
+
+    @unittest.skipUnless(os.name == 'posix', 'requires process groups')
+    @patch('gleetex.image.AsyncTex2img', SleepingAsyncTex2img)
+    def test_that_cancelled_async_conversions_kill_process_groups(self):
+        c = cachedconverter.CachedConverter('.')
+        async def convert_and_cancel():
+            task = asyncio.ensure_future(c.convert_all_async([mk_eqn('a')]))
+            for _ in range(200):
+                if os.path.exists('pids'):
+                    break
+                await asyncio.sleep(0.05)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+        asyncio.run(convert_and_cancel())
+        with open('pids') as f:
+            pids = [int(pid) for pid in f.read().split()]
+        for _ in range(100): # the child of LaTeX is killed asynchronously
+            if not any(is_running(pid) for pid in pids):
+                break
+            time.sleep(0.05)
+        self.assertEqual([is_running(pid) for pid in pids], [False, False])
+        self.assertFalse(c.contains('a', False))
+
+    @unittest.skipUnless(os.name == 'posix', 'requires process groups')
+    @patch('gleetex.image.AsyncTex2img', SleepingAsyncTex2img)
+    def test_that_hung_async_conversions_time_out(self):
+        c = cachedconverter.CachedConverter('.')
+        with self.assertRaises(cachedconverter.ConversionException) as ctx:
+            asyncio.run(c.convert_all_async([mk_eqn('a')], timeout=0.5))
+        self.assertTrue('timed out' in ctx.exception.cause)
+
+    @patch('gleetex.image.Tex2img', Tex2imgMock)
+    def test_that_iterated_results_cover_all_formulas_in_order(self):
+        c = cachedconverter.CachedConverter('.')
+        c.convert_all([mk_eqn('b')]) # cached beforehand
+        formulas = [mk_eqn('a_{%d}' % i) for i in range(5)] + [mk_eqn('b'),
+                mk_eqn('a_{1}')]
+        results = list(c.convert_iter(formulas, ordered=True))
+        self.assertEqual([index for index, _ in results], list(range(7)))
+        self.assertEqual([data['formula'] for _, data in results],
+                [f[2] for f in formulas])
+
+    @patch('gleetex.image.Tex2img', FailingTex2imgMock)
+    def test_that_failed_formulas_are_yielded_without_data(self):
+        formulas = [mk_eqn('a_{%d}' % i) for i in range(3)] + \
+                [mk_eqn('\\fail'), mk_eqn('a_{0}')]
+        c = cachedconverter.CachedConverter('.')
+        c.set_keep_going(True)
+        results = {}
+        with self.assertRaises(cachedconverter.MultipleConversionException):
+            for index, data in c.convert_iter(formulas):
+                results[index] = data
+        self.assertEqual(sorted(results), list(range(5)))
+        self.assertEqual(results[3], None)
+        self.assertEqual(results[4]['formula'], 'a_{0}')
+
+    @patch('gleetex.image.Tex2img', FailingTex2imgMock)
+    def test_that_observer_receives_events(self):
+        c = cachedconverter.CachedConverter('.')
+        c.convert_all([mk_eqn('b')])
+        events = []
+        c.set_observer(events.append)
+        c.set_keep_going(True)
+        formulas = [mk_eqn('a'), mk_eqn('b'), mk_eqn('\\fail'), mk_eqn('a')]
+        with self.assertRaises(cachedconverter.MultipleConversionException):
+            c.convert_all(formulas)
+        kinds = lambda index: [e.kind for e in events if e.index == index]
+        self.assertEqual(kinds(0), [progress.QUEUED, progress.LATEX_START,
+                progress.LATEX_DONE, progress.IMAGE_DONE])
+        self.assertEqual(kinds(1), [progress.CACHE_HIT])
+        self.assertEqual(kinds(2), [progress.QUEUED, progress.LATEX_START,
+                progress.FAILED])
+        self.assertEqual(kinds(3), [])
+
+    @patch('gleetex.image.Tex2img', Tex2imgMock)
+    def test_that_formulas_are_imported_from_other_converters(self):
+        first = cachedconverter.CachedConverter('.')
+        first.convert_all([mk_eqn('a'), mk_eqn('b')])
+        second = cachedconverter.CachedConverter('chapter')
+        second.import_formula(first, 'b', False)
+        self.assertTrue(second.contains('b', False))
+        self.assertFalse(second.contains('a', False))
+        self.assertTrue(os.path.exists(os.path.join('chapter',
+            second.get_data_for('b', False)['path'])))
+        # the next free file name is used for converted formulas
+        second.convert_all([mk_eqn('b'), mk_eqn('c')])
+        self.assertNotEqual(second.get_data_for('b', False)['path'],
+                second.get_data_for('c', False)['path'])
+        self.assertEqual(get_number_of_files('chapter'), 3)
+
+    @patch('gleetex.image.Tex2img', Tex2imgMock)
+    def test_that_profiles_are_converted_concurrently_and_cached_apart(self):
+        c = cachedconverter.CachedConverter('.')
+        png = cachedconverter.Profile(png=True)
+        formulas = [mk_eqn('a_{%d}' % i) for i in range(5)]
+        threads = [threading.Thread(target=c.convert_all, args=(formulas,)),
+                threading.Thread(target=c.convert_all, args=(formulas, png))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(c.get_data_for('a_{0}', False)['path'].endswith('.svg'))
+        self.assertTrue(c.get_data_for('a_{0}', False,
+            png)['path'].endswith('.png'))
+        self.assertTrue(os.path.exists('gladtex-%s.cache' % png.get_id()))
+        # options set on the converter form the default profile
+        c.set_option('png', True)
+        self.assertEqual(c.get_profile(), png)
+
+    @patch('gleetex.image.Tex2img', Tex2imgMock)
+    def test_that_profiles_with_lists_can_be_used_as_keys(self):
+        profile = cachedconverter.Profile(png=True, densities=[1, 2])
+        self.assertEqual(profile, cachedconverter.Profile(png=True,
+            densities=(1, 2)))
+        self.assertEqual(hash(profile._replace(densities=[1, 2])),
+                hash(profile))
+        c = cachedconverter.CachedConverter('.')
+        c.convert_all([mk_eqn('a')], profile)
+        self.assertEqual(c.get_data_for('a', False, profile)['variants'],
+                {'2x': 'eqn000@2x.png'})
+        c.set_option('densities', [2])
+        self.assertEqual(c.get_profile().densities, (2,))
+
+    @patch('gleetex.image.Tex2img', Tex2imgMock)
+    def test_that_formulas_are_converted_while_iterable_is_consumed(self):
+        c = cachedconverter.CachedConverter('.')
+        def formulas():
+            for i in range(5):
+                yield mk_eqn('a_{%d}' % (i % 3))
+            raise ValueError('parse error')
+        results = []
+        with self.assertRaises(ValueError):
+            for result in c.convert_iter(formulas(), ordered=True):
+                results.append(result)
+        self.assertEqual([index for index, _ in results], list(range(5)))
+        self.assertEqual(results[4][1]['formula'], 'a_{1}')
+        self.assertEqual(get_number_of_files('.'), 4)
+
+    @patch('gleetex.image.Tex2img', Tex2imgMock)
+    def test_that_images_are_optimized_after_creation(self):
+        optimizer = optimize.ImageOptimizer()
+        optimizer.set_minify_svg(3)
+        c = cachedconverter.CachedConverter('.')
+        c.set_optimizer(optimizer)
+        c.convert_all([mk_eqn('a'), mk_eqn('b')])
+        self.assertEqual(optimizer.get_statistics()[0], 2)
+
+    @patch('gleetex.image.Tex2img', Tex2imgMock)
+    def test_that_density_variants_are_cached(self):
+        c = cachedconverter.CachedConverter('.')
+        c.set_option('png', True)
+        c.convert_all([mk_eqn('a')])
+        self.assertFalse('variants' in c.get_data_for('a', False))
+        # formulas without the requested variants are converted again
+        c.set_option('densities', (1, 2))
+        c.convert_all([mk_eqn('a')])
+        data = c.get_data_for('a', False)
+        self.assertEqual(data['variants'], {'2x': 'eqn000@2x.png'})
+        self.assertEqual(sorted(os.listdir('.')), ['eqn000.png',
+                'eqn000@2x.png', 'gladtex.cache'])
+        # a missing variant invalidates the cache entry
+        os.remove('eqn000@2x.png')
+        self.assertFalse(c.contains('a', False))
+        second = cachedconverter.CachedConverter('chapter')
+        second.set_option('png', True)
+        second.set_option('densities', (1, 2))
+        c.convert_all([mk_eqn('a')])
+        second.import_formula(c, 'a', False)
+        self.assertTrue(os.path.exists(os.path.join('chapter',
+            'eqn000@2x.png')))
+
+    @patch('gleetex.image.Tex2img', Tex2imgMock)
+    def test_that_cached_and_imported_svg_images_are_precompressed(self):
+        optimizer = optimize.ImageOptimizer()
+        optimizer.set_precompress_svg(True)
+        c = cachedconverter.CachedConverter('.')
+        c.convert_all([mk_eqn('a'), mk_eqn('b')])
+        # cached before precompression was enabled
+        c.set_optimizer(optimizer)
+        c.convert_all([mk_eqn('a')])
+        self.assertTrue(os.path.exists('eqn000.svg.gz'))
+        self.assertFalse(os.path.exists('eqn001.svg.gz'))
+        # the compressed copy is imported along with the image
+        second = cachedconverter.CachedConverter('chapter')
+        second.import_formula(c, 'a', False)
+        self.assertTrue(os.path.exists(os.path.join('chapter',
+            'eqn000.svg.gz')))
+        # or created, if missing
+        second.set_optimizer(optimizer)
+        second.import_formula(c, 'b', False)
+        self.assertTrue(os.path.exists(os.path.join('chapter',
+            'eqn001.svg.gz')))
+
+    @patch('gleetex.image.Tex2img', Tex2imgMock)
+    def test_that_png_fallbacks_are_cached_with_svg_images(self):
+        c = cachedconverter.CachedConverter('.')
+        c.set_option('png_fallback', True)
+        c.convert_all([mk_eqn('a')])
+        data = c.get_data_for('a', False)
+        self.assertEqual((data['path'], data['variants']), ('eqn000.svg',
+            {'png': 'eqn000.png'}))
+        self.assertTrue(os.path.exists('eqn000.png'))
+        # the fallback is not overwritten by PNG images of another profile
+        png = cachedconverter.Profile(png=True)
+        c.convert_all([mk_eqn('b')], png)
+        self.assertEqual(c.get_data_for('b', False, png)['path'],
+                'eqn001.png')
+
+    @patch('gleetex.image.Tex2img', RecordingTex2imgMock)
+    def test_that_intermediate_files_are_kept_in_scratch_directory(self):
+        os.mkdir('scratch')
+        dvi_files = []
+        create_dvi = RecordingTex2imgMock.create_dvi
+        def record(mock, tex_document, dvi_fn):
+            dvi_files.append(dvi_fn)
+            create_dvi(mock, tex_document, dvi_fn)
+        c = cachedconverter.CachedConverter('.', img_dir='img')
+        c.set_scratch_directory('scratch')
+        with patch.object(RecordingTex2imgMock, 'create_dvi', record):
+            c.convert_all([mk_eqn('a'), mk_eqn('b')])
+        self.assertTrue(all(path.startswith('scratch') for path in dvi_files))
+        # each worker reuses its own directory
+        self.assertTrue(all(os.path.basename(os.path.dirname(path))
+            .startswith('worker-') for path in dvi_files))
+        self.assertEqual(os.listdir('scratch'), [])
+        self.assertEqual(sorted(os.listdir('img')), ['eqn000.svg',
+            'eqn001.svg', 'gladtex.cache'])
+
+    @patch('gleetex.image.Tex2img', InputTex2imgMock)
+    def test_that_relative_inputs_are_found_from_scratch_directory(self):
+        os.mkdir('img')
+        write(os.path.join('img', 'macros.tex'), '\\newcommand{\\R}{x}')
+        c = cachedconverter.CachedConverter('.', img_dir='img')
+        c.set_option('preamble', '\\input{macros}')
+        c.set_scratch_directory('')
+        c.convert_all([mk_eqn('\\R')])
+        self.assertTrue(c.contains('\\R', False))
+
+    @patch('gleetex.image.Tex2img', Tex2imgMock)
+    def test_that_images_are_moved_from_scratch_directory(self):
+        os.mkdir('scratch')
+        optimizer = optimize.ImageOptimizer()
+        optimizer.set_precompress_svg(True)
+        c = cachedconverter.CachedConverter('.', img_dir='img')
+        c.set_option('png_fallback', True)
+        c.set_scratch_directory('scratch')
+        c.set_optimizer(optimizer)
+        c.convert_all([mk_eqn('a')])
+        self.assertEqual(os.listdir('scratch'), [])
+        self.assertEqual(sorted(os.listdir('img')), ['eqn000.png',
+            'eqn000.svg', 'eqn000.svg.gz', 'gladtex.cache'])
+
+    @unittest.skipUnless(os.name == 'posix', 'requires POSIX process ids')
+    @patch('gleetex.image.Tex2img', Tex2imgMock)
+    def test_that_stale_scratch_directories_are_removed(self):
+        process = subprocess.Popen([sys.executable, '-c', ''])
+        process.wait() # the process id is not in use anymore
+        stale = os.path.join('scratch', 'gladtex-%d-x' % process.pid)
+        running = os.path.join('scratch', 'gladtex-%d-y' % os.getpid())
+        for path in (stale, running, os.path.join('scratch', 'other')):
+            os.makedirs(path)
+        c = cachedconverter.CachedConverter('.')
+        c.set_scratch_directory('scratch')
+        c.convert_all([mk_eqn('a')])
+        self.assertEqual(sorted(os.listdir('scratch')), ['gladtex-%d-y' %
+            os.getpid(), 'other'])
+
+    def test_that_scratch_directories_default_to_a_writable_directory(self):
+        path = cachedconverter.default_scratch_directory()
+        self.assertTrue(os.access(path, os.W_OK))
+        with patch.object(cachedconverter, 'FAST_SCRATCH_PATHS',
+                ('does-not-exist',)):
+            self.assertEqual(cachedconverter.default_scratch_directory(),
+                    tempfile.gettempdir())
@@ -85,6 +85,15 @@ class test_caching(unittest.TestCase):
         c.remove_formula(form1, False)
         self.assertEqual(len(c), 0)
 
+    def test_that_remove_removes_precompressed_copies(self):
+        write('eqn000.svg', '<svg/>')
+        write('eqn000.svg.gz', 'compressed')
+        c = caching.ImageCache()
+        c.add_formula('x', self.pos, 'eqn000.svg')
+        c.remove_formula('x', False)
+        self.assertFalse(os.path.exists('eqn000.svg'))
+        self.assertFalse(os.path.exists('eqn000.svg.gz'))
+
     def test_removal_of_non_existing_formula_raises_exception(self):
         c = caching.ImageCache()
         self.assertRaises(KeyError, c.remove_formula, 'Haha!', False)
@@ -146,4 +155,12 @@ class test_caching(unittest.TestCase):
         with self.assertRaises(KeyError):
             c.get_data_for('foo.png', 'False')
 
-
+    def test_that_render_times_are_remembered(self):
+        write('foo.png', 'muha')
+        write('bar.png', 'muha')
+        c = caching.ImageCache()
+        c.add_formula('\\tau', self.pos, 'foo.png', render_time=1.5)
+        c.add_formula('\\pi', self.pos, 'bar.png')
+        c.write()
+        c = caching.ImageCache()
+        self.assertEqual(c.get_render_times(), [('\\tau', False, 1.5)])
@@ -0,0 +1,56 @@
+#pylint: disable=too-many-public-methods,import-error,too-few-public-methods,missing-docstring,unused-variable
+import unittest
+
+from gleetex import cost
+
+class TestComplexity(unittest.TestCase):
+    def test_that_longer_formulas_are_more_complex(self):
+        self.assertTrue(cost.complexity('a+b+c+d') > cost.complexity('a'))
+
+    def test_that_environments_increase_complexity(self):
+        plain = 'a &= b \\\\ c &= d'
+        aligned = '\\begin{align*}%s\\end{align*}' % plain
+        self.assertTrue(cost.complexity(aligned) > 1.5 * cost.complexity(plain))
+
+    def test_that_configured_environment_is_considered(self):
+        self.assertTrue(cost.complexity('a=b', environment='flalign*') >
+                cost.complexity('a=b'))
+
+    def test_that_displaymath_is_more_complex(self):
+        self.assertTrue(cost.complexity('\\sum_i i', True) >
+                cost.complexity('\\sum_i i', False))
+
+
+class TestCostModel(unittest.TestCase):
+    def test_that_defaults_are_used_without_samples(self):
+        model = cost.CostModel()
+        self.assertEqual(model.get_parameters(),
+                (cost.DEFAULT_BASE, cost.DEFAULT_PER_UNIT))
+        self.assertTrue(model.estimate('x' * 100) > model.estimate('x'))
+
+    def test_that_too_few_samples_are_ignored(self):
+        model = cost.CostModel([('a', False, 9.0)])
+        self.assertEqual(model.get_parameters(),
+                (cost.DEFAULT_BASE, cost.DEFAULT_PER_UNIT))
+
+    def test_that_model_is_fitted_to_samples(self):
+        # one second plus 0.01 s per character
+        samples = [('x' * n, False, 1 + n * 0.01) for n in range(1, 50, 7)]
+        base, per_unit = cost.CostModel(samples).get_parameters()
+        self.assertAlmostEqual(base, 1.0)
+        self.assertAlmostEqual(per_unit, 0.01)
+
+    def test_that_samples_and_estimates_use_the_same_environment(self):
+        # rendering takes 0.01 s per complexity unit, within align*
+        samples = [('x' * n, False, cost.complexity('x' * n, False, 'align*')
+            * 0.01) for n in range(1, 50, 7)]
+        model = cost.CostModel(samples, 'align*')
+        self.assertAlmostEqual(model.get_parameters()[1], 0.01)
+        self.assertAlmostEqual(model.estimate('x' * 20), cost.complexity(
+            'x' * 20, False, 'align*') * 0.01)
+
+    def test_that_parameters_are_never_negative(self):
+        samples = [('x' * n, False, 10 - n * 0.1) for n in range(1, 50, 7)]
+        base, per_unit = cost.CostModel(samples).get_parameters()
+        self.assertEqual(per_unit, 0.0)
+        self.assertTrue(base > 0)
@@ -1,6 +1,6 @@
 #pylint: disable=too-many-public-methods
 from functools import reduce
-import os, re, shutil, tempfile
+import io, os, re, shutil, tempfile
 import unittest
 from gleetex import htmlhandling
 
@@ -47,6 +47,105 @@ class HtmlparserTest(unittest.TestCase):
         self.assertTrue(isinstance(self.p.get_data()[0], (tuple, list)))
         self.assertEqual(self.p.get_data()[0][2], 'foo \\pi')
 
+    def test_that_chunks_are_yielded_while_parsing(self):
+        chunks = self.p.feed_iter('<p><eq>a</eq> <eq>b</eq></p>')
+        self.assertEqual(next(chunks), '<p>')
+        self.assertEqual(next(chunks)[2], 'a')
+        self.assertEqual([c if isinstance(c, str) else c[2] for c in chunks],
+                [' ', 'b', '</p>'])
+        self.assertEqual(self.p.get_data(), [])
+
+    def test_that_lazy_parse_errors_are_raised_by_generator(self):
+        chunks = self.p.feed_iter('<eq>a</eq><eq>b')
+        self.assertEqual(next(chunks)[2], 'a')
+        self.assertRaises(htmlhandling.ParseException, next, chunks)
+
+    def test_that_streams_are_parsed_like_strings(self):
+        document = '<p>x\n<eq>a</eq>\n<!-- <eq> -->\n<eq env="x">b\nc</eq></p>'
+        self.p.feed(document)
+        for block_size in range(1, len(document) + 1):
+            chunks = htmlhandling.EqnParser().feed_stream(io.StringIO(
+                document), block_size)
+            chunks = list(chunks)
+            self.assertEqual(''.join(c for c in chunks if isinstance(c, str)),
+                    ''.join(c for c in self.p.get_data() if isinstance(c, str)))
+            self.assertEqual([c for c in chunks if not isinstance(c, str)],
+                    [c for c in self.p.get_data() if not isinstance(c, str)])
+
+    def test_that_characters_may_cross_block_boundaries(self):
+        document = HTML_SKELETON.format('utf-8', '<eq>ö</eq>æø').encode('utf-8')
+        chunks = list(self.p.feed_stream(io.BytesIO(document),
+                document.index('ö'.encode('utf-8')) + 1))
+        self.assertEqual(chunks[1][2], 'ö')
+        self.assertEqual(chunks[2], 'æø</body>')
+
+    def test_that_blocks_within_a_character_are_not_the_end(self):
+        text = 'ä€𝔸 <eq>ö€</eq> 𝔸€ä'
+        document = HTML_SKELETON.format('utf-8', text).encode('utf-8')
+        for block_size in (1, 2, 3):
+            chunks = list(htmlhandling.EqnParser().feed_stream(
+                io.BytesIO(document), block_size))
+            self.assertEqual([c[2] for c in chunks if isinstance(c, tuple)],
+                    ['ö€'])
+            self.assertTrue(''.join(c for c in chunks if isinstance(c, str))
+                    .endswith('<body>ä€𝔸  𝔸€ä</body>'))
+
+    def test_that_charset_is_found_after_the_first_block(self):
+        document = ('<!-- %s -->' % ('x' * 100) + HTML_SKELETON.format(
+            'iso-8859-15', '<eq>ö</eq>ü')).encode('iso-8859-15')
+        for block_size in (7, 64, 100):
+            parser = htmlhandling.EqnParser()
+            chunks = list(parser.feed_stream(io.BytesIO(document), block_size))
+            self.assertEqual(parser.get_encoding(), 'iso-8859-15')
+            self.assertEqual([c[2] for c in chunks if isinstance(c, tuple)],
+                    ['ö'])
+            self.assertTrue(''.join(c for c in chunks if isinstance(c, str))
+                    .endswith('</head><body>ü</body>'))
+
+    def test_that_buffers_are_parsed_without_decoding_raw_html(self):
+        document = HTML_SKELETON.format('iso-8859-15',
+                'ä<eq>ö &amp; \\alpha</eq>ü').encode('iso-8859-15')
+        chunks = list(self.p.feed_buffer(document))
+        self.assertEqual(self.p.get_encoding(), 'iso-8859-15')
+        self.assertEqual(chunks[1], ((1, 15), False, 'ö & \\alpha'))
+        self.assertTrue(isinstance(chunks[0], memoryview))
+        self.assertEqual(bytes(chunks[0]) + bytes(chunks[2]),
+                document.replace(b'<eq>\xf6 &amp; \\alpha</eq>', b''))
+
+    def test_that_charset_is_only_searched_in_header_of_buffer(self):
+        document = ('<html><head></head><body><meta charset="utf-8">'
+                '</body></html>').encode('utf-8')
+        self.assertRaises(htmlhandling.ParseException, self.p.feed_buffer,
+                document)
+
+    def test_that_raw_bytes_are_written_back_unaltered(self):
+        document = HTML_SKELETON.format('utf-8', 'ä<eq>b</eq>ü').encode('utf-8')
+        chunks = [{'pos': {'depth': 1, 'height': 2, 'width': 3},
+                'formula': c[2], 'path': 'b.svg', 'displaymath': c[1]}
+                if isinstance(c, tuple) else c
+                for c in self.p.feed_buffer(document)]
+        output = io.BytesIO()
+        file = io.TextIOWrapper(output, encoding='utf-8')
+        class Formatter:
+            def format(self, pos, formula, path, displaymath, variants=None):
+                return '<img alt="%s">' % formula
+        htmlhandling.write_html(file, chunks, Formatter())
+        file.flush()
+        self.assertEqual(output.getvalue(),
+                document.replace(b'<eq>b</eq>', b'<img alt="b">'))
+
+    def test_that_last_character_after_formula_is_kept(self):
+        self.p.feed('<eq>a</eq>x')
+        self.assertEqual(self.p.get_data()[1], 'x')
+
+    def test_that_each_entity_is_replaced_by_itself(self):
+        self.p.feed('<eq>a&gt;b&lt;c</eq>')
+        self.assertEqual(self.p.get_data()[0][2], 'a>b<c')
+
+    def test_that_tags_in_mixed_case_are_recognized(self):
+        self.p.feed('<Eq>a</eQ>')
+        self.assertEqual(self.p.get_data()[0][2], 'a')
+
     def test_tag_followed_by_eqn_is_correctly_recognized(self):
         self.p.feed('<p foo="bar"><eq>bar</eq>')
         self.assertEqual(self.p.get_data()[0], '<p foo="bar">')
@@ -148,6 +247,15 @@ class GetPositionTest(unittest.TestCase):
         self.assertEqual(htmlhandling.get_position('a\njojo', 3)[0], 1)
         self.assertEqual(htmlhandling.get_position('a\n\njojo', 3)[0], 2)
 
+    def test_that_line_index_answers_several_lookups(self):
+        document = 'ab\ncd\n\nef'
+        lines = htmlhandling.LineIndex(document)
+        for index in range(len(document)):
+            self.assertEqual(lines.get_position(index),
+                    htmlhandling.get_position(document, index))
+        self.assertEqual(lines.get_position(2), (1, 0))
+        self.assertEqual(lines.get_position(7), (3, 1))
+
     def test_that_position_on_line_is_correct(self):
         self.assertEqual(htmlhandling.get_position('jojo', 0)[1], 0)
         self.assertEqual(htmlhandling.get_position('jojo', 3)[1], 3)
@@ -330,6 +438,151 @@ class HtmlImageTest(unittest.TestCase):
             data = img.format(self.pos, '←', 'foo.png')
             self.assertTrue('←' in data)
  
+    def test_that_images_are_linked_by_default(self):
+        with htmlhandling.HtmlImageFormatter() as img:
+            data = img.format(self.pos, 'a', 'img/foo.png')
+        self.assertTrue('src="img/foo.png"' in data)
+
+    def test_that_inlined_images_have_mime_type_of_file(self):
+        os.mkdir('out')
+        with open(os.path.join('out', 'foo.png'), 'wb') as f:
+            f.write(b'\x89PNG')
+        with htmlhandling.HtmlImageFormatter() as img:
+            img.set_embedding(htmlhandling.HtmlImageFormatter.INLINE)
+            img.set_source_path('out')
+            data = img.format(self.pos, 'a', 'foo.png')
+        self.assertTrue('src="data:image/png;base64,iVBORw=="' in data)
+
+    def test_that_hybrid_mode_only_inlines_small_images(self):
+        with open('small.svg', 'w') as f:
+            f.write('<svg/>')
+        with open('large.svg', 'w') as f:
+            f.write('<svg>%s</svg>' % ('x' * 100))
+        with htmlhandling.HtmlImageFormatter() as img:
+            img.set_url('http://example.com/img')
+            img.set_embedding(htmlhandling.HtmlImageFormatter.HYBRID, 50)
+            self.assertTrue('src="data:image/svg+xml;base64,' in
+                    img.format(self.pos, 'a', 'small.svg'))
+            self.assertTrue('src="http://example.com/img/large.svg"' in
+                    img.format(self.pos, 'b', 'large.svg'))
+
+    def test_that_svg_symbols_are_defined_once(self):
+        with open('foo.svg', 'w') as f:
+            f.write("<?xml version='1.0'?>\n<svg version='1.1' "
+                    "viewBox='0 -8 7 9'><defs><path id='g0-97' d='M1 2'/>"
+                    "</defs><g id='page1'><use xlink:href='#g0-97'/></g></svg>")
+        with htmlhandling.HtmlImageFormatter() as img:
+            img.set_embedding(htmlhandling.HtmlImageFormatter.SYMBOLS)
+            first = img.format(self.pos, 'a', 'foo.svg')
+            second = img.format(self.pos, 'a', 'foo.svg', True)
+        self.assertEqual(first.count('<symbol id="gladtex-foo-svg" '
+                'viewBox="0 -8 7 9">'), 1)
+        self.assertTrue("<g id='gladtex-foo-svg-page1'>" in first)
+        self.assertFalse('<symbol' in second)
+        for data in (first, second):
+            self.assertTrue('<use href="#gladtex-foo-svg"/>' in data)
+            self.assertTrue('height="88.00" width="77.00"' in data)
+            self.assertTrue('vertical-align: -99.00px' in data)
+        self.assertTrue('class="displaymath"' in second)
+
+    def test_that_glyphs_are_shared_between_symbols(self):
+        svg = ("<svg viewBox='0 0 1 1'><defs><path id='{0}' d='M1 2'/>"
+                "</defs><use xlink:href='#{0}'/></svg>")
+        for name, glyph in (('a.svg', 'g0-97'), ('b.svg', 'g1-97')):
+            with open(name, 'w') as f:
+                f.write(svg.format(glyph))
+        with htmlhandling.HtmlImageFormatter() as img:
+            img.set_embedding(htmlhandling.HtmlImageFormatter.SYMBOLS)
+            data = (img.format(self.pos, 'a', 'a.svg') +
+                    img.format(self.pos, 'b', 'b.svg'))
+        self.assertEqual(data.count("d='M1 2'"), 1)
+        self.assertEqual(data.count("<use xlink:href='#gladtex-glyph-0'/>"), 2)
+        self.assertFalse('<defs></defs>' in data)
+
+    def test_that_png_images_are_inlined_in_symbol_mode(self):
+        with open('foo.png', 'wb') as f:
+            f.write(b'\x89PNG')
+        with htmlhandling.HtmlImageFormatter() as img:
+            img.set_embedding(htmlhandling.HtmlImageFormatter.SYMBOLS)
+            data = img.format(self.pos, 'a', 'foo.png')
+        self.assertTrue('src="data:image/png;base64,' in data)
+
+    def test_that_density_variants_form_a_srcset(self):
+        with htmlhandling.HtmlImageFormatter() as img:
+            img.set_url('http://x.org/img')
+            data = img.format(self.pos, 'a', 'eqn000.png', variants={
+                '3x': 'eqn000@3x.png', '1.5x': 'eqn000@1.5x.png',
+                'other': 'eqn000.svg'})
+        self.assertTrue('src="http://x.org/img/eqn000.png" srcset="'
+                'http://x.org/img/eqn000@1.5x.png 1.5x, '
+                'http://x.org/img/eqn000@3x.png 3x"' in data)
+        self.assertFalse('.svg' in data)
+
+    def test_that_density_variants_are_only_offered_for_linked_images(self):
+        for name, size in (('small.png', 10), ('large.png', 100)):
+            with open(name, 'wb') as f:
+                f.write(b'\x89PNG' + b'x' * size)
+        variants = {'2x': 'eqn000@2x.png'}
+        with htmlhandling.HtmlImageFormatter() as img:
+            img.set_embedding(htmlhandling.HtmlImageFormatter.INLINE)
+            data = img.format(self.pos, 'a', 'small.png', variants=variants)
+            self.assertFalse('srcset' in data)
+            img.set_embedding(htmlhandling.HtmlImageFormatter.HYBRID, 50)
+            data = img.format(self.pos, 'a', 'small.png', variants=variants)
+            self.assertFalse('srcset' in data)
+            data = img.format(self.pos, 'a', 'large.png', variants=variants)
+            self.assertTrue('src="large.png" srcset="eqn000@2x.png 2x"'
+                    in data)
+
+    def test_that_png_variants_are_svg_fallbacks(self):
+        with htmlhandling.HtmlImageFormatter() as img:
+            data = img.format(self.pos, 'a', 'eqn000.svg', variants={
+                'png': 'eqn000.png'})
+        self.assertTrue(data.startswith('<picture><source srcset="eqn000.svg" '
+            'type="image/svg+xml"><img src="eqn000.png" '))
+        self.assertTrue(data.endswith('></picture>'))
+
+    def test_that_unknown_embedding_modes_are_rejected(self):
+        with htmlhandling.HtmlImageFormatter() as img:
+            self.assertRaises(ValueError, img.set_embedding, 'foo')
+
+    def test_that_images_are_encoded_once(self):
+        with open('foo.svg', 'w') as f:
+            f.write('<svg/>')
+        mtime = os.stat('foo.svg').st_mtime_ns
+        with htmlhandling.HtmlImageFormatter() as img:
+            img.set_embedding(htmlhandling.HtmlImageFormatter.INLINE)
+            first = img.format(self.pos, 'a', 'foo.svg')
+            # same size and modification time: the file is not read again
+            with open('foo.svg', 'w') as f:
+                f.write('<SVG/>')
+            os.utime('foo.svg', ns=(mtime, mtime))
+            self.assertEqual(img.format(self.pos, 'a', 'foo.svg'), first)
+
+    def test_that_changed_images_are_encoded_again(self):
+        with open('foo.svg', 'w') as f:
+            f.write('<svg/>')
+        with htmlhandling.HtmlImageFormatter() as img:
+            first = img.get_encoded_image('foo.svg')
+            with open('foo.svg', 'w') as f:
+                f.write('<svg width="1"/>')
+            self.assertNotEqual(img.get_encoded_image('foo.svg'), first)
+
+    def test_that_encoded_images_are_dropped_if_cache_is_full(self):
+        for name in ('a.svg', 'b.svg'):
+            with open(name, 'w') as f:
+                f.write('<svg/>')
+        size = htmlhandling.HtmlImageFormatter.ENCODED_IMAGE_CACHE_SIZE
+        htmlhandling.HtmlImageFormatter.ENCODED_IMAGE_CACHE_SIZE = 10
+        try:
+            with htmlhandling.HtmlImageFormatter() as img:
+                img.get_encoded_image('a.svg')
+                img.get_encoded_image('b.svg')
+                cache = img._HtmlImageFormatter__encoded_images
+                self.assertEqual(list(cache), ['b.svg'])
+        finally:
+            htmlhandling.HtmlImageFormatter.ENCODED_IMAGE_CACHE_SIZE = size
+
     def test_formatting_commands_are_stripped(self):
         with htmlhandling.HtmlImageFormatter('foo.html') as img:
             data = img.format(self.pos, 'a\,b\,c\,d', 'foo.png')
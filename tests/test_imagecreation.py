@@ -1,8 +1,13 @@
 #pylint: disable=too-many-public-methods,import-error,too-few-public-methods,missing-docstring,unused-variable
+import asyncio
+import errno
 import os
 import pprint
 import shutil
+import sys
 import tempfile
+import threading
+import time
 import unittest
 from unittest.mock import patch
 from subprocess import SubprocessError
@@ -157,9 +162,181 @@ class test_imagecreation(unittest.TestCase):
                 fname('png'), ''.join(pprint.pformat(list(os.walk('.'))))))
         self.assertFalse(os.path.exists(fname('log')))
 
+    @patch('gleetex.image.proc_call', dvipng_mock)
+    def test_that_densities_are_rendered_from_one_dvi_file(self):
+        touch(['foo.dvi'])
+        t = image.Tex2img(Format.Png)
+        t.set_dpi(100)
+        t.set_densities((1, 2, 1.5))
+        self.assertEqual(t.get_variants('foo.png'), {'2x': 'foo@2x.png',
+            '1.5x': 'foo@1.5x.png'})
+        self.assertEqual([cmd[cmd.index('-D') + 1] for cmd, _fn
+                in t._variant_commands('foo.dvi')], ['200', '150'])
+        t.create_image('foo.dvi')
+        self.assertEqual(sorted(os.listdir('.')), ['foo.png', 'foo@1.5x.png',
+            'foo@2x.png'])
+
+    @patch('gleetex.image.proc_call', latex_error_mock)
+    def test_that_densities_are_removed_on_errors(self):
+        touch(['foo.dvi', 'foo@2x.png'])
+        t = image.Tex2img(Format.Png)
+        t.set_densities((2,))
+        self.assertRaises(SubprocessError, t.create_image, 'foo.dvi')
+        self.assertEqual(os.listdir('.'), [])
+
+    @patch('gleetex.image.proc_call', dvipng_mock)
+    def test_that_png_fallback_is_created_from_the_same_dvi_file(self):
+        touch(['foo.dvi'])
+        t = image.Tex2img(Format.Svg)
+        t.set_png_fallback(True)
+        self.assertEqual(t.get_variants('foo.svg'), {'png': 'foo.png'})
+        commands = t._variant_commands('foo.dvi')
+        self.assertEqual([cmd[0] for cmd, _fn in commands], ['dvipng'])
+        with patch('gleetex.image.run_image_command', lambda *args, **kw:
+                image.remove_all('foo.dvi')):
+            t.create_image('foo.dvi')
+        self.assertEqual(os.listdir('.'), ['foo.png'])
+
+    def test_that_latex_reads_the_document_from_stdin_with_pipes(self):
+        calls = []
+        def record(cmd, **kwargs):
+            calls.append((cmd, kwargs))
+            return ''
+        t = image.Tex2img(Format.Svg)
+        t.set_pipes(True)
+        with patch('gleetex.image.proc_call', record):
+            t.create_dvi(doc('x'), os.path.join('scratch', 'eqn004.dvi'))
+        cmd, kwargs = calls[0]
+        self.assertEqual(cmd[-1], '-jobname=eqn004')
+        self.assertTrue(kwargs['input'].startswith(b'\\documentclass'))
+        self.assertTrue(kwargs['cwd'].endswith('scratch'))
+        self.assertEqual(os.listdir('scratch'), [])
+
+    def test_that_the_search_path_is_put_in_front_of_texinputs(self):
+        calls = []
+        def record(cmd, **kwargs):
+            calls.append(kwargs)
+            return ''
+        t = image.Tex2img(Format.Svg)
+        t.set_pipes(True)
+        t.set_search_path('img')
+        with patch('gleetex.image.proc_call', record), \
+                patch.dict(os.environ, {'TEXINPUTS': 'tex' + os.pathsep}):
+            t.create_dvi(doc('x'), os.path.join('scratch', 'eqn004.dvi'))
+        self.assertEqual(calls[0]['env']['TEXINPUTS'], os.pathsep.join(['.',
+            os.path.abspath('img'), 'tex', '']))
+        # without a search path, the environment is inherited
+        t.set_search_path(None)
+        with patch('gleetex.image.proc_call', record):
+            t.create_dvi(doc('x'), os.path.join('scratch', 'eqn004.dvi'))
+        self.assertEqual(calls[1]['env'], None)
+
+    def test_that_svg_images_are_read_from_stdout_with_pipes(self):
+        touch([os.path.join('scratch', 'eqn004.dvi')])
+        def dvisvgm(cmd, **kwargs):
+            self.assertTrue('--stdout' in cmd and '-o' not in cmd)
+            self.assertTrue(kwargs['capture'])
+            return (b'<svg/>', ' width=1pt, height=2pt, depth=3pt\n'
+                    ' graphic size: 4pt x 5pt')
+        t = image.Tex2img(Format.Svg)
+        t.set_pipes(True)
+        with patch('gleetex.image.proc_call', dvisvgm):
+            pos = t.create_image(os.path.join('scratch', 'eqn004.dvi'),
+                    os.path.join('img', 'eqn004.svg'))
+        self.assertEqual(sorted(pos), ['depth', 'height', 'width'])
+        self.assertEqual(os.listdir('scratch'), [])
+        with open(os.path.join('img', 'eqn004.svg'), 'rb') as f:
+            self.assertEqual(f.read(), b'<svg/>')
+
+    def test_that_densities_are_ignored_for_svg(self):
+        t = image.Tex2img(Format.Svg)
+        t.set_densities((2,))
+        self.assertEqual(t.get_variants('foo.svg'), {})
+        self.assertRaises(ValueError, t.set_densities, (0,))
+
+    def test_that_files_are_moved_across_file_systems(self):
+        os.mkdir('scratch')
+        touch([os.path.join('scratch', 'eqn000.svg'), 'eqn000.svg'])
+        replace = os.replace
+        calls = []
+        def cross_device(source, destination):
+            calls.append(source)
+            if len(calls) == 1:
+                raise OSError(errno.EXDEV, 'Invalid cross-device link')
+            replace(source, destination)
+        with patch('os.replace', cross_device):
+            image.move_file(os.path.join('scratch', 'eqn000.svg'),
+                    'eqn000.svg')
+        # copied next to the destination first, then renamed
+        self.assertEqual(calls[1], 'eqn000.svg.tmp')
+        self.assertEqual(os.listdir('scratch'), [])
+        self.assertEqual(sorted(os.listdir('.')), ['eqn000.svg', 'scratch'])
+
 
 class TestImageResolutionCorrectlyCalculated(unittest.TestCase):
     def test_sizes_are_correctly_calculated(self):
         self.assertEqual(int(image.fontsize2dpi(12)), 115)
         self.assertEqual(int(image.fontsize2dpi(10)), 96)
 
+
+class TestProcessTracker(unittest.TestCase):
+    def test_that_running_processes_are_terminated(self):
+        tracker = image.ProcessTracker()
+        errors = []
+        def run():
+            try:
+                image.proc_call([sys.executable, '-c',
+                    'import time; time.sleep(15)'], tracker=tracker)
+            except SubprocessError as e:
+                errors.append(e)
+        thread = threading.Thread(target=run)
+        start = time.monotonic()
+        thread.start()
+        time.sleep(0.3) # let the process start
+        tracker.terminate()
+        thread.join()
+        self.assertTrue(time.monotonic() - start < 5)
+        self.assertTrue(isinstance(errors[0], image.ProcessCancelled))
+
+    def test_that_no_processes_are_started_after_termination(self):
+        tracker = image.ProcessTracker()
+        tracker.terminate()
+        self.assertRaises(image.ProcessCancelled, image.proc_call,
+                [sys.executable, '-c', 'pass'], tracker=tracker)
+
+
+class TestAsyncProcCall(unittest.TestCase):
+    def test_that_output_is_returned(self):
+        out = asyncio.run(image.async_proc_call([sys.executable, '-c',
+            'print("hello")']))
+        self.assertEqual(out.strip(), 'hello')
+
+    def test_that_the_environment_is_passed(self):
+        out = asyncio.run(image.async_proc_call([sys.executable, '-c',
+            'import os; print(os.environ["TEXINPUTS"])'],
+            env=dict(os.environ, TEXINPUTS='x')))
+        self.assertEqual(out.strip(), 'x')
+
+    def test_that_errors_raise_subprocess_error(self):
+        with self.assertRaises(SubprocessError):
+            asyncio.run(image.async_proc_call([sys.executable, '-c',
+                'import sys; sys.exit(3)']))
+
+    def test_that_processes_time_out(self):
+        start = time.monotonic()
+        with self.assertRaises(SubprocessError):
+            asyncio.run(image.async_proc_call([sys.executable, '-c',
+                'import time; time.sleep(15)'], timeout=0.5))
+        self.assertTrue(time.monotonic() - start < 5)
+
+    def test_that_cancelled_tasks_kill_their_process(self):
+        async def cancel():
+            task = asyncio.ensure_future(image.async_proc_call([sys.executable,
+                '-c', 'import time; time.sleep(15)']))
+            await asyncio.sleep(0.3)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+        start = time.monotonic()
+        asyncio.run(cancel())
+        self.assertTrue(time.monotonic() - start < 5)
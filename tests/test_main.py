@@ -0,0 +1,225 @@
+#pylint: disable=too-many-public-methods,import-error,too-few-public-methods,missing-docstring,unused-variable
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+
+from gleetex import __main__, cachedconverter
+from test_cachedconverter import FailingTex2imgMock
+
+def write(path, content):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(content)
+
+HEADER = '<html><head><meta charset="utf-8"></head><body>\n'
+
+class Output(io.StringIO):
+    """Standard output, which keeps its value after GladTeX closed it."""
+    value = None
+    def close(self):
+        self.value = self.getvalue()
+        super().close()
+
+class CountingTex2imgMock(FailingTex2imgMock):
+    """Record the LaTeX documents being typeset."""
+    documents = []
+    def create_dvi(self, tex_document, dvi_fn):
+        CountingTex2imgMock.documents.append(str(tex_document))
+        super().create_dvi(tex_document, dvi_fn)
+
+def run_main(args, timeout=30):
+    """Run GladTeX with the given command-line arguments in a separate thread
+    and return its exit status or None if it did not terminate in time."""
+    status = []
+    def run():
+        try:
+            __main__.Main().run(['gladtex'] + args)
+            status.append(0)
+        except SystemExit as e:
+            status.append(e.code)
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    return (status[0] if status else None)
+
+
+class TestMain(unittest.TestCase):
+    def setUp(self):
+        self.original_directory = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+        self.stderr = patch('sys.stderr', io.StringIO())
+        self.stderr.start()
+
+    def tearDown(self):
+        self.stderr.stop()
+        os.chdir(self.original_directory)
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def write_failing_document(self):
+        # one failing formula followed by more chunks than the parser may run
+        # ahead of the output
+        write('doc.htex', HEADER + '<p><eq>\\fail</eq></p>' +
+                '<p><eq>x</eq></p>\n' * __main__.CHUNK_QUEUE_SIZE)
+
+    @patch('gleetex.image.Tex2img', FailingTex2imgMock)
+    def test_that_a_failing_formula_before_many_chunks_does_not_hang(self):
+        self.write_failing_document()
+        self.assertEqual(run_main(['--embed', 'link', 'doc.htex']), 91)
+        self.assertFalse(os.path.exists('doc.html'))
+
+    @patch('gleetex.image.Tex2img', FailingTex2imgMock)
+    def test_that_keep_going_does_not_hang_after_a_failing_formula(self):
+        self.write_failing_document()
+        self.assertEqual(run_main(['-k', '--embed', 'link', 'doc.htex']), 91)
+        self.assertFalse(os.path.exists('doc.html'))
+        # all other formulas are converted nevertheless
+        self.assertTrue(cachedconverter.CachedConverter('.').contains('x',
+            False))
+
+    @patch('gleetex.image.Tex2img', FailingTex2imgMock)
+    def test_that_stdin_is_converted_to_stdout(self):
+        output = Output()
+        with patch('sys.stdin', io.StringIO(HEADER +
+                '<p><eq>a</eq> and <eq>b</eq></p>')), \
+                patch('sys.stdout', output):
+            self.assertEqual(run_main(['--embed', 'link', '-']), 0)
+        self.assertTrue(output.value.startswith(HEADER))
+        self.assertTrue('<img src="eqn000.svg"' in output.value)
+        self.assertTrue(output.value.index('alt="a"') <
+                output.value.index(' and ') < output.value.index('alt="b"'))
+
+    @patch('gleetex.image.Tex2img', FailingTex2imgMock)
+    def test_that_a_streamed_file_is_written_in_document_order(self):
+        write('doc.htex', HEADER + ''.join('<p><eq>x_{%d}</eq></p>\n' % i
+            for i in range(200)))
+        self.assertEqual(run_main(['--embed', 'link', 'doc.htex']), 0)
+        with open('doc.html', encoding='utf-8') as f:
+            document = f.read()
+        self.assertTrue(document.startswith(HEADER))
+        positions = [document.index('alt="x_{%d}"' % i) for i in range(200)]
+        self.assertEqual(positions, sorted(positions))
+        self.assertFalse('<eq>' in document)
+
+    @patch('gleetex.image.Tex2img', FailingTex2imgMock)
+    def test_that_a_file_is_streamed_to_stdout(self):
+        write('doc.htex', HEADER + '<p><eq>a</eq></p>' * 3)
+        output = Output()
+        with patch('sys.stdout', output):
+            self.assertEqual(run_main(['--embed', 'link', '-o', '-',
+                'doc.htex']), 0)
+        self.assertEqual(output.value.count('<img src="eqn000.svg"'), 3)
+        self.assertFalse(os.path.exists('doc.html'))
+
+    @patch('gleetex.image.Tex2img', FailingTex2imgMock)
+    def test_that_failing_formulas_from_stdin_exit_with_status_91(self):
+        with patch('sys.stdin', io.StringIO(HEADER +
+                '<p><eq>a</eq><eq>\\fail</eq></p>')), \
+                patch('sys.stdout', Output()):
+            self.assertEqual(run_main(['-k', '--embed', 'link', '-o', '-',
+                '-']), 91)
+        self.assertTrue('formula 2' in sys.stderr.getvalue())
+
+    def convert_in_place(self, args):
+        # larger than the blocks read while streaming
+        paragraphs = ['<p>%d: <eq>x</eq></p>\n' % i for i in range(10000)]
+        write('doc.html', HEADER + ''.join(paragraphs))
+        self.assertEqual(run_main(args + ['--embed', 'link', 'doc.html']), 0)
+        with open('doc.html', encoding='utf-8') as f:
+            document = f.read()
+        self.assertTrue(document.startswith(HEADER))
+        self.assertEqual(document.count('<img src="eqn000.svg"'), 10000)
+        self.assertTrue('<p>9999: ' in document)
+        self.assertFalse('<eq>' in document)
+
+    @patch('gleetex.image.Tex2img', FailingTex2imgMock)
+    def test_that_an_input_file_with_known_encoding_can_be_its_output(self):
+        self.convert_in_place(['-E', 'utf-8'])
+
+    @patch('gleetex.image.Tex2img', FailingTex2imgMock)
+    def test_that_a_mapped_input_file_can_be_its_output(self):
+        self.convert_in_place([])
+
+    @patch('gleetex.image.Tex2img', FailingTex2imgMock)
+    def test_that_pandoc_ast_is_converted(self):
+        math = lambda style, formula: {'t': 'Math', 'c': [{'t': style},
+            formula]}
+        ast = {'pandoc-api-version': [1, 17], 'meta': {}, 'blocks': [
+            {'t': 'Para', 'c': [math('InlineMath', 'a'), {'t': 'Space'}]},
+            {'t': 'Para', 'c': [math('DisplayMath', 'b')]}]}
+        output = Output()
+        with patch('sys.stdin', io.StringIO(json.dumps(ast))), \
+                patch('sys.stdout', output):
+            self.assertEqual(run_main(['-P', '--embed', 'link', '-']), 0)
+        blocks = json.loads(output.value)['blocks']
+        self.assertEqual([block['c'][0]['t'] for block in blocks],
+                ['RawInline', 'RawInline'])
+        self.assertTrue('alt="a"' in blocks[0]['c'][0]['c'][1])
+        self.assertTrue('alt="b"' in blocks[1]['c'][0]['c'][1])
+        self.assertEqual(blocks[0]['c'][1], {'t': 'Space'})
+
+
+class TestBatchConversion(unittest.TestCase):
+    def setUp(self):
+        self.original_directory = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+        self.stderr = patch('sys.stderr', io.StringIO())
+        self.stderr.start()
+        CountingTex2imgMock.documents = []
+
+    def tearDown(self):
+        self.stderr.stop()
+        os.chdir(self.original_directory)
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def typeset(self, formula):
+        """Return how often the given formula has been typeset."""
+        return len([document for document in CountingTex2imgMock.documents
+            if formula in document])
+
+    @patch('gleetex.image.Tex2img', CountingTex2imgMock)
+    def test_that_shared_formulas_are_converted_once(self):
+        os.mkdir('other')
+        write('a.htex', HEADER + '<eq>shared</eq><eq>first</eq>')
+        write('b.htex', HEADER + '<eq>shared</eq>')
+        write(os.path.join('other', 'c.htex'), HEADER + '<eq>shared</eq>')
+        self.assertEqual(run_main(['--embed', 'link', 'a.htex', 'b.htex',
+            os.path.join('other', 'c.htex')]), 0)
+        self.assertEqual((self.typeset('shared'), self.typeset('first')),
+                (1, 1))
+        for path in ('a.html', 'b.html', os.path.join('other', 'c.html')):
+            self.assertTrue(os.path.exists(path))
+        # copied from the cache of the other directory
+        self.assertTrue(cachedconverter.CachedConverter('other').contains(
+            'shared', False))
+
+    @patch('gleetex.image.Tex2img', CountingTex2imgMock)
+    def test_that_errors_name_their_document_with_keep_going(self):
+        write('a.htex', HEADER + '<eq>a</eq><eq>\\fail</eq>')
+        write('b.htex', HEADER + '<eq>b</eq><eq>c</eq><eq>\\failed</eq>')
+        write('c.htex', HEADER + '<eq>c</eq>')
+        self.assertEqual(run_main(['-k', '-m', '--embed', 'link', 'a.htex',
+            'b.htex', 'c.htex']), 91)
+        # formula counts and positions are relative to their document
+        errors = sys.stderr.getvalue()
+        self.assertTrue('File: a.htex\nLine: 2, 12\nNumber: 2\n' in errors)
+        self.assertTrue('File: b.htex\nLine: 2, 22\nNumber: 3\n' in errors)
+        # documents without failing formulas are written nevertheless
+        self.assertEqual([os.path.exists(path) for path in ('a.html',
+            'b.html', 'c.html')], [False, False, True])
+
+    @patch('gleetex.image.Tex2img', CountingTex2imgMock)
+    def test_that_file_names_are_read_from_argument_files(self):
+        write('a.htex', HEADER + '<eq>a</eq>')
+        write('b.htex', HEADER + '<eq>b</eq>')
+        write('inputs', 'a.htex\nb.htex\n')
+        self.assertEqual(run_main(['--embed', 'link', '@inputs']), 0)
+        self.assertTrue(os.path.exists('a.html') and os.path.exists('b.html'))
+        self.assertEqual((self.typeset('\\(a\\)'), self.typeset('\\(b\\)')),
+                (1, 1))
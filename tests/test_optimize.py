@@ -0,0 +1,243 @@
+#pylint: disable=too-many-public-methods,import-error,too-few-public-methods,missing-docstring,unused-variable
+import gzip
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import zlib
+
+from gleetex import optimize
+
+DVISVGM_OUTPUT = """<?xml version='1.0' encoding='UTF-8'?>
+<!-- This file was generated by dvisvgm 2.8.1 -->
+<svg version='1.1' xmlns='http://www.w3.org/2000/svg' xmlns:xlink='http://www.w3.org/1999/xlink' width='6.227143pt' height='4.428488pt' viewBox='0 -4.428488 6.227143 4.428488'>
+<defs>
+<path id='g0-97' d='M3.716065-3.706351C3.536737-4.07397 3.247821-4.343462 2.799502-4.343462Z'/>
+</defs>
+<g id='page1'>
+<use x='0' y='0' xlink:href='#g0-97'/>
+</g>
+</svg>
+"""
+
+def make_png(width, height, pixels, extra=()):
+    """Create an unfiltered, barely compressed RGBA PNG image, as a careless
+    encoder would. `pixels` is a list of RGBA tuples, row by row."""
+    rows = b''.join(b'\0' + bytes(value for pixel in
+            pixels[y * width:(y + 1) * width] for value in pixel)
+            for y in range(height))
+    return (optimize.PNG_SIGNATURE + optimize.write_png_chunk(b'IHDR',
+            struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)) +
+            b''.join(optimize.write_png_chunk(kind, data)
+                for kind, data in extra) +
+            optimize.write_png_chunk(b'IDAT', zlib.compress(rows, 0)) +
+            optimize.write_png_chunk(b'IEND', b''))
+
+def get_pixels(png):
+    header, rows, chunks = optimize.decode_png(png)
+    return [pixel for row in optimize.png_pixels(header, rows, chunks)
+            for pixel in row]
+
+class TestSvgMinifier(unittest.TestCase):
+    def test_that_comments_and_declaration_are_removed(self):
+        svg = optimize.minify_svg(DVISVGM_OUTPUT)
+        self.assertTrue(svg.startswith('<svg '))
+        self.assertFalse('<!--' in svg)
+        self.assertFalse('\n' in svg)
+
+    def test_that_coordinates_are_rounded(self):
+        svg = optimize.minify_svg(DVISVGM_OUTPUT, 2)
+        self.assertTrue("viewBox='0 -4.43 6.23 4.43'" in svg)
+        self.assertTrue("d='M3.72-3.71C3.54-4.07 3.25-4.34 2.8-4.34Z'" in svg)
+        self.assertTrue("width='6.23pt'" in svg)
+
+    def test_that_numbers_stay_separated(self):
+        self.assertEqual(optimize.round_numbers('M1.0001.5L2-0.0001', 2),
+                'M1 0.5L2 0')
+
+    def test_that_compact_arc_flags_are_kept(self):
+        self.assertEqual(optimize.round_path('M0 0a5 5 0 011 10 10', 2),
+                'M0 0a5 5 0 01 1 10 10')
+        # repeated arcs, flags separated by commas
+        self.assertEqual(optimize.round_path('M0 0A5.001,5 0 1,0 1.5.5 5 5 0 '
+            '0010 0z', 2), 'M0 0A5,5 0 1,0 1.5 0.5 5 5 0 00 10 0z')
+        self.assertEqual(optimize.round_path('M1.0001.5L2-0.0001', 2),
+                'M1 0.5L2 0')
+
+    def test_that_unreferenced_groups_are_unwrapped(self):
+        svg = optimize.minify_svg(DVISVGM_OUTPUT)
+        self.assertFalse('<g' in svg)
+        self.assertTrue("</defs><use x='0' y='0' xlink:href='#g0-97'/></svg>"
+                in svg)
+
+    def test_that_referenced_groups_are_kept(self):
+        svg = optimize.minify_svg("<svg><g id='a'><path d='M0 0'/></g>"
+                "<use xlink:href='#a'/></svg>")
+        self.assertTrue("<g id='a'><path d='M0 0'/></g>" in svg)
+
+    def test_that_identity_transforms_are_removed(self):
+        svg = optimize.minify_svg("<svg><g transform='translate(0, 0)'>"
+                "<path transform='matrix(1 0 0 1 0 0)' d='M0 0'/></g></svg>")
+        self.assertEqual(svg, "<svg><path d='M0 0'/></svg>")
+
+    def test_that_translations_are_merged(self):
+        self.assertEqual(optimize.merge_transforms('translate(1, 2) '
+                'translate(.5) scale(1)', 2), 'translate(1.5 2)')
+        self.assertEqual(optimize.merge_transforms('translate(1 2) '
+                'translate(-1 -2)', 2), '')
+        self.assertEqual(optimize.merge_transforms('scale(2) translate(1)', 2),
+                'scale(2) translate(1 0)')
+
+    def test_that_transformed_groups_around_one_element_are_unwrapped(self):
+        svg = optimize.minify_svg("<svg><g transform='translate(1 2)'>\n"
+                "<g transform='translate(3,4)'><path transform='scale(2)' "
+                "d='M0 0'/></g>\n</g></svg>")
+        self.assertEqual(svg, "<svg><path d='M0 0' transform='translate(4 6) "
+                "scale(2)'/></svg>")
+
+    def test_that_transformed_groups_around_several_elements_are_kept(self):
+        svg = optimize.minify_svg("<svg><g transform='translate(1 2)'>"
+                "<path d='M0 0'/><path d='M1 1'/></g><g transform='scale(2)'>"
+                "<defs/></g></svg>")
+        self.assertEqual(svg, "<svg><g transform='translate(1 2)'>"
+                "<path d='M0 0'/><path d='M1 1'/></g><g transform='scale(2)'>"
+                "<defs/></g></svg>")
+
+    def test_that_metadata_is_removed(self):
+        svg = optimize.minify_svg('<svg><metadata><rdf:RDF>x</rdf:RDF>'
+                '</metadata><path d="M0 0"/></svg>')
+        self.assertEqual(svg, "<svg><path d='M0 0'/></svg>")
+
+    def test_that_whitespace_in_text_is_kept(self):
+        svg = optimize.minify_svg('<svg><text x="1"> a <tspan>b</tspan> '
+                '</text></svg>')
+        self.assertTrue("<text x='1'> a <tspan>b</tspan> </text>" in svg)
+
+
+class TestPngOptimizer(unittest.TestCase):
+    def test_that_few_colours_are_converted_to_a_palette(self):
+        pixels = [(0, 0, 0, 0), (0, 0, 0, 255), (80, 80, 80, 128)] * 40
+        png = make_png(12, 10, pixels)
+        optimized = optimize.optimize_png(png)
+        self.assertTrue(len(optimized) < len(png))
+        header = optimize.decode_png(optimized)[0]
+        self.assertEqual(header, (12, 10, 2, 3))
+        self.assertEqual(get_pixels(optimized), pixels)
+
+    def test_that_many_colours_are_kept(self):
+        pixels = [(x, y, (x * y) % 256, 255) for y in range(20)
+                for x in range(20)]
+        png = make_png(20, 20, pixels)
+        optimized = optimize.optimize_png(png)
+        self.assertEqual(optimize.decode_png(optimized)[0][3], 6)
+        self.assertEqual(get_pixels(optimized), pixels)
+
+    def test_that_metadata_chunks_are_dropped(self):
+        png = make_png(2, 1, [(0, 0, 0, 255)] * 2, [(b'tEXt',
+                b'Software\0dvipng 1.15'), (b'pHYs', b'\0' * 9)])
+        chunks = [kind for kind, _data in optimize.read_png_chunks(
+                optimize.optimize_png(png))]
+        self.assertEqual(chunks, [b'IHDR', b'pHYs', b'PLTE', b'IDAT',
+                b'IEND'])
+
+    def test_that_unsupported_images_are_left_alone(self):
+        png = make_png(1, 1, [(0, 0, 0, 255)]).replace(b'\x08\x06',
+                b'\x10\x06', 1) # pretend 16 bits per sample
+        self.assertEqual(optimize.optimize_png(png), png)
+        self.assertEqual(optimize.optimize_png(b'no image'), b'no image')
+
+    def test_that_malformed_palette_images_are_left_alone(self):
+        def palette_png(palette, indices):
+            return (optimize.PNG_SIGNATURE + optimize.write_png_chunk(b'IHDR',
+                    struct.pack('>IIBBBBB', 2, 1, 8, 3, 0, 0, 0)) +
+                    (optimize.write_png_chunk(b'PLTE', palette)
+                        if palette is not None else b'') +
+                    optimize.write_png_chunk(b'IDAT', zlib.compress(b'\0' +
+                        bytes(indices))) +
+                    optimize.write_png_chunk(b'IEND', b''))
+        for png in (palette_png(None, (0, 0)), # no palette
+                palette_png(b'\0\0\0\xff', (0, 0)), # truncated colour
+                palette_png(b'\0\0\0', (0, 5))): # index out of range
+            self.assertEqual(optimize.optimize_png(png), png)
+
+    def test_that_all_filters_are_reversed(self):
+        rows = [bytearray(range(i, i + 8)) for i in range(0, 40, 8)]
+        for kind in range(5):
+            data = b''.join(bytes([kind]) + optimize.filter_row(kind, row,
+                (rows[i - 1] if i else bytearray(8)), 4)
+                for i, row in enumerate(rows))
+            self.assertEqual(optimize.unfilter_rows(data, 5, 8, 4), rows)
+
+
+class TestImageOptimizer(unittest.TestCase):
+    def setUp(self):
+        self.original_directory = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+
+    def tearDown(self):
+        os.chdir(self.original_directory)
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_that_nothing_is_enabled_by_default(self):
+        self.assertFalse(optimize.ImageOptimizer().is_enabled())
+
+    def test_that_svg_files_are_minified_and_counted(self):
+        with open('eqn000.svg', 'w', encoding='utf-8') as f:
+            f.write(DVISVGM_OUTPUT)
+        optimizer = optimize.ImageOptimizer()
+        optimizer.set_minify_svg(2)
+        before, after = optimizer.optimize('eqn000.svg')
+        self.assertEqual(before, len(DVISVGM_OUTPUT))
+        self.assertEqual(after, os.path.getsize('eqn000.svg'))
+        self.assertTrue(after < before)
+        self.assertEqual(optimizer.get_statistics(), (1, before, after))
+
+    def test_that_files_are_not_enlarged(self):
+        with open('eqn000.svg', 'w', encoding='utf-8') as f:
+            f.write("<svg/>")
+        optimizer = optimize.ImageOptimizer()
+        optimizer.set_minify_svg(2)
+        self.assertEqual(optimizer.optimize('eqn000.svg'), (6, 6))
+
+    def test_that_png_files_are_optimized(self):
+        with open('eqn000.png', 'wb') as f:
+            f.write(make_png(10, 10, [(0, 0, 0, 255)] * 100))
+        optimizer = optimize.ImageOptimizer()
+        optimizer.set_optimize_png(True)
+        self.assertTrue(optimizer.is_enabled())
+        before, after = optimizer.optimize('eqn000.png')
+        self.assertTrue(after < before)
+        self.assertEqual(after, os.path.getsize('eqn000.png'))
+
+    def test_that_svg_files_are_precompressed(self):
+        with open('eqn000.svg', 'w', encoding='utf-8') as f:
+            f.write(DVISVGM_OUTPUT)
+        optimizer = optimize.ImageOptimizer()
+        optimizer.set_minify_svg(2)
+        optimizer.set_precompress_svg(True)
+        optimizer.optimize('eqn000.svg')
+        with open('eqn000.svg', 'rb') as f:
+            minified = f.read()
+        with gzip.open('eqn000.svg.gz') as f:
+            self.assertEqual(f.read(), minified)
+        with open('eqn000.svg.gz', 'rb') as f:
+            compressed = f.read()
+        optimizer.optimize('eqn000.svg') # no time stamp, same content
+        with open('eqn000.svg.gz', 'rb') as f:
+            self.assertEqual(f.read(), compressed)
+        self.assertEqual(sorted(os.listdir('.')), ['eqn000.svg',
+                'eqn000.svg.gz'])
+
+    def test_that_missing_compressed_copies_are_created(self):
+        with open('eqn000.svg', 'w', encoding='utf-8') as f:
+            f.write(DVISVGM_OUTPUT)
+        optimizer = optimize.ImageOptimizer()
+        self.assertFalse(optimizer.precompress('eqn000.svg'))
+        optimizer.set_precompress_svg(True)
+        self.assertTrue(optimizer.precompress('eqn000.svg'))
+        with gzip.open('eqn000.svg.gz') as f:
+            self.assertEqual(f.read().decode('utf-8'), DVISVGM_OUTPUT)
+        # up to date
+        self.assertFalse(optimizer.precompress('eqn000.svg'))
@@ -0,0 +1,103 @@
+#pylint: disable=too-many-public-methods,import-error,too-few-public-methods,missing-docstring,unused-variable
+import threading
+import time
+import unittest
+
+from gleetex.pipeline import RenderPipeline
+
+def run(pipeline, jobs):
+    for job in jobs:
+        pipeline.submit(job)
+    pipeline.close()
+    return list(pipeline.results())
+
+class TestRenderPipeline(unittest.TestCase):
+    def test_that_all_jobs_pass_both_stages(self):
+        with RenderPipeline(lambda j: j * 2, lambda j, i: i + 1, 3, 2) as p:
+            results = run(p, range(20))
+        self.assertEqual(sorted(r[1] for r in results),
+                [j * 2 + 1 for j in range(20)])
+        self.assertTrue(all(r[0] * 2 + 1 == r[1] for r in results))
+
+    def test_that_exceptions_are_returned_with_their_job(self):
+        def fail(job):
+            if job == 3:
+                raise ValueError("three")
+            return job
+        with RenderPipeline(fail, lambda j, i: i, 2, 2) as p:
+            results = run(p, range(5))
+        errors = [r for r in results if r[2]]
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(errors[0][0], 3)
+        self.assertTrue(isinstance(errors[0][2], ValueError))
+
+    def test_that_empty_pipeline_terminates(self):
+        with RenderPipeline(lambda j: j, lambda j, i: i) as p:
+            self.assertEqual(run(p, []), [])
+
+    def test_that_queue_between_stages_is_bounded(self):
+        release = threading.Event()
+        done = []
+        def first(job):
+            done.append(job)
+            return job
+        def second(job, intermediate):
+            release.wait()
+            return intermediate
+        with RenderPipeline(first, second, 1, 1, queue_size=2) as p:
+            for job in range(10):
+                p.submit(job)
+            p.close()
+            time.sleep(0.2)
+            # one job in the second stage, two waiting, one blocked in `put`
+            self.assertTrue(len(done) <= 4, "first stage ran ahead: %s" % done)
+            release.set()
+            self.assertEqual(len(list(p.results())), 10)
+
+    def test_that_cancelled_jobs_are_dropped(self):
+        release = threading.Event()
+        def first(job):
+            release.wait()
+            return job
+        cancelled = []
+        with RenderPipeline(first, lambda j, i: i, 1, 1,
+                on_cancel=lambda: cancelled.append(True)) as p:
+            for job in range(10):
+                p.submit(job)
+            p.close()
+            p.cancel()
+            p.cancel()
+            release.set()
+            results = list(p.results())
+        self.assertTrue(len(results) < 10)
+        self.assertEqual(cancelled, [True])
+
+    def test_that_jobs_submitted_after_cancelling_are_dropped(self):
+        started = []
+        def first(job):
+            started.append(job)
+            return job
+        cancelled = []
+        with RenderPipeline(first, lambda j, i: i, 2, 1,
+                on_cancel=lambda: cancelled.append(True)) as p:
+            p.cancel()
+            # cancelling from several threads calls on_cancel once
+            threads = [threading.Thread(target=p.cancel) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for job in range(10):
+                p.submit(job)
+            for thread in threads:
+                thread.join()
+            p.close()
+            self.assertEqual(list(p.results()), [])
+        self.assertEqual((started, cancelled), ([], [True]))
+
+    def test_that_exception_in_block_cancels_pipeline(self):
+        cancelled = []
+        with self.assertRaises(KeyError):
+            with RenderPipeline(lambda j: j, lambda j, i: i,
+                    on_cancel=lambda: cancelled.append(True)) as p:
+                p.submit(1)
+                raise KeyError()
+        self.assertEqual(cancelled, [True])
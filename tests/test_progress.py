@@ -0,0 +1,34 @@
+import io
+import unittest
+from gleetex import progress
+
+def event(kind, index=0):
+    return progress.make_event(kind, index, 'a', False)
+
+class TestProgressBar(unittest.TestCase):
+    def test_that_processed_formulas_are_counted(self):
+        out = io.StringIO()
+        bar = progress.ProgressBar(out, width=10, interval=0)
+        for index in range(3):
+            bar(event(progress.QUEUED, index))
+        bar(event(progress.CACHE_HIT, 3))
+        bar(event(progress.LATEX_START))
+        bar(event(progress.IMAGE_DONE))
+        self.assertTrue(bar.get_line().startswith('[#####-----] 2/4 formulas'))
+        bar(event(progress.FAILED, 1))
+        self.assertTrue('3/4 formulas, 1 failed' in bar.get_line())
+        self.assertTrue('ETA' in bar.get_line())
+
+    def test_that_finish_ends_line_only_if_drawn(self):
+        out = io.StringIO()
+        bar = progress.ProgressBar(out)
+        bar.finish()
+        self.assertEqual(out.getvalue(), '')
+        bar(event(progress.CACHE_HIT))
+        bar.finish()
+        self.assertTrue(out.getvalue().startswith('\r['))
+        self.assertTrue(out.getvalue().endswith('\n'))
+
+    def test_duration_format(self):
+        self.assertEqual(progress.format_duration(62), '1:02')
+        self.assertEqual(progress.format_duration(3725), '1:02:05')